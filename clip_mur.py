@@ -1,54 +1,126 @@
 #!/usr/bin/env python3
 
-# I _was_ going to have this code clip the NetCDF file but that was
-# before I realized ncks can accept latitude,longitude ranges instead of
-# just indices.  ¯\_(ツ)_/¯
+# Crop MUR SST NetCDF files to the MapS bounding box, the python
+# equivalent of `ncks --no_alphabetize $MUR_NCKS_ARGS` in maps_input.sh.
 #
-#  At least I didn't get too far into writing it :)
+# The global 0.01° MUR files are huge, so rather than having ncks (or
+# this code) search the lat, lon axes of every file, index bounds are
+# looked up in the grid index (grid_index.py, calculated once per grid)
+# and only that hyperslab of each variable is read.
+#
+# Usage: clip_mur.py -o OUTPUT FILE   (crop)
+#        clip_mur.py FILE             (show index bounds, ncks commands)
 
 import argparse
+import os
+import sys
+import time
 from netCDF4 import Dataset
-import numpy as np
-
-def clip(filename):
-    nc = Dataset(filename, 'r')
 
-    # Code stolen/adapted from https://stackoverflow.com/a/29136166/1502174
+import grid_index
 
-    # Hamid's [expanded] MapS DLNN bounding box
-    latbounds = [ 25.24 , 29.0 ]
-    lonbounds = [ -98.01 , -94.25 ] # degrees east
+BOX = 'mur'
 
-    lats = nc.variables['lat'][:]
-    lons = nc.variables['lon'][:]
 
-    # latitude lower and upper index
-    latli = np.argmin( np.abs( lats - latbounds[0] ) )
-    latui = np.argmin( np.abs( lats - latbounds[1] ) )
-
-    # longitude lower and upper index
-    lonli = np.argmin( np.abs( lons - lonbounds[0] ) )
-    lonui = np.argmin( np.abs( lons - lonbounds[1] ) )
+def clip(filename, index, box=BOX):
+    nc = Dataset(filename, 'r')
+    try:
+        lat, lon = grid_index.netcdf_slices(index, nc, box)
+        lats = nc.variables['lat'][lat]
+        lons = nc.variables['lon'][lon]
+    finally:
+        nc.close()
 
+    (lon0, lon1), (lat0, lat1) = grid_index.BOXES[box]
     # Actual latitude/longitude values for ncks _must_ include decimal point
     # FMI see https://stackoverflow.com/a/25751550/1502174
-    latbounds_str = ','.join([str(float(x)) for x in latbounds])
-    lonbounds_str = ','.join([str(float(x)) for x in lonbounds])
+    latbounds_str = f'{float(lat0)},{float(lat1)}'
+    lonbounds_str = f'{float(lon0)},{float(lon1)}'
 
-    # KISS
+    # KISS.  Index ranges are inclusive for ncks
     print(f'For latitude range [{latbounds_str}] and longitude range [{lonbounds_str}] in file {filename}:')
-    print(f' • Latitude indexes are [{latli}, {latui}], longitude indexes are [{lonli},{lonui}]')
+    print(f' • Latitude indexes are [{lat.start}, {lat.stop - 1}], longitude indexes are [{lon.start},{lon.stop - 1}]')
     print(f'ncks command invocations to crop this file:')
     print(f' • ncks --no_alphabetize -d lat,{latbounds_str} -d lon,{lonbounds_str} {filename} -O range_example.nc')
-    print(f' • ncks --no_alphabetize -d lat,{latli},{latui} -d lon,{lonli},{lonui} {filename} -O index_example.nc\n')
+    print(f' • ncks --no_alphabetize -d lat,{lat.start},{lat.stop - 1} -d lon,{lon.start},{lon.stop - 1} {filename} -O index_example.nc\n')
+
+    print(f'From the NetCDF file, latitude bounds {lats[0]:.6f},{lats[-1]:.6f} ; longitude bounds {lons[0]:.6f},{lons[-1]:.6f}')
+    print(f' • resulting grid dimensions {lats.size} latitude, {lons.size} longitude')
+
+
+def crop(filename, output, index, box=BOX):
+    """Write the box hyperslab of MUR SST file filename to output, w/ the
+       same dimensions, variables, attributes and storage settings.
+       Written to a temporary file renamed to output, so an interrupted
+       crop doesn't leave an output maps_input.sh -r would skip
+    """
+    src = Dataset(filename, 'r')
+    try:
+        lat, lon = grid_index.netcdf_slices(index, src, box)
+        window = {'lat': lat, 'lon': lon}
+        tmp = f'{output}.tmp{os.getpid()}'
+        try:
+            dst = Dataset(tmp, 'w', format=src.data_model)
+            try:
+                # Copy packed values as is, no (un)scaling or masking
+                src.set_auto_maskandscale(False)
+                for name, dim in src.dimensions.items():
+                    if name in window:
+                        size = len(range(dim.size)[window[name]])
+                    else:
+                        size = None if dim.isunlimited() else dim.size
+                    dst.createDimension(name, size)
+
+                for name, var in src.variables.items():
+                    attrs = var.__dict__.copy()
+                    fill_value = attrs.pop('_FillValue', None)
+                    kwargs = {}
+                    filters = var.filters() or {}
+                    if filters.get('zlib'):
+                        kwargs.update(zlib=True, complevel=filters.get('complevel', 4), shuffle=filters.get('shuffle', False))
+                    chunking = var.chunking() if src.data_model.startswith('NETCDF4') else 'contiguous'
+                    if chunking not in (None, 'contiguous'):
+                        kwargs['chunksizes'] = [min(c, len(dst.dimensions[d]) or c) for c, d in zip(chunking, var.dimensions)]
+                    out = dst.createVariable(name, var.datatype, var.dimensions, fill_value=fill_value, **kwargs)
+                    out.set_auto_maskandscale(False)
+                    out.setncatts(attrs)
+
+                dst.setncatts(src.__dict__)
+                history = f'{time.ctime(time.time())}: {" ".join(sys.argv)}'
+                dst.history = history + ('\n' + src.history if 'history' in src.ncattrs() else '')
 
-    print(f'From the NetCDF file, latitude bounds {lats[latli]:.6f},{lats[latui]:.6f} ; longitude bounds {lons[lonli]:.6f},{lons[lonui]:.6f}')
-    print(f' • resulting grid dimensions {latui-latli} latitude, {lonui-lonli} longitude')
+                # Only read the hyperslab we keep
+                for name, var in src.variables.items():
+                    index_exp = tuple(window.get(d, slice(None)) for d in var.dimensions)
+                    dst.variables[name][:] = var[index_exp]
+            finally:
+                dst.close()
+            os.replace(tmp, output)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+            raise
+    finally:
+        src.close()
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
-    parser.add_argument('file', help='NetCDF file to examine WRT latitude, longitude')
+    parser.add_argument('file', help='MUR SST NetCDF file to crop (or examine WRT latitude, longitude)')
+    parser.add_argument('-o', '--output', help='Write cropped NetCDF file here')
+    parser.add_argument('-i', '--index', default=grid_index.DEFAULT_INDEX, help=f'Grid index file (default: {grid_index.DEFAULT_INDEX})')
     args = parser.parse_args()
-    if args.file:
-        clip(args.file)
+    index = grid_index.GridIndex(args.index)
+    try:
+        if args.output:
+            crop(args.file, args.output, index)
+        else:
+            clip(args.file, index)
+    except (OSError, KeyError, ValueError, RuntimeError) as err:
+        print(f'?error when trying to crop file "{args.file}": {err}', file=sys.stderr)
+        sys.exit(1)
+    finally:
+        try:
+            index.save()
+        except OSError as err:
+            print(f'?unable to save grid index "{index.filename}": {err}', file=sys.stderr)
@@ -0,0 +1,281 @@
+#!/usr/bin/env python3
+
+"""
+Local stand-in for NOMADS/NCEI to test download_urls.py against: serves
+a directory over HTTP/1.1 (keep-alive) w/ Last-Modified, If-Modified-Since,
+Range and If-Range (a stale If-Range gets the whole file, like Apache).
+/moved/PATH redirects (302) to /PATH.
+
+`check` runs download_urls.py's Downloader against a stand-in serving
+made up files in a temporary directory: resuming a partial download
+(also redirected), a remote file that changed under a partial one, a
+truncated local file, and --match slim GRIB files from the .idx byte
+ranges (fresh and resumed).  Exits non-zero if any check fails.
+
+Runs on gridftp too (Python v3.4), hence stdlib only and no f-strings.
+
+E.g., download_standin.py serve -p 8000 $ARCHIVE_DIR
+      FOGHAT_NOMADS_URL=http://localhost:8000 ./nomads-download.sh href
+      download_standin.py check
+"""
+
+import argparse
+import email.utils
+import http.server
+import os
+import re
+import socketserver
+import sys
+import tempfile
+import threading
+
+import download_urls
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def send_empty(self, status):
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_GET(self):
+        path = os.path.join(self.server.root, self.path.split('?')[0].lstrip('/'))
+        self.server.requests.append((self.path, self.headers.get('Range')))
+        if self.path.startswith('/moved/'):
+            self.send_response(302)
+            self.send_header('Location', self.path[len('/moved'):])
+            self.send_header('Content-Length', '0')
+            return self.end_headers()
+        if os.path.isdir(path):
+            path = os.path.join(path, 'index.html')
+        if not os.path.isfile(path):
+            return self.send_empty(404)
+        mtime = int(os.path.getmtime(path))
+        last_modified = email.utils.formatdate(mtime, usegmt=True)
+        since = self.headers.get('If-Modified-Since')
+        if since and email.utils.mktime_tz(email.utils.parsedate_tz(since)) >= mtime:
+            return self.send_empty(304)
+        with open(path, 'rb') as f:
+            data = f.read()
+
+        match = re.match(r'^bytes=(\d+)-(\d*)$', self.headers.get('Range', ''))
+        if match and self.headers.get('If-Range', last_modified) == last_modified:
+            start = int(match.group(1))
+            end = min(int(match.group(2)) + 1, len(data)) if match.group(2) else len(data)
+            if start >= len(data):
+                return self.send_empty(416)
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(start, end - 1, len(data)))
+            data = data[start:end]
+        else:
+            self.send_response(200)
+        self.send_header('Last-Modified', last_modified)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class Server(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, root, port=0, verbose=False):
+        super().__init__(('127.0.0.1', port), Handler)
+        self.root = root
+        self.verbose = verbose
+        # (path, Range header) of every request, for check
+        self.requests = []
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}'.format(self.server_address[1])
+
+
+def write_file(filename, data, mtime=None):
+    with open(filename, 'wb') as f:
+        f.write(data)
+    if mtime is not None:
+        os.utime(filename, (mtime, mtime))
+
+
+def fake_grib(fields):
+    """(GRIB file, wgrib2 .idx) of made up messages, one per
+       (variable, level), each GRIB...7777 w/ a different length
+    """
+    data = b''
+    lines = []
+    for i, (var, level) in enumerate(fields):
+        lines.append('{}:{}:d=2020010100:{}:{}:anl:'.format(i + 1, len(data), var, level))
+        data += b'GRIB' + bytes([i]) * (1000 + 100 * i) + b'7777'
+    return data, '\n'.join(lines) + '\n'
+
+
+def check(verbose=False):
+    """Downloader vs. a stand-in server.  Returns the number of failures"""
+    failures = []
+
+    def expect(ok, what):
+        print('{} {}'.format('ok    ' if ok else 'FAILED', what), file=sys.stderr)
+        if not ok:
+            failures.append(what)
+
+    def read(filename):
+        with open(filename, 'rb') as f:
+            return f.read()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        www, dest = os.path.join(tmp, 'www'), os.path.join(tmp, 'dest')
+        os.makedirs(www)
+        os.makedirs(dest)
+        server = Server(www, verbose=verbose)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        mtime = 1577836800
+
+        def downloader(match=None):
+            return download_urls.Downloader(dest, jobs=2, retries=0, match=match)
+
+        def ranges(name):
+            return [r for path, r in server.requests if path == '/' + name]
+
+        data = os.urandom(300000)
+        write_file(os.path.join(www, 'a.grib2'), data, mtime)
+        write_file(os.path.join(www, 'b.grib2'), data, mtime)
+        results = downloader().download([server.url + '/a.grib2', server.url + '/b.grib2', server.url + '/none.grib2'])
+        expect(results.get('downloaded') and len(results['downloaded']) == 2 and results.get('missing') == ['none.grib2'],
+               'download 2 files, 404 is missing: {}'.format(results))
+        expect(read(os.path.join(dest, 'a.grib2')) == data, 'downloaded file matches')
+        expect(int(os.path.getmtime(os.path.join(dest, 'a.grib2'))) == mtime, 'mtime set from Last-Modified')
+        del server.requests[:]
+        results = downloader().download([server.url + '/a.grib2'])
+        expect(results == {'unchanged': ['a.grib2']} and not server.requests, 'manifest entry not requested again')
+
+        # Interrupted download: .part w/ the first 100000 bytes and a partial manifest entry
+        def interrupt(name):
+            os.remove(os.path.join(dest, name))
+            write_file(os.path.join(dest, name + '.part'), data[:100000])
+            entry = download_urls.Manifest(dest).get(name)
+            entry.update(partial=True, md5=None)
+            download_urls.Manifest(dest).update(name, entry)
+
+        interrupt('a.grib2')
+        results = downloader().download([server.url + '/a.grib2'])
+        expect(results == {'resumed': ['a.grib2']}, 'partial file resumed: {}'.format(results))
+        expect(ranges('a.grib2') == ['bytes=100000-'], 'range request from .part size: {}'.format(ranges('a.grib2')))
+        expect(read(os.path.join(dest, 'a.grib2')) == data and not os.path.exists(os.path.join(dest, 'a.grib2.part')),
+               'resumed file matches')
+        expect(download_urls.Manifest(dest).get('a.grib2').get('md5') == download_urls.file_md5(os.path.join(dest, 'a.grib2')).hexdigest(),
+               'manifest md5 of resumed file')
+
+        # Redirected, range request keeps its Range and If-Range
+        interrupt('a.grib2')
+        entry = download_urls.Manifest(dest).get('a.grib2')
+        entry.update(url=server.url + '/moved/a.grib2')
+        download_urls.Manifest(dest).update('a.grib2', entry)
+        del server.requests[:]
+        results = downloader().download([server.url + '/moved/a.grib2'])
+        expect(results == {'resumed': ['a.grib2']} and read(os.path.join(dest, 'a.grib2')) == data,
+               'redirected partial file resumed: {}'.format(results))
+        expect(server.requests == [('/moved/a.grib2', 'bytes=100000-'), ('/a.grib2', 'bytes=100000-')],
+               'Range kept across the redirect: {}'.format(server.requests))
+
+        # Truncated file (mtime kept) doesn't match its manifest entry, downloaded again
+        write_file(os.path.join(dest, 'a.grib2'), data[:1000], mtime)
+        results = downloader().download([server.url + '/moved/a.grib2'])
+        expect(results == {'downloaded': ['a.grib2']} and read(os.path.join(dest, 'a.grib2')) == data,
+               'truncated file downloaded again: {}'.format(results))
+        expect(download_urls.Manifest(dest).get('a.grib2').get('size') == len(data), 'manifest size of file downloaded again')
+
+        # Remote file changed since the partial download, If-Range doesn't match
+        interrupt('b.grib2')
+        data = os.urandom(250000)
+        write_file(os.path.join(www, 'b.grib2'), data, mtime + 3600)
+        results = downloader().download([server.url + '/b.grib2'])
+        expect(results == {'downloaded': ['b.grib2']}, 'changed file downloaded again: {}'.format(results))
+        expect(read(os.path.join(dest, 'b.grib2')) == data, 'changed file matches new remote file')
+        expect(download_urls.Manifest(dest).get('b.grib2').get('size') == len(data), 'manifest size of changed file')
+
+        # --match: slim GRIB file from .idx byte ranges, adjacent messages in one request
+        fields = [('TMP', '2 m above ground'), ('VIS', 'surface'), ('HGT', 'surface'), ('RH', '2 m above ground'),
+                  ('UGRD', '10 m above ground'), ('VIS', 'cloud top')]
+        grib, idx = fake_grib(fields)
+        write_file(os.path.join(www, 'c.grib2'), grib, mtime)
+        write_file(os.path.join(www, 'c.grib2.idx'), idx.encode('ascii'), mtime)
+        match = ':(VIS|HGT):'
+        messages = download_urls.parse_idx(idx)
+        selected = download_urls.select_messages(messages, re.compile(match))
+        slim = b''.join(grib[offset:offset + length if length else None] for offset, length, lines in selected)
+        del server.requests[:]
+        results = downloader(match).download([server.url + '/c.grib2', server.url + '/c.grib2.idx'])
+        expect(results == {'downloaded': ['c.grib2'], 'skipped': ['c.grib2.idx']}, '--match download: {}'.format(results))
+        expect(read(os.path.join(dest, 'c.grib2')) == slim, 'slim GRIB file has the matching messages')
+        expect(len(ranges('c.grib2')) == 2, 'adjacent messages merged, 2 range requests: {}'.format(ranges('c.grib2')))
+        slim_messages = download_urls.parse_idx(read(os.path.join(dest, 'c.grib2.idx')).decode('ascii'))
+        expect(all(slim[offset:offset + 4] == b'GRIB' for offset, lines in slim_messages)
+               and [lines[0].split(':', 2)[2] for offset, lines in slim_messages]
+               == [lines[0].split(':', 2)[2] for offset, length, lines in selected],
+               'slim .idx offsets point at its messages')
+        del server.requests[:]
+        results = downloader(match).download([server.url + '/c.grib2'])
+        expect(results == {'unchanged': ['c.grib2']} and not server.requests, 'slim file not requested again')
+
+        # Interrupted slim download, resumed past the bytes already in .part
+        os.remove(os.path.join(dest, 'c.grib2'))
+        write_file(os.path.join(dest, 'c.grib2.part'), slim[:1500])
+        entry = download_urls.Manifest(dest).get('c.grib2')
+        entry.update(partial=True)
+        download_urls.Manifest(dest).update('c.grib2', entry)
+        del server.requests[:]
+        results = downloader(match).download([server.url + '/c.grib2'])
+        expect(results == {'resumed': ['c.grib2']}, 'slim file resumed: {}'.format(results))
+        expect(read(os.path.join(dest, 'c.grib2')) == slim, 'resumed slim GRIB file matches')
+        expect(ranges('c.grib2')[0] == 'bytes={}-{}'.format(selected[0][0] + 1500, selected[1][0] + selected[1][1] - 1),
+               'slim resume range starts past .part: {}'.format(ranges('c.grib2')))
+
+        # The inventory changed, slim file starts over
+        grib, idx = fake_grib(fields[::-1])
+        write_file(os.path.join(www, 'c.grib2'), grib, mtime + 3600)
+        write_file(os.path.join(www, 'c.grib2.idx'), idx.encode('ascii'), mtime + 3600)
+        os.remove(os.path.join(dest, 'c.grib2'))
+        write_file(os.path.join(dest, 'c.grib2.part'), slim[:1500])
+        entry = download_urls.Manifest(dest).get('c.grib2')
+        entry.update(partial=True)
+        download_urls.Manifest(dest).update('c.grib2', entry)
+        selected = download_urls.select_messages(download_urls.parse_idx(idx), re.compile(match))
+        slim = b''.join(grib[offset:offset + length if length else None] for offset, length, lines in selected)
+        results = downloader(match).download([server.url + '/c.grib2'])
+        expect(results == {'downloaded': ['c.grib2']}, 'changed inventory downloaded again: {}'.format(results))
+        expect(read(os.path.join(dest, 'c.grib2')) == slim, 'slim GRIB file from new inventory')
+
+        server.shutdown()
+        server.server_close()
+    print('?{} check(s) failed'.format(len(failures)) if failures else '?all checks passed', file=sys.stderr)
+    return len(failures)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Local HTTP stand-in server to test download_urls.py against')
+    parser.add_argument('-v', '--verbose', action='store_true', help='Log requests')
+    subparsers = parser.add_subparsers(dest='command')
+    serve_parser = subparsers.add_parser('serve', help='Serve a directory w/ Range, If-Range and If-Modified-Since')
+    serve_parser.add_argument('-p', '--port', type=int, default=8000, help='Port (default: 8000)')
+    serve_parser.add_argument('directory', nargs='?', default='.', help='Directory to serve (default: current directory)')
+    subparsers.add_parser('check', help='Check download_urls.py: resume, redirect, changed file, corrupt file, --match slim GRIB')
+    args = parser.parse_args()
+
+    if args.command == 'serve':
+        server = Server(os.path.abspath(args.directory), args.port, verbose=True)
+        print('?serving {} at {}'.format(args.directory, server.url), file=sys.stderr)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+    elif args.command == 'check':
+        sys.exit(1 if check(args.verbose) else 0)
+    else:
+        parser.print_help()
+        sys.exit(2)
@@ -0,0 +1,570 @@
+#!/usr/bin/env python3
+
+"""
+Concurrent, resumable replacement for the `wget --timestamping
+--input-file=-` calls in nomads-download.sh (and the recursive wget of an
+NCEI order directory in nam-archive-dl.sh).
+
+URLs are downloaded by a few worker threads, each keeping one persistent
+(keep-alive) connection per host, so the 150-odd files of a day aren't
+150 TCP/TLS handshakes done one after another.  A file is written to
+FILE.part and renamed once its size checks out; an interrupted download
+is resumed w/ a range request (If-Range, so a changed file starts over).
+
+Each destination directory has a manifest, .download_manifest.json, w/
+the URL, size, md5 and Last-Modified of every file downloaded.  Files in
+the manifest w/ the right size (and md5 w/ --verify) aren't requested
+again, ones that don't match their entry are downloaded again and files
+that aren't in it (e.g. downloaded by wget) get a conditional GET.
+A 404 isn't an error, most HREF/SREF forecast hours just aren't up yet.
+Redirects are followed (up to 5, like wget's 20 but fewer), range
+requests keep their Range and If-Range headers.
+
+W/ --match REGEX only the GRIB messages w/ an inventory line matching
+REGEX (like wgrib2 -match) are downloaded: byte ranges from the file's
+.idx (adjacent messages merged into one range request) are written to a
+slim, valid GRIB file and a matching slim .idx, the manifest entry lists
+the messages fetched.  .idx URLs are skipped w/ --match.
+
+--limit-rate (total for all downloads) and --wait (between requests) work
+like wget's, both default to what $FOGHAT_WGET_OPTIONS says (e.g.
+"--limit-rate=10m --wait=5"), its other options are ignored.
+
+Runs on gridftp too (Python v3.4), hence stdlib only and no f-strings.
+
+E.g., generate_href_urls 20200101 | download_urls.py -d $ARCHIVE_DIR/2020/20200101
+      download_urls.py --index -d $TMP_DIR/$ORDER_ID $ORDER_URL
+      download_urls.py --match ':VIS:surface:' -d . $HREF_URL
+"""
+
+import argparse
+import email.utils
+import hashlib
+import http.client
+import http.cookiejar
+import json
+import os
+import re
+import sys
+import threading
+import time
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+MANIFEST = '.download_manifest.json'
+BUFFER_SIZE = 64 * 1024
+USER_AGENT = 'foghat-download_urls/1.0'
+REDIRECTS = (301, 302, 303, 307, 308)
+MAX_REDIRECTS = 5
+
+# NCEI order directories, same files nam-archive-dl.sh picks out of index.html
+INDEX_ACCEPT = r'^nam[^"/?]+tar$'
+
+
+def parse_rate(text):
+    """Bytes/second of a wget --limit-rate value, e.g. 10m, 200k, 5000"""
+    match = re.match(r'^(\d+(?:\.\d+)?)([kKmM]?)$', text.strip())
+    if not match:
+        raise ValueError('invalid rate "{}"'.format(text))
+    return float(match.group(1)) * {'': 1, 'k': 1024, 'm': 1024 * 1024}[match.group(2).lower()]
+
+
+def wget_options(text):
+    """(limit rate, wait) from wget options (e.g. $FOGHAT_WGET_OPTIONS),
+       None if not given
+    """
+    rate = wait = None
+    args = (text or '').split()
+    i = 0
+    while i < len(args):
+        arg = args[i]
+        name, _, value = arg.partition('=')
+        if name in ('--limit-rate', '--wait', '-w') and not value and i + 1 < len(args):
+            i += 1
+            value = args[i]
+        elif name.startswith('-w') and name != '-w' and not name.startswith('--'):
+            name, value = '-w', name[2:]
+        try:
+            if name == '--limit-rate':
+                rate = parse_rate(value)
+            elif name in ('--wait', '-w'):
+                wait = float(value)
+        except ValueError:
+            print('?ignoring wget option "{}"'.format(arg), file=sys.stderr)
+        i += 1
+    return rate, wait
+
+
+class Throttle:
+    """Bandwidth limit (bytes/second) shared by all downloads and a
+       minimum wait between requests, like wget --limit-rate and --wait
+    """
+
+    def __init__(self, rate=None, wait=None):
+        self.rate = rate
+        self.wait = wait
+        self.lock = threading.Lock()
+        self.next_byte_t = self.next_request_t = time.time()
+
+    def request(self):
+        """Block until the next request may be sent"""
+        if not self.wait:
+            return
+        with self.lock:
+            now = time.time()
+            start_t = max(now, self.next_request_t)
+            self.next_request_t = start_t + self.wait
+        time.sleep(max(0, start_t - now))
+
+    def received(self, nbytes):
+        """Block until nbytes more fit in the bandwidth limit"""
+        if not self.rate:
+            return
+        with self.lock:
+            now = time.time()
+            # No credit for idle time beyond a second's worth
+            start_t = max(now - 1, self.next_byte_t)
+            self.next_byte_t = start_t + nbytes / self.rate
+            delay = self.next_byte_t - now
+        if delay > 0:
+            time.sleep(delay)
+
+
+class DownloadError(Exception):
+    pass
+
+
+class Manifest:
+    """Per destination directory record of downloaded files, {filename:
+       {url, size, md5, last_modified}}, saved after every change
+    """
+
+    def __init__(self, directory):
+        self.filename = os.path.join(directory, MANIFEST)
+        self.lock = threading.Lock()
+        try:
+            with open(self.filename) as f:
+                self.entries = json.load(f)
+        except (OSError, ValueError):
+            self.entries = {}
+
+    def get(self, name):
+        with self.lock:
+            return dict(self.entries.get(name) or {})
+
+    def update(self, name, entry):
+        with self.lock:
+            self.entries[name] = entry
+            tmp = '{}.tmp{}'.format(self.filename, os.getpid())
+            with open(tmp, 'w') as f:
+                json.dump(self.entries, f, indent=1, sort_keys=True)
+            os.replace(tmp, self.filename)
+
+
+class ConnectionPool:
+    """One persistent connection per (thread, host)"""
+
+    def __init__(self, timeout=60):
+        self.timeout = timeout
+        self.local = threading.local()
+
+    def get(self, scheme, netloc):
+        conns = self.local.__dict__.setdefault('conns', {})
+        key = (scheme, netloc)
+        if key not in conns:
+            cls = http.client.HTTPSConnection if scheme == 'https' else http.client.HTTPConnection
+            conns[key] = cls(netloc, timeout=self.timeout)
+        return conns[key]
+
+    def discard(self, scheme, netloc):
+        conn = self.local.__dict__.get('conns', {}).pop((scheme, netloc), None)
+        if conn is not None:
+            conn.close()
+
+
+def file_md5(filename, md5=None):
+    md5 = md5 or hashlib.md5()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(BUFFER_SIZE), b''):
+            md5.update(block)
+    return md5
+
+
+def parse_idx(text):
+    """wgrib2 inventory (.idx) → [(offset, [inventory lines])], one per
+       GRIB message (sub-messages, e.g. 12.1, 12.2, share an offset)
+    """
+    messages = []
+    for line in text.splitlines():
+        fields = line.split(':')
+        if len(fields) < 3 or not fields[1].isdigit():
+            continue
+        offset = int(fields[1])
+        if messages and messages[-1][0] == offset:
+            messages[-1][1].append(line)
+        else:
+            messages.append((offset, [line]))
+    return messages
+
+
+def select_messages(messages, match):
+    """Messages w/ an inventory line matching regex match, like wgrib2
+       -match.  Returns [(offset, length or None if last in file, lines)]
+    """
+    selected = []
+    for i, (offset, lines) in enumerate(messages):
+        if any(match.search(line) for line in lines):
+            length = messages[i + 1][0] - offset if i + 1 < len(messages) else None
+            selected.append((offset, length, lines))
+    return selected
+
+
+def byte_ranges(selected, done=0):
+    """(start, end or None) ranges covering the selected messages,
+       adjacent ones merged, w/o the first done bytes (already fetched)
+    """
+    ranges = []
+    for offset, length, lines in selected:
+        if ranges and ranges[-1][1] == offset:
+            ranges[-1][1] = offset + length if length is not None else None
+        else:
+            ranges.append([offset, offset + length if length is not None else None])
+    remaining = []
+    for start, end in ranges:
+        if end is not None and end - start <= done:
+            done -= end - start
+            continue
+        remaining.append((start + done, end))
+        done = 0
+    return remaining
+
+
+def slim_idx(selected):
+    """Inventory of the slim file, offsets of the selected messages in it"""
+    lines = []
+    offset = 0
+    for old_offset, length, old_lines in selected:
+        for line in old_lines:
+            fields = line.split(':')
+            fields[1] = str(offset)
+            lines.append(':'.join(fields))
+        offset += length or 0
+    return '\n'.join(lines) + '\n'
+
+
+def check_grib(filename, selected):
+    """Make sure the slim file is made of whole GRIB messages"""
+    with open(filename, 'rb') as f:
+        data = f.read()
+    offset = 0
+    for old_offset, length, lines in selected:
+        end = offset + length if length is not None else len(data)
+        if data[offset:offset + 4] != b'GRIB' or data[end - 4:end] != b'7777':
+            raise DownloadError('not a whole GRIB message at offset {} ({})'.format(offset, lines[0]))
+        offset = end
+    if offset != len(data):
+        raise DownloadError('{} bytes past last GRIB message'.format(len(data) - offset))
+
+
+def verified(filename, entry, check_md5=False):
+    """True if filename matches its manifest entry"""
+    try:
+        size = os.path.getsize(filename)
+    except OSError:
+        return False
+    if not entry.get('size') or size != entry['size']:
+        return False
+    return not check_md5 or file_md5(filename).hexdigest() == entry.get('md5')
+
+
+class Downloader:
+
+    def __init__(self, directory, jobs=4, retries=3, cookies=None, check_md5=False, timeout=60, match=None,
+                 limit_rate=None, wait=None):
+        self.directory = directory
+        self.throttle = Throttle(limit_rate, wait)
+        self.match = re.compile(match) if match else None
+        self.jobs = jobs
+        self.retries = retries
+        self.check_md5 = check_md5
+        self.pool = ConnectionPool(timeout)
+        self.manifest = Manifest(directory)
+        self.cookies = None
+        if cookies:
+            self.cookies = http.cookiejar.MozillaCookieJar(cookies)
+            try:
+                self.cookies.load(ignore_discard=True)
+            except OSError:
+                pass
+
+    def request(self, method, url, headers=None):
+        """Send request, following up to MAX_REDIRECTS redirects (like
+           wget) w/ the same headers, e.g. Range and If-Range.  Returns
+           response, its url attribute the URL it came from
+        """
+        for hop in range(MAX_REDIRECTS + 1):
+            response = self.send(method, url, headers)
+            location = response.getheader('Location')
+            if response.status not in REDIRECTS or not location:
+                response.url = url
+                return response
+            response.read()
+            response.close()
+            url = urllib.parse.urljoin(url, location)
+        raise DownloadError('more than {} redirects'.format(MAX_REDIRECTS))
+
+    def send(self, method, url, headers=None):
+        """Send request over a pooled connection.  Returns response (the
+           caller reads it all so the connection can be reused)
+        """
+        parts = urllib.parse.urlsplit(url)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        headers = dict(headers or {})
+        headers['User-Agent'] = USER_AGENT
+        req = None
+        if self.cookies is not None:
+            req = urllib.request.Request(url)
+            self.cookies.add_cookie_header(req)
+            if req.has_header('Cookie'):
+                headers['Cookie'] = req.get_header('Cookie')
+        self.throttle.request()
+        conn = self.pool.get(parts.scheme, parts.netloc)
+        try:
+            conn.request(method, path, headers=headers)
+            response = conn.getresponse()
+        except (http.client.HTTPException, OSError):
+            # Server may have closed an idle keep-alive connection, one retry w/ a new one
+            self.pool.discard(parts.scheme, parts.netloc)
+            conn = self.pool.get(parts.scheme, parts.netloc)
+            conn.request(method, path, headers=headers)
+            response = conn.getresponse()
+        if req is not None:
+            self.cookies.extract_cookies(response, req)
+        return response
+
+    def fetch(self, url, name=None):
+        """Download url into the destination directory.  Returns (name,
+           status) where status is one of downloaded, resumed, unchanged,
+           missing (404), skipped (.idx w/ --match)
+        """
+        name = name or os.path.basename(urllib.parse.urlsplit(url).path)
+        final = os.path.join(self.directory, name)
+        part = final + '.part'
+        entry = self.manifest.get(name)
+        # A whole file has every message a --match would fetch
+        if (entry.get('url') == url and entry.get('match') in (None, self.match and self.match.pattern)
+                and verified(final, entry, self.check_md5)):
+            return name, 'unchanged'
+        if entry and not entry.get('partial') and os.path.exists(final):
+            # Truncated or corrupt, a conditional GET would keep it
+            print('?{} doesn\'t match its manifest entry, downloading it again'.format(name), file=sys.stderr)
+            entry = {}
+            os.remove(final)
+        if self.match:
+            if name.endswith('.idx'):
+                # Written w/ the slim GRIB file instead
+                return name, 'skipped'
+            return name, self.fetch_messages(url, name, entry)
+
+        headers = {}
+        offset = os.path.getsize(part) if os.path.exists(part) else 0
+        if offset and entry.get('partial') and entry.get('last_modified'):
+            headers['Range'] = 'bytes={}-'.format(offset)
+            headers['If-Range'] = entry['last_modified']
+        elif os.path.exists(final):
+            # Not in the manifest (e.g. from wget, which sets mtime to Last-Modified)
+            headers['If-Modified-Since'] = email.utils.formatdate(os.path.getmtime(final), usegmt=True)
+
+        response = self.request('GET', url, headers)
+        try:
+            if response.status == 404:
+                return name, 'missing'
+            if response.status == 304:
+                size = os.path.getsize(final)
+                self.manifest.update(name, {'url': url, 'size': size, 'md5': file_md5(final).hexdigest(),
+                                            'last_modified': entry.get('last_modified') or headers['If-Modified-Since']})
+                return name, 'unchanged'
+            if response.status == 416:
+                # Range past the end, start over
+                os.remove(part)
+                raise DownloadError('range not satisfiable, restarting')
+            if response.status not in (200, 206):
+                raise DownloadError('HTTP {} {}'.format(response.status, response.reason))
+            return name, self.receive(response, url, name, part, offset)
+        finally:
+            response.read()
+            response.close()
+
+    def receive(self, response, url, name, part, offset):
+        last_modified = response.getheader('Last-Modified')
+        length = response.getheader('Content-Length')
+        length = int(length) if length is not None else None
+        md5 = hashlib.md5()
+        if response.status == 206:
+            match = re.match(r'bytes (\d+)-\d+/(\d+|\*)', response.getheader('Content-Range', ''))
+            if not match or int(match.group(1)) != offset:
+                raise DownloadError('unexpected Content-Range "{}"'.format(response.getheader('Content-Range')))
+            total = int(match.group(2)) if match.group(2) != '*' else None
+            file_md5(part, md5)
+            mode, status = 'ab', 'resumed'
+        else:
+            offset, total, mode, status = 0, length, 'wb', 'downloaded'
+        # Record validator first, so an interrupted download can be resumed
+        self.manifest.update(name, {'url': url, 'size': total, 'last_modified': last_modified, 'partial': True})
+
+        received = 0
+        with open(part, mode) as f:
+            for block in iter(lambda: response.read(BUFFER_SIZE), b''):
+                f.write(block)
+                md5.update(block)
+                received += len(block)
+                self.throttle.received(len(block))
+        if length is not None and received != length:
+            raise DownloadError('received {} of {} bytes'.format(received, length))
+        size = offset + received
+        if total is not None and size != total:
+            raise DownloadError('size {} != {} bytes'.format(size, total))
+
+        os.replace(part, os.path.join(self.directory, name))
+        if last_modified:
+            # Like wget --timestamping
+            mtime = email.utils.mktime_tz(email.utils.parsedate_tz(last_modified))
+            os.utime(os.path.join(self.directory, name), (mtime, mtime))
+        self.manifest.update(name, {'url': url, 'size': size, 'md5': md5.hexdigest(), 'last_modified': last_modified})
+        return status
+
+    def get(self, url, headers=None, expect=(200,)):
+        """Response (status, headers, body) of a small request"""
+        response = self.request('GET', url, headers)
+        try:
+            body = response.read()
+        finally:
+            response.close()
+        if response.status not in expect:
+            raise DownloadError('HTTP {} {} for {}'.format(response.status, response.reason, url))
+        return response.status, response, body
+
+    def fetch_messages(self, url, name, entry):
+        """Download only the GRIB messages matching --match using url's
+           .idx and range requests.  Writes a slim GRIB file and its .idx,
+           the manifest entry records what was fetched
+        """
+        final = os.path.join(self.directory, name)
+        part = final + '.part'
+        status, response, idx = self.get(url + '.idx', expect=(200, 404))
+        if status == 404:
+            return 'missing'
+        selected = select_messages(parse_idx(idx.decode('ascii', 'replace')), self.match)
+        if not selected:
+            raise DownloadError('no messages in {}.idx match "{}"'.format(url, self.match.pattern))
+        idx_md5 = hashlib.md5(idx).hexdigest()
+
+        # Resume if the inventory hasn't changed since the partial download
+        done = 0
+        if os.path.exists(part) and entry.get('partial') and entry.get('idx_md5') == idx_md5:
+            done = os.path.getsize(part)
+        md5 = file_md5(part) if done else hashlib.md5()
+        self.manifest.update(name, {'url': url, 'match': self.match.pattern, 'idx_md5': idx_md5, 'partial': True})
+
+        last_modified = source_size = None
+        with open(part, 'ab' if done else 'wb') as f:
+            for start, end in byte_ranges(selected, done):
+                rng = 'bytes={}-{}'.format(start, end - 1 if end is not None else '')
+                status, response, data = self.get(url, {'Range': rng}, expect=(206,))
+                match = re.match(r'bytes (\d+)-(\d+)/(\d+|\*)', response.getheader('Content-Range', ''))
+                if not match or int(match.group(1)) != start or (end is not None and len(data) != end - start):
+                    raise DownloadError('unexpected Content-Range "{}" for {}'.format(response.getheader('Content-Range'), rng))
+                last_modified = response.getheader('Last-Modified')
+                source_size = int(match.group(3)) if match.group(3) != '*' else None
+                f.write(data)
+                md5.update(data)
+                self.throttle.received(len(data))
+
+        check_grib(part, selected)
+        with open(final + '.idx', 'w') as f:
+            f.write(slim_idx(selected))
+        os.replace(part, final)
+        self.manifest.update(name, {'url': url, 'size': os.path.getsize(final), 'md5': md5.hexdigest(),
+                                    'last_modified': last_modified, 'match': self.match.pattern,
+                                    'idx_md5': idx_md5, 'source_size': source_size,
+                                    'messages': [lines[0] for offset, length, lines in selected]})
+        return 'resumed' if done else 'downloaded'
+
+    def fetch_w_retries(self, url, name=None):
+        for attempt in range(self.retries + 1):
+            try:
+                return self.fetch(url, name)
+            except (DownloadError, http.client.HTTPException, OSError) as err:
+                print('?{} attempt {} failed: {}'.format(url, attempt + 1, err), file=sys.stderr)
+                self.pool.discard(*urllib.parse.urlsplit(url)[:2])
+                if attempt < self.retries:
+                    time.sleep(2 ** attempt)
+        return name or os.path.basename(urllib.parse.urlsplit(url).path), 'failed'
+
+    def download(self, urls):
+        """Download urls concurrently.  Returns {status: [names]}"""
+        start_t = time.time()
+        results = {}
+        with ThreadPoolExecutor(max_workers=max(1, self.jobs)) as executor:
+            for name, status in executor.map(self.fetch_w_retries, urls):
+                results.setdefault(status, []).append(name)
+                if status in ('downloaded', 'resumed', 'failed'):
+                    print('?{} {}'.format(status, name), file=sys.stderr)
+        if self.cookies is not None:
+            self.cookies.save(ignore_discard=True)
+        print('?{} URL(s) in {:.1f} seconds ({} job(s)): {}'.format(
+            len(urls), time.time() - start_t, self.jobs,
+            ', '.join('{} {}'.format(len(v), k) for k, v in sorted(results.items()))), file=sys.stderr)
+        return results
+
+    def index_urls(self, url, accept=INDEX_ACCEPT):
+        """Save directory listing url as index.html, return URLs of the
+           files in it matching accept
+        """
+        response = self.request('GET', url)
+        try:
+            data = response.read()
+            if response.status != 200:
+                raise DownloadError('HTTP {} {} for {}'.format(response.status, response.reason, url))
+        finally:
+            response.close()
+        with open(os.path.join(self.directory, 'index.html'), 'wb') as f:
+            f.write(data)
+        base = response.url if response.url.endswith('/') else response.url + '/'
+        hrefs = re.findall(r'href="([^"]+)"', data.decode('utf-8', 'replace'), re.IGNORECASE)
+        names = sorted(set(h for h in hrefs if re.search(accept, h)))
+        return [urllib.parse.urljoin(base, h) for h in names]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Concurrent, resumable download of URLs (one per line on stdin or as arguments)')
+    parser.add_argument('-d', '--directory', default='.', help='Destination directory (default: current directory)')
+    parser.add_argument('-j', '--jobs', type=int, default=4, help='Concurrent downloads (default: 4)')
+    parser.add_argument('-r', '--retries', type=int, default=3, help='Retries per URL, w/ backoff (default: 3)')
+    parser.add_argument('--cookies', default=os.environ.get('FOGHAT_COOKIES'), help='Cookie file to load/save (default: $FOGHAT_COOKIES)')
+    parser.add_argument('--verify', action='store_true', help='Check md5 of files already downloaded, not just size')
+    parser.add_argument('--timeout', type=float, default=60, help='Socket timeout in seconds (default: 60)')
+    parser.add_argument('--index', action='store_true', help='URL is a directory listing (NCEI order), download files in it')
+    parser.add_argument('--accept', default=INDEX_ACCEPT, help='Regex of files to download w/ --index (default: {})'.format(INDEX_ACCEPT))
+    parser.add_argument('-m', '--match', help='Only download GRIB messages w/ .idx inventory lines matching this regex (e.g. ":VIS:surface:")')
+    wget_rate, wget_wait = wget_options(os.environ.get('FOGHAT_WGET_OPTIONS'))
+    parser.add_argument('--limit-rate', type=parse_rate, default=wget_rate, help='Total download rate limit, bytes/second w/ k or m suffix (default: from $FOGHAT_WGET_OPTIONS, none)')
+    parser.add_argument('-w', '--wait', type=float, default=wget_wait, help='Seconds between requests (default: from $FOGHAT_WGET_OPTIONS, none)')
+    parser.add_argument('url', nargs='*', help='URL(s), read from stdin if none')
+    args = parser.parse_args()
+
+    urls = args.url or [line.strip() for line in sys.stdin if line.strip()]
+    os.makedirs(args.directory, exist_ok=True)
+    downloader = Downloader(args.directory, args.jobs, args.retries, args.cookies, args.verify, args.timeout, args.match,
+                            args.limit_rate, args.wait)
+    try:
+        if args.index:
+            urls = [u for index_url in urls for u in downloader.index_urls(index_url, args.accept)]
+    except (DownloadError, http.client.HTTPException, OSError) as err:
+        print('?error when trying to read directory listing: {}'.format(err), file=sys.stderr)
+        sys.exit(1)
+    results = downloader.download(urls)
+    sys.exit(1 if results.get('failed') else 0)
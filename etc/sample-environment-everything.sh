@@ -7,25 +7,41 @@ export FOGHAT_COOKIES=$HOME/.cookies
 # Additional options for all wget invocations
 # I use this for network bandwidth utilization / server "niceness" and hopefully to not get IP/server banned by NOAA
 # FMI https://www.gnu.org/software/wget/manual/html_node/Download-Options.html
+# download_urls.py honors --limit-rate (total of its concurrent downloads) and --wait
 #export FOGHAT_WGET_OPTIONS="--limit-rate=10m --wait=5"
 
+# Concurrent downloads (download_urls.py) for nomads-download.sh, nam-archive-dl.sh
+#export FOGHAT_DOWNLOAD_JOBS=4
+# Only download (byte ranges of) the GRIB messages matching these regexes,
+# e.g. just what vis-generate.sh uses.  Whole files if unset
+#export FOGHAT_HREF_MATCH=':VIS:surface:'
+#export FOGHAT_SREF_MATCH=':VIS:surface:'
+
 # Only need these on server that's involved in NAM requests/downloads
 export FOGHAT_IMAP_HOST='imap.gmail.com'
 export FOGHAT_IMAP_USER='username'
 export FOGHAT_IMAP_PASSWD='password'
+# Defaults: port 993 w/ SSL.  E.g. for a local test IMAP server
+#export FOGHAT_IMAP_PORT=1143
+#export FOGHAT_IMAP_SSL=0
+# Local store of AIRS orders and their states (ncei_email.py orders)
+#export FOGHAT_ORDERS_DB=$FOGHAT_BASE/var/ncei_orders.sqlite
 
 # Send ncei_email.py logging output to file instead of stderr
 export FOGHAT_LOGGER2FILE=1
 
-# Only needed for server running Task Spooler (same as above)
-# man ts/ts.1  for environment variable description
-export TS_SLOTS=2
-export TS_SAVELIST=$HOME/.foghat_spooler
+# Only needed for server running the job queue, jobq.py (same as above)
+# Jobs to run at once
+export FOGHAT_JOBQ_SLOTS=2
+# Command (w/ options) that processes NCEI orders once they're downloaded, default maps_input.sh
+#export FOGHAT_JOBQ_PROCESS="sbatch --wait hpc_maps.sbatch"
 
 # Make sure email has HTML entities encoded  (@ → %40)
 export FOGHAT_EMAIL='username%40gmail.com'
 
 # Slightly confusing, but where to store generated model input files
+# (maps_*_input.nc, zlib compressed NetCDF4 w/ this level, 1-9, if set)
+#export FOGHAT_NC_COMPLEVEL=4
 export FOGHAT_INPUT_DIR=$FOGHAT_BASE/input
 export FOGHAT_EXE_DIR=$HOME/git/foghat
 
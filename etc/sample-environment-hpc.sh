@@ -9,9 +9,19 @@ export FOGHAT_EXE_DIR=$HOME/git/foghat
 # Additional options for all wget invocations
 # I use this for network bandwidth utilization / server "niceness" and hopefully to not get IP/server banned by NOAA
 # FMI https://www.gnu.org/software/wget/manual/html_node/Download-Options.html
+# download_urls.py honors --limit-rate (total of its concurrent downloads) and --wait
 #export FOGHAT_WGET_OPTIONS="--limit-rate=10m --wait=5"
 
+# Concurrent downloads (download_urls.py) for nomads-download.sh, nam-archive-dl.sh
+#export FOGHAT_DOWNLOAD_JOBS=4
+# Only download (byte ranges of) the GRIB messages matching these regexes,
+# e.g. just what vis-generate.sh uses.  Whole files if unset
+#export FOGHAT_HREF_MATCH=':VIS:surface:'
+#export FOGHAT_SREF_MATCH=':VIS:surface:'
+
 # Slightly confusing, but where to store generated model input files
+# (maps_*_input.nc, zlib compressed NetCDF4 w/ this level, 1-9, if set)
+#export FOGHAT_NC_COMPLEVEL=4
 export FOGHAT_INPUT_DIR=/work/TANN/$USER/fog
 # Logs from data processing should be stored in user-specific work directory
 export FOGHAT_LOG_DIR=/work/TANN/$USER/logs
@@ -1,9 +1,11 @@
 #!/usr/bin/env python3
 
 """
-Find NetCDF "filled values" in DQDZ1000SFC and DQDZ700725 derived
+Find NetCDF "filled values" in DQDZ975SFC and DQDZ700725 derived
 parameters in the generated input files (produced by maps_input.sh and
 maps_derived.py).
+
+See maps_qa.py for a parallel, incremental scan of every variable.
 """
 
 import os
@@ -12,19 +14,26 @@ import re
 from netCDF4 import Dataset
 import numpy as np
 
+# Lowest level was 1000mb (DQDZ1000SFC) once, it's 975mb now
+LABELS = ('DQDZ975SFC', 'DQDZ700725')
+
 def process_file(filename):
-    nc = Dataset(filename, 'r')
     m = re.search('maps_(\d+)_(\d+)_(\d+)_input.nc$', filename)
     if not m:                           # wrong filename, skip
         return
+    nc = Dataset(filename, 'r')
     strs = []
     strs.append(f'{m[0]},{m[1]},{m[2]},{m[3]}') # file information
-    for label in ('DQDZ1000SFC', 'DQDZ700725'):
+    for label in LABELS:
+        if label not in nc.variables:   # keep columns lined up
+            strs.append(',,')
+            continue
         var = nc.variables[label][:]
         min = var.data.min()
         max = var.data.max()
         oob = np.count_nonzero(var.data > 9999)
         strs.append(f'{min},{max},{oob}')
+    nc.close()
     print(','.join(strs))
 
 def process_folder(folder, limit=0):
@@ -0,0 +1,237 @@
+#!/usr/bin/env python3
+
+"""
+Clip-once spatial index for the grids we crop: MUR SST (regular 1-D
+lat/lon axes) and the NAM/HREF GRIB grids (2-D latitude/longitude).
+
+Index bounds for each of our bounding boxes are calculated once per grid
+definition and kept in a JSON file ($FOGHAT_BASE/var/grid_index.json by
+default), so cropping a file only reads the few coordinate values needed
+to identify its grid and then just the hyperslab we keep.
+
+Nearest grid points of the stations we extract point time series for
+(href_points.py) are kept there too.
+
+Usage: grid_index.py [-i INDEX] FILE...   (precompute/show index bounds)
+"""
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+
+import numpy as np
+
+# Bounding boxes, ((west, east), (south, north)) in degrees, that we crop to
+BOXES = {
+    # Hamid's MapS DL NN, LON_LAT in maps_input.sh and vis-generate.sh
+    'maps': ((-98.01, -94.20), (25.4, 28.85)),
+    # Hamid's [expanded] MapS DL NN, MUR_NCKS_ARGS in maps_input.sh
+    'mur': ((-98.01, -94.25), (25.24, 29.0)),
+    # Grid point(s) closest to KRAS airport, CSV_LON_LAT in vis-generate.sh
+    'kras': ((-97.07, -97.05), (27.79, 27.84)),
+}
+
+# Stations we extract point time series for (href_points.py), (longitude,
+# latitude) in degrees.  The 'kras' box above is KRAS's closest HREF grid point
+STATIONS = {
+    'KRAS': (-97.08875, 27.8118333),
+}
+
+DEFAULT_INDEX = os.path.join(os.environ.get('FOGHAT_BASE', '.'), 'var', 'grid_index.json')
+
+
+def axis_key(name, n, first, last):
+    """Key for a regular 1-D coordinate axis"""
+    return f'{name}:{n}:{float(first):.6f}:{float(last):.6f}'
+
+
+def axis_slice(values, lo, hi):
+    """(start, stop) of the values w/in [lo, hi], inclusive, like ncks -d
+       w/ floating point coordinates.  values must be monotonic
+    """
+    inside = np.nonzero((values >= lo) & (values <= hi))[0]
+    if inside.size == 0:
+        raise ValueError(f'no coordinates w/in [{lo}, {hi}]')
+    return int(inside[0]), int(inside[-1]) + 1
+
+
+def box_window(lats, lons, lon_lat):
+    """(rows (start, stop), columns (start, stop)) of the smallest part of
+       a 2-D grid containing every grid point w/in the lon_lat box (like
+       wgrib2 -small_grib).  Longitudes in [0, 360), as per wgrib2
+    """
+    lons = np.mod(lons, 360)
+    (lon0, lon1), (lat0, lat1) = lon_lat
+    inside = ((lats >= lat0) & (lats <= lat1) & (lons >= lon0 % 360) & (lons <= lon1 % 360))
+    rows, cols = np.nonzero(inside)
+    if rows.size == 0:
+        raise ValueError(f'no grid points inside {lon_lat}')
+    return (int(rows.min()), int(rows.max()) + 1), (int(cols.min()), int(cols.max()) + 1)
+
+
+def nearest_point(lats, lons, lon, lat):
+    """(row, column) of the 2-D grid point closest to (lon, lat).  Flat
+       earth distance, plenty for picking a neighbouring grid point
+    """
+    dlon = (np.mod(lons, 360) - lon % 360 + 180) % 360 - 180
+    distance = (lats - lat) ** 2 + (dlon * np.cos(np.radians(lat))) ** 2
+    row, col = np.unravel_index(np.argmin(distance), distance.shape)
+    return int(row), int(col)
+
+
+class GridIndex:
+    """Persistent cache of index bounds keyed by grid definition and box
+       name.  Entries are computed on first use, save() writes any new
+       ones back to the JSON file
+    """
+
+    def __init__(self, filename=DEFAULT_INDEX):
+        self.filename = filename
+        self.entries = self._load()
+        self.dirty = False
+
+    def _load(self):
+        try:
+            with open(self.filename) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as err:
+            print(f'?ignoring unreadable grid index "{self.filename}": {err}', file=sys.stderr)
+            return {}
+
+    def lookup(self, key, box, compute):
+        """Cached entry for (grid key, box name), calling compute() if needed"""
+        grid = self.entries.setdefault(key, {})
+        if box not in grid:
+            grid[box] = compute()
+            self.dirty = True
+        return grid[box]
+
+    def save(self):
+        """Merge new entries into the index file (other processes may have
+           added some of their own) and replace it atomically
+        """
+        if not self.dirty:
+            return
+        entries = self._load()
+        for key, boxes in self.entries.items():
+            entries.setdefault(key, {}).update(boxes)
+        directory = os.path.dirname(os.path.abspath(self.filename))
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=directory, prefix='.grid_index')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(entries, f, sort_keys=True)
+        os.chmod(tmp, 0o644)
+        os.replace(tmp, self.filename)
+        self.entries = entries
+        self.dirty = False
+
+
+def netcdf_axes(nc, lat='lat', lon='lon'):
+    """Grid key for a NetCDF file w/ regular 1-D lat, lon axes (e.g. MUR
+       SST), only reading the first/last coordinate values
+    """
+    lats, lons = nc.variables[lat], nc.variables[lon]
+    return 'nc:' + '/'.join((axis_key(lat, lats.size, lats[0], lats[-1]),
+                             axis_key(lon, lons.size, lons[0], lons[-1])))
+
+
+def netcdf_slices(index, nc, box, lat='lat', lon='lon'):
+    """(latitude slice, longitude slice) of box in NetCDF file nc"""
+    def compute():
+        (lon0, lon1), (lat0, lat1) = BOXES[box]
+        return {'lat': axis_slice(nc.variables[lat][:], lat0, lat1),
+                'lon': axis_slice(nc.variables[lon][:], lon0, lon1)}
+    entry = index.lookup(netcdf_axes(nc, lat, lon), box, compute)
+    return slice(*entry['lat']), slice(*entry['lon'])
+
+
+def grib_key(grb):
+    """Key uniquely identifying a GRIB message's grid definition"""
+    keys = ('gridDefinitionTemplateNumber', 'Nx', 'Ny', 'latitudeOfFirstGridPointInDegrees',
+            'longitudeOfFirstGridPointInDegrees', 'LoVInDegrees', 'Latin1InDegrees', 'Latin2InDegrees',
+            'DxInMetres', 'DyInMetres', 'jScansPositively')
+    return 'grib:' + ':'.join(str(grb[k] if grb.has_key(k) else None) for k in keys)
+
+
+def grib_window(index, grb, box):
+    """(row slice, column slice, latitudes, longitudes) of box in a GRIB
+       message's grid.  Latitudes and longitudes ([0, 360)) are the clipped
+       coordinates, cached too so grb.latlons() is only called once per grid
+    """
+    def compute():
+        lats, lons = grb.latlons()
+        rows, cols = box_window(lats, lons, BOXES[box])
+        window = (slice(*rows), slice(*cols))
+        return {'rows': rows, 'cols': cols,
+                'lats': lats[window].tolist(), 'lons': np.mod(lons[window], 360).tolist()}
+    entry = index.lookup(grib_key(grb), box, compute)
+    return (slice(*entry['rows']), slice(*entry['cols']),
+            np.array(entry['lats'], dtype=np.float64), np.array(entry['lons'], dtype=np.float64))
+
+
+def grib_points(index, grb, stations):
+    """{station: (row, column, latitude, longitude)} of the grid points
+       closest to stations ({name: (longitude, latitude)}) in a GRIB
+       message's grid.  Longitudes in [-180, 180), like wgrib2 -csv
+    """
+    latlons = []
+
+    def compute(lon, lat):
+        if not latlons:
+            latlons.extend(grb.latlons())
+        lats, lons = latlons
+        row, col = nearest_point(lats, lons, lon, lat)
+        return {'row': row, 'col': col, 'lat': float(lats[row, col]),
+                'lon': float((lons[row, col] + 180) % 360 - 180)}
+
+    key = grib_key(grb)
+    points = {}
+    for name, (lon, lat) in stations.items():
+        entry = index.lookup(key, f'point:{name}:{lon:g}:{lat:g}', lambda: compute(lon, lat))
+        points[name] = (entry['row'], entry['col'], entry['lat'], entry['lon'])
+    return points
+
+
+def describe_file(index, filename, boxes):
+    """Precompute (and print) index bounds of boxes for a NetCDF or GRIB file"""
+    if filename.endswith('.nc'):
+        from netCDF4 import Dataset
+        with Dataset(filename) as nc:
+            for box in boxes:
+                lat, lon = netcdf_slices(index, nc, box)
+                print(f'{filename} {box}: lat [{lat.start}, {lat.stop}) lon [{lon.start}, {lon.stop})')
+    else:
+        import pygrib
+        grbs = pygrib.open(filename)
+        try:
+            grb = grbs.message(1)
+            for box in boxes:
+                rows, cols, _, _ = grib_window(index, grb, box)
+                print(f'{filename} {box}: rows [{rows.start}, {rows.stop}) columns [{cols.start}, {cols.stop})')
+            for name, (row, col, lat, lon) in sorted(grib_points(index, grb, STATIONS).items()):
+                print(f'{filename} {name}: row {row} column {col} ({lat:.4f}, {lon:.4f})')
+        finally:
+            grbs.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Precompute/show cached bounding box index bounds for MUR SST (NetCDF) and NAM/HREF (GRIB) files')
+    parser.add_argument('file', nargs='+', help='NetCDF (.nc) or GRIB file(s)')
+    parser.add_argument('-b', '--box', action='append', choices=sorted(BOXES), help='Bounding box(es) (default: all)')
+    parser.add_argument('-i', '--index', default=DEFAULT_INDEX, help=f'Grid index file (default: {DEFAULT_INDEX})')
+    args = parser.parse_args()
+    index = GridIndex(args.index)
+    failed = False
+    for fn in args.file:
+        try:
+            describe_file(index, fn, args.box or sorted(BOXES))
+        except (OSError, KeyError, ValueError, RuntimeError) as err:
+            print(f'?error when trying to index file "{fn}": {err}', file=sys.stderr)
+            failed = True
+    index.save()
+    if failed:
+        sys.exit(1)
@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+
+"""
+Point time series of HREF probabilistic visibility at one or more
+stations, replacing `wgrib2 -csv` on the CSV_LON_LAT box plus
+csv_combine.pl in vis-generate.sh (csv mode).
+
+Each HREF file is read once: only the visibility probability messages are
+decoded and every station's value is pulled out of the decoded grid by
+its nearest grid point (row, column), calculated once per grid and kept
+in the grid index (see grid_index.py), so more stations cost next to
+nothing.  Output is one CSV table, a row per (model cycle, forecast hour,
+station) and a column per probability threshold:
+
+    model_cycle_time,prediction_time,model_cycle,forecast_hour,lat,lon,surface.VIS.prob_<1600.prob_fcst,...,station
+
+i.e. csv_combine.pl's columns, in the same positions, plus station as the
+last column (after the thresholds).  Threshold names are
+wgrib2 -set_ext_name style w/o the varying ensemble member count (e.g.
+_0/8) and missing values are empty.
+
+Stations default to grid_index.STATIONS (KRAS), --stations reads a CSV
+file w/ name, latitude, longitude columns.
+
+E.g., href_points.py $FOGHAT_ARCHIVE_DIR/nomads-href/20200101/href.t??z.conus.prob.f??.20200101.grib2 >href-vis-20200101.csv
+
+Requires pygrib <https://github.com/jswhit/pygrib>, like maps_grib.py.
+"""
+
+import argparse
+import csv
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+import grid_index
+import maps_derived
+from maps_grib import grib_time, level_description
+
+try:
+    import pygrib
+except ImportError:
+    pygrib = None
+
+COLUMNS = ('model_cycle_time', 'prediction_time', 'model_cycle', 'forecast_hour', 'lat', 'lon')
+# After the probability threshold columns, so csv_combine.pl's columns
+# keep their positions
+LAST_COLUMNS = ('station',)
+
+# Visibility, (discipline, parameter category, parameter number)
+VIS = (0, 19, 0)
+
+# Probability product definition templates (4.5, 4.9)
+PROBABILITY_TEMPLATES = (5, 9)
+
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+def read_stations(filename):
+    """{name: (longitude, latitude)} from a CSV file w/ name, latitude
+       and longitude columns
+    """
+    stations = {}
+    with open(filename, newline='') as f:
+        for row in csv.DictReader(f):
+            stations[row['name']] = (float(row['longitude']), float(row['latitude']))
+    if not stations:
+        raise ValueError(f'no stations in "{filename}"')
+    return stations
+
+
+def limit(grb, which):
+    """Lower/Upper probability limit of a message"""
+    return grb[f'scaledValueOf{which}Limit'] / 10 ** grb[f'scaleFactorOf{which}Limit']
+
+
+def field_name(grb):
+    """wgrib2 -set_ext_name style name (w/o ensemble count) of a
+       visibility probability message, e.g. surface.VIS.prob_<1600.prob_fcst,
+       None for any other message
+    """
+    key = (grb['discipline'], grb['parameterCategory'], grb['parameterNumber'])
+    if key != VIS or grb['productDefinitionTemplateNumber'] not in PROBABILITY_TEMPLATES:
+        return None
+    # Probability type as per wgrib2's prob inventory
+    kind = grb['probabilityType']
+    if kind in (0, 4):
+        prob = f'<{limit(grb, "Lower" if kind == 0 else "Upper"):g}'
+    elif kind in (1, 3):
+        prob = f'>{limit(grb, "Upper" if kind == 1 else "Lower"):g}'
+    elif kind == 2:
+        prob = f'>={limit(grb, "Lower"):g}_<{limit(grb, "Upper"):g}'
+    else:
+        prob = f'type_{kind}'
+    return f'{level_description(grb)}.VIS.prob_{prob}.prob_fcst'
+
+
+# Station grid points, loaded from/saved to the grid index file
+_index = None
+
+
+def point_indices(grb, stations):
+    global _index
+    if _index is None:
+        _index = grid_index.GridIndex()
+    points = grid_index.grib_points(_index, grb, stations)
+    if _index.dirty:
+        try:
+            _index.save()
+        except OSError as err:
+            print(f'?unable to save grid index "{_index.filename}": {err}', file=sys.stderr)
+    return points
+
+
+def read_points(messages, stations):
+    """Station values of the visibility probability messages.  Returns
+       {(analysis time, valid time, station): {column: value}}
+    """
+    rows = {}
+    for grb in messages:
+        name = field_name(grb)
+        if name is None:
+            continue
+        points = point_indices(grb, stations)
+        # Decoded once, whatever the number of stations
+        values = grb.values
+        data, mask = np.ma.getdata(values), np.ma.getmaskarray(values)
+        analysis = grib_time(grb['dataDate'], grb['dataTime'])
+        valid = grib_time(grb['validityDate'], grb['validityTime'])
+        for station, (row, col, lat, lon) in points.items():
+            values_row = rows.setdefault((analysis, valid, station), {
+                'model_cycle_time': time.strftime(TIME_FORMAT, time.gmtime(analysis)),
+                'prediction_time': time.strftime(TIME_FORMAT, time.gmtime(valid)),
+                'model_cycle': f'{analysis % 86400 // 3600:02d}',
+                'forecast_hour': f'{(valid - analysis) // 3600:02d}',
+                'lat': f'{lat:g}', 'lon': f'{lon:g}', 'station': station})
+            values_row[name] = '' if mask[row, col] else f'{data[row, col]:g}'
+    return rows
+
+
+def extract_file(filename, stations):
+    """Station rows of a HREF GRIB file, or (filename, error message)"""
+    try:
+        grbs = pygrib.open(filename)
+    except (OSError, RuntimeError) as err:
+        return filename, str(err)
+    try:
+        return filename, read_points(grbs, stations)
+    except Exception as err:
+        # Any error fails just this file, not the extract
+        return filename, f'{type(err).__name__}: {err}'
+    finally:
+        grbs.close()
+
+
+def _result(future, filename):
+    """Result of an extract_file() future, an error if the worker process died"""
+    try:
+        return future.result()
+    except Exception as err:
+        return filename, f'{type(err).__name__}: {err}'
+
+
+def extract(filenames, stations, output, jobs=1):
+    """Write the stations' time series from filenames as a CSV table to
+       output (file object).  Returns list of files that failed
+    """
+    start_t = time.perf_counter()
+    if jobs > 1 and len(filenames) > 1:
+        executor = ProcessPoolExecutor(max_workers=min(jobs, len(filenames)))
+        futures = {executor.submit(extract_file, fn, stations): fn for fn in filenames}
+        results = (_result(f, futures[f]) for f in as_completed(futures))
+    else:
+        executor = None
+        results = (extract_file(fn, stations) for fn in filenames)
+
+    rows = {}
+    failed = []
+    for fn, found in results:
+        if isinstance(found, str):
+            print(f'?error when trying to read file "{fn}": {found}', file=sys.stderr)
+            failed.append(fn)
+            continue
+        for key, values in found.items():
+            rows.setdefault(key, {}).update(values)
+    if executor:
+        executor.shutdown()
+
+    fields = sorted({k for values in rows.values() for k in values} - set(COLUMNS + LAST_COLUMNS))
+    writer = csv.DictWriter(output, COLUMNS + tuple(fields) + LAST_COLUMNS, restval='')
+    writer.writeheader()
+    for key in sorted(rows):
+        writer.writerow(rows[key])
+    delta_t = time.perf_counter() - start_t
+    print(f'?{len(rows)} row(s), {len(stations)} station(s) from {len(filenames) - len(failed)} of {len(filenames)} '
+          f'file(s) in {delta_t:.3f} seconds ({jobs} job(s))', file=sys.stderr)
+    return failed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Station time series of HREF probabilistic visibility (CSV)')
+    parser.add_argument('file', nargs='+', help='HREF GRIB file(s) (href.tCCz.conus.prob.fHH*.grib2)')
+    parser.add_argument('-s', '--stations', help='CSV file w/ name, latitude, longitude columns (default: KRAS)')
+    parser.add_argument('-o', '--output', help='CSV file to write (default: stdout)')
+    parser.add_argument('-j', '--jobs', type=int, default=maps_derived.default_jobs(), help='Number of worker processes (default: $SLURM_CPUS_PER_TASK or 1)')
+    args = parser.parse_args()
+    if pygrib is None:
+        print('?pygrib module is required, try: pip install pygrib', file=sys.stderr)
+        sys.exit(1)
+    try:
+        stations = read_stations(args.stations) if args.stations else grid_index.STATIONS
+    except (OSError, KeyError, ValueError) as err:
+        print(f'?error when trying to read stations: {err}', file=sys.stderr)
+        sys.exit(1)
+    output = open(args.output, 'w', newline='') if args.output else sys.stdout
+    try:
+        failed = extract(args.file, stations, output, max(1, args.jobs))
+    finally:
+        if args.output:
+            output.close()
+    if failed:
+        sys.exit(1)
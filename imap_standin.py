@@ -0,0 +1,346 @@
+#!/usr/bin/env python3
+
+"""
+Local stand-in for the IMAP server ncei_email.py checks for NCEI order
+emails: no TLS, any user/password, and just the commands ncei_email.py
+(IMAPClient) sends, UID SEARCH (UID, FROM, SUBJECT, ALL), UID FETCH
+(ENVELOPE, RFC822), UID MOVE and friends.
+
+`check` runs `ncei_email.py check` against a stand-in w/ made up order
+emails: the first (full search) check, incremental ones from the saved
+UIDNEXT (incl. an order that couldn't be queued the first time) and a
+UIDVALIDITY reset (full search again, known orders not queued twice).
+Orders are queued in a temporary jobq database.  Needs ncei_email.py's
+requirements (IMAPClient, envparse).  Exits non-zero if any check fails.
+
+Runs on gridftp too (Python v3.4), hence stdlib only and no f-strings.
+
+E.g., imap_standin.py serve -p 1143
+      FOGHAT_IMAP_HOST=localhost FOGHAT_IMAP_PORT=1143 FOGHAT_IMAP_SSL=false ./ncei_email.py check --dry-run
+      imap_standin.py check
+"""
+
+import argparse
+import email.utils
+import os
+import re
+import socketserver
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+
+NOAA_FROM = 'noreply@noaa.gov'
+
+
+def quote(text):
+    return '"{}"'.format(text.replace('\\', '\\\\').replace('"', '\\"')) if text is not None else 'NIL'
+
+
+def order_email(order_id, sender=NOAA_FROM, date=None):
+    """RFC 822 message like NCEI's order complete emails"""
+    return ('From: {}\r\nTo: foghat@example.com\r\nSubject: AIRS Order {} Complete\r\nDate: {}\r\n'
+            'Message-ID: <{}@example.com>\r\nContent-Type: text/html\r\n\r\n'
+            '<div id="items"><table><tr><td>Web Download</td>'
+            '<td><a href="https://www.ncei.noaa.gov/pub/has/model/{}/">{}</a></td></tr></table></div>\r\n'
+            ).format(sender, order_id, date or email.utils.formatdate(usegmt=True), order_id, order_id, order_id).encode('ascii')
+
+
+class Folder:
+
+    def __init__(self, uidvalidity=1):
+        self.uidvalidity = uidvalidity
+        self.uidnext = 1
+        self.messages = []              # [(UID, RFC 822 bytes)]
+
+    def append(self, data):
+        self.messages.append((self.uidnext, data))
+        self.uidnext += 1
+        return self.uidnext - 1
+
+    def renumber(self):
+        """New UIDVALIDITY, UIDs from 1 (e.g. after the mailbox was rebuilt)"""
+        self.uidvalidity += 1
+        self.uidnext = 1
+        messages, self.messages = self.messages, []
+        for uid, data in messages:
+            self.append(data)
+
+    def uids(self, uid_set):
+        """UIDs in an IMAP UID set, e.g. 1,4:7,9:*"""
+        if not self.messages:
+            return []
+        last = self.messages[-1][0]
+        uids = set()
+        for part in uid_set.split(','):
+            first, _, end = part.partition(':')
+            first = last if first == '*' else int(first)
+            end = first if not end else last if end == '*' else int(end)
+            # n:* includes the last message even if n > its UID
+            uids.update(uid for uid, data in self.messages if min(first, end) <= uid <= max(first, end))
+        return sorted(uids)
+
+
+def tokenize(text):
+    """IMAP command arguments, quoted strings unquoted, parentheses dropped"""
+    return [q.replace('\\"', '"').replace('\\\\', '\\') if q or not w else w
+            for q, w in re.findall(r'"((?:[^"\\]|\\.)*)"|([^\s()"]+)', text)]
+
+
+def envelope(data):
+    message = email.message_from_bytes(data)
+
+    def addresses(name):
+        values = message.get_all(name)
+        if not values:
+            return 'NIL'
+        return '({})'.format(''.join('({} NIL {} {})'.format(quote(display or None), quote(address.partition('@')[0]),
+                                                             quote(address.partition('@')[2]))
+                                     for display, address in email.utils.getaddresses(values)))
+
+    return '({} {} {} {} {} {} {} {} {} {})'.format(
+        quote(message.get('Date')), quote(message.get('Subject')), addresses('From'), addresses('From'),
+        addresses('From'), addresses('To'), addresses('Cc'), addresses('Bcc'), quote(message.get('In-Reply-To')),
+        quote(message.get('Message-ID')))
+
+
+class Handler(socketserver.StreamRequestHandler):
+
+    def send(self, line):
+        self.wfile.write(line if isinstance(line, bytes) else (line + '\r\n').encode('ascii'))
+
+    def handle(self):
+        self.folder = None
+        self.send('* OK [CAPABILITY IMAP4rev1 MOVE UIDPLUS] foghat IMAP stand-in ready')
+        for line in self.rfile:
+            line = line.decode('ascii', 'replace').rstrip('\r\n')
+            tag, _, rest = line.partition(' ')
+            command, _, args = rest.partition(' ')
+            command = command.upper()
+            if command == 'UID':
+                command, _, args = args.partition(' ')
+                command = 'UID ' + command.upper()
+            with self.server.lock:
+                self.server.commands.append('{} {}'.format(command, args).strip())
+                try:
+                    status = self.dispatch(command, tokenize(args))
+                except (KeyError, IndexError, ValueError) as err:
+                    status = 'BAD {}'.format(err)
+            self.send('{} {}'.format(tag, status))
+            self.wfile.flush()
+            if command == 'LOGOUT':
+                break
+
+    def dispatch(self, command, args):
+        folders = self.server.folders
+        if command == 'CAPABILITY':
+            self.send('* CAPABILITY IMAP4rev1 MOVE UIDPLUS')
+        elif command in ('LOGIN', 'NOOP', 'CLOSE'):
+            pass
+        elif command == 'LOGOUT':
+            self.send('* BYE logging out')
+        elif command in ('SELECT', 'EXAMINE'):
+            if args[0] not in folders:
+                return 'NO no such folder'
+            self.folder = folders[args[0]]
+            self.send('* FLAGS (\\Answered \\Flagged \\Deleted \\Seen \\Draft)')
+            self.send('* {} EXISTS'.format(len(self.folder.messages)))
+            self.send('* 0 RECENT')
+            self.send('* OK [UIDVALIDITY {}] UIDs valid'.format(self.folder.uidvalidity))
+            self.send('* OK [UIDNEXT {}] predicted next UID'.format(self.folder.uidnext))
+            return 'OK [READ-WRITE] {} completed'.format(command)
+        elif command == 'UID SEARCH':
+            self.send(' '.join(['* SEARCH'] + [str(uid) for uid in self.search(args)]))
+        elif command == 'UID FETCH':
+            seqs = {uid: seq for seq, (uid, data) in enumerate(self.folder.messages, 1)}
+            messages = dict(self.folder.messages)
+            items = [a.upper() for a in args[1:]]
+            for uid in self.folder.uids(args[0]):
+                parts = ['UID {}'.format(uid)]
+                if 'ENVELOPE' in items:
+                    parts.append('ENVELOPE ' + envelope(messages[uid]))
+                if 'RFC822' in items:
+                    parts.append('RFC822 {{{}}}'.format(len(messages[uid])))
+                self.send(('* {} FETCH ({}'.format(seqs[uid], ' '.join(parts))).encode('ascii') +
+                          (b'\r\n' + messages[uid] if 'RFC822' in items else b'') + b')\r\n')
+        elif command in ('UID MOVE', 'UID COPY'):
+            if args[1] not in folders:
+                return 'NO [TRYCREATE] no such folder'
+            uids = self.folder.uids(args[0])
+            for uid, data in self.folder.messages:
+                if uid in uids:
+                    folders[args[1]].append(data)
+            if command == 'UID MOVE':
+                # Highest sequence number first, so the others don't change
+                for seq in reversed([seq for seq, (uid, data) in enumerate(self.folder.messages, 1) if uid in uids]):
+                    del self.folder.messages[seq - 1]
+                    self.send('* {} EXPUNGE'.format(seq))
+        else:
+            return 'BAD unknown command {}'.format(command)
+        return 'OK {} completed'.format(command)
+
+    def search(self, args):
+        messages = dict(self.folder.messages)
+        uids = set(messages)
+        args = list(args)
+        while args:
+            key = args.pop(0).upper()
+            if key == 'ALL':
+                continue
+            elif key == 'UID':
+                uids &= set(self.folder.uids(args.pop(0)))
+            elif key in ('FROM', 'SUBJECT'):
+                value = args.pop(0).lower()
+                uids = set(uid for uid in uids
+                           if value in (email.message_from_bytes(messages[uid]).get(key) or '').lower())
+            else:
+                raise ValueError('unsupported search key {}'.format(key))
+        return sorted(uids)
+
+
+class Server(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, port=0, folders=('INBOX', 'Queued', 'Processed')):
+        super().__init__(('127.0.0.1', port), Handler)
+        self.lock = threading.Lock()
+        self.folders = dict((name, Folder()) for name in folders)
+        # Every command (w/o tag) received, for check
+        self.commands = []
+
+
+def check(verbose=False):
+    """ncei_email.py check vs. a stand-in server.  Returns the number of
+       failures
+    """
+    failures = []
+
+    def expect(ok, what):
+        print('{} {}'.format('ok    ' if ok else 'FAILED', what), file=sys.stderr)
+        if not ok:
+            failures.append(what)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        server = Server()
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        inbox = server.folders['INBOX']
+        inbox.uidvalidity = 7
+        orders_db = os.path.join(tmp, 'orders.sqlite')
+        jobq_db = os.path.join(tmp, 'jobq.sqlite')
+        env = dict(os.environ, FOGHAT_IMAP_HOST='127.0.0.1', FOGHAT_IMAP_PORT=str(server.server_address[1]),
+                   FOGHAT_IMAP_SSL='false', FOGHAT_IMAP_USER='foghat', FOGHAT_IMAP_PASSWD='x', FOGHAT_LOG_DIR=tmp,
+                   FOGHAT_LOGGER2FILE='false', FOGHAT_ORDERS_DB=orders_db, FOGHAT_JOBQ_DB=jobq_db)
+
+        def ncei_check(jobq=jobq_db):
+            del server.commands[:]
+            proc = subprocess.Popen([sys.executable, './ncei_email.py', 'check'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                    env=dict(env, FOGHAT_JOBQ_DB=jobq), stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            output = proc.communicate()[0].decode('utf-8', 'replace')
+            if verbose or proc.returncode:
+                print(output, file=sys.stderr)
+            return proc.returncode
+
+        def query(filename, sql):
+            if not os.path.exists(filename):
+                return []
+            db = sqlite3.connect(filename)
+            try:
+                return db.execute(sql).fetchall()
+            finally:
+                db.close()
+
+        def sync_state():
+            return query(orders_db, "SELECT uidvalidity, uidnext FROM mailbox WHERE folder = 'INBOX'")
+
+        def queued():
+            return [label for label, in query(jobq_db, 'SELECT label FROM jobs ORDER BY id')]
+
+        def searches():
+            return [c for c in server.commands if c.startswith('UID SEARCH')]
+
+        def bodies():
+            return [c for c in server.commands if c.startswith('UID FETCH') and 'RFC822' in c.upper()]
+
+        def subjects(folder):
+            return [email.message_from_bytes(data)['Subject'] for uid, data in server.folders[folder].messages]
+
+        # First check, no sync state: full search
+        inbox.append(order_email('A1'))
+        inbox.append(order_email('B2'))
+        inbox.append(order_email('SPAM', 'someone@example.com'))
+        expect(ncei_check() == 0, 'first check exits w/ 0')
+        expect(queued() == ['order:A1', 'order:B2'], 'orders A1 and B2 queued: {}'.format(queued()))
+        expect(searches() and 'UID' not in searches()[0][len('UID SEARCH'):], 'full search w/o sync state: {}'.format(searches()))
+        expect(subjects('Queued') == ['AIRS Order A1 Complete', 'AIRS Order B2 Complete'], 'queued emails moved to Queued')
+        expect(sync_state() == [(7, 4)], 'UIDVALIDITY and UIDNEXT saved: {}'.format(sync_state()))
+
+        # Nothing new: incremental search from UIDNEXT, no bodies fetched
+        expect(ncei_check() == 0, 'check w/o new email exits w/ 0')
+        expect(searches() and re.search(r'\bUID "?4:\*', searches()[0]), 'incremental search from UIDNEXT 4: {}'.format(searches()))
+        expect(not bodies() and queued() == ['order:A1', 'order:B2'], 'nothing fetched or queued again')
+
+        # New order that can't be enqueued (jobq database isn't one) and a 2nd email for A1
+        inbox.append(order_email('C3'))
+        inbox.append(order_email('A1'))
+        ncei_check(jobq=tmp)
+        expect(searches() and re.search(r'\bUID "?4:\*', searches()[0]), 'incremental search from UIDNEXT 4: {}'.format(searches()))
+        expect(len(bodies()) == 1 and bodies()[0].split()[2] == '4', 'only the new order email fetched: {}'.format(bodies()))
+        expect(query(orders_db, "SELECT state FROM orders WHERE order_id = 'C3'") == [('found',)],
+               'order C3 left found when jobq.py add fails')
+        expect(subjects('INBOX') == ['AIRS Order SPAM Complete', 'AIRS Order C3 Complete'],
+               'duplicate A1 email moved, C3 left in INBOX: {}'.format(subjects('INBOX')))
+        expect(sync_state() == [(7, 6)], 'UIDNEXT saved after enqueueing: {}'.format(sync_state()))
+
+        # C3 is queued next time, w/o searching old messages again
+        expect(ncei_check() == 0, 'check after failed enqueue exits w/ 0')
+        expect(searches() and re.search(r'\bUID "?6:\*', searches()[0]) and not bodies(),
+               'incremental search from UIDNEXT 6: {}'.format(searches()))
+        expect(queued() == ['order:A1', 'order:B2', 'order:C3'], 'order C3 queued on the next check: {}'.format(queued()))
+        expect(subjects('INBOX') == ['AIRS Order SPAM Complete'], 'C3 email moved to Queued')
+
+        # UIDVALIDITY reset: full search again, known orders not queued twice
+        inbox.append(order_email('B2'))
+        inbox.append(order_email('D4'))
+        inbox.renumber()
+        expect(ncei_check() == 0, 'check after UIDVALIDITY reset exits w/ 0')
+        expect(searches() and 'UID' not in searches()[0][len('UID SEARCH'):],
+               'full search after UIDVALIDITY reset: {}'.format(searches()))
+        expect(len(bodies()) == 1 and bodies()[0].split()[2] == '3', 'only the new order email fetched: {}'.format(bodies()))
+        expect(queued() == ['order:A1', 'order:B2', 'order:C3', 'order:D4'], 'only order D4 queued: {}'.format(queued()))
+        expect(subjects('INBOX') == ['AIRS Order SPAM Complete'], 'B2 and D4 emails moved to Queued')
+        expect(sync_state() == [(8, 4)], 'new UIDVALIDITY and UIDNEXT saved: {}'.format(sync_state()))
+
+        server.shutdown()
+        server.server_close()
+    print('?{} check(s) failed'.format(len(failures)) if failures else '?all checks passed', file=sys.stderr)
+    return len(failures)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Local IMAP stand-in server to test ncei_email.py against')
+    parser.add_argument('-v', '--verbose', action='store_true', help='Show commands received and ncei_email.py output')
+    subparsers = parser.add_subparsers(dest='command')
+    serve_parser = subparsers.add_parser('serve', help='Serve an INBOX w/ made up order emails')
+    serve_parser.add_argument('-p', '--port', type=int, default=1143, help='Port (default: 1143)')
+    serve_parser.add_argument('order', nargs='*', default=['12345'], help='Order ID(s) of emails in INBOX (default: 12345)')
+    subparsers.add_parser('check', help='Check ncei_email.py: full, incremental (UIDNEXT) and UIDVALIDITY reset checks')
+    args = parser.parse_args()
+
+    if args.command == 'serve':
+        server = Server(args.port)
+        for order_id in args.order:
+            server.folders['INBOX'].append(order_email(order_id))
+        print('?serving {} email(s) at 127.0.0.1:{}'.format(len(args.order), args.port), file=sys.stderr)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        if args.verbose:
+            print('\n'.join(server.commands), file=sys.stderr)
+    elif args.command == 'check':
+        sys.exit(1 if check(args.verbose) else 0)
+    else:
+        parser.print_help()
+        sys.exit(2)
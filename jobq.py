@@ -0,0 +1,371 @@
+#!/usr/bin/env python3
+
+"""
+Persistent job queue for archive downloads and processing, replacing
+Task Spooler (ts/ts).  Jobs (commands) are kept in a SQLite database
+($FOGHAT_BASE/var/jobq.sqlite by default) w/ their state:
+
+    queued → running → done
+                     → queued again (retry after a backoff) → ... → failed
+
+`jobq.py run` (e.g. from cron) runs queued jobs, highest priority first,
+w/ up to $FOGHAT_JOBQ_SLOTS (default 2) at once, until there's nothing
+left to run.  Only one scheduler runs at a time (lock file), jobs left
+running by a scheduler that died are requeued once their process (its
+PID is recorded) is gone.  A failed job is retried up to --retries
+times, waiting backoff × 2^(attempt - 1) seconds in between.  A job
+can wait for another one (--after ID) and can have a chain: when it's
+done, the chain adds follow-up jobs, e.g. nam-order queues
+maps_input.sh processing of the days an NCEI order downloaded.
+
+Each job's stdout/stderr go to $FOGHAT_LOG_DIR/jobq/job-ID.log.  Jobs
+inherit the scheduler's environment (unlike ts, not the one they were
+added in) and run in the directory they were added from.
+
+Runs on gridftp too (Python v3.4), hence no f-strings.
+
+E.g., jobq.py add --label order:12345 --chain nam-order ./nam-archive-dl.sh 42 12345 https://...
+      jobq.py run
+      jobq.py list; jobq.py stats
+"""
+
+import argparse
+import calendar
+import fcntl
+import json
+import os
+import re
+import shlex
+import sqlite3
+import subprocess
+import sys
+import time
+
+DEFAULT_DB = os.environ.get('FOGHAT_JOBQ_DB', os.path.join(os.environ.get('FOGHAT_BASE', '.'), 'var', 'jobq.sqlite'))
+LOG_DIR = os.path.join(os.environ.get('FOGHAT_LOG_DIR', '.'), 'jobq')
+POLL_SECONDS = 5
+
+SCHEMA = """
+    CREATE TABLE IF NOT EXISTS jobs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        command TEXT NOT NULL,
+        cwd TEXT NOT NULL,
+        label TEXT,
+        chain TEXT,
+        priority INTEGER NOT NULL DEFAULT 0,
+        after INTEGER,
+        state TEXT NOT NULL,
+        attempts INTEGER NOT NULL DEFAULT 0,
+        max_attempts INTEGER NOT NULL,
+        backoff REAL NOT NULL,
+        next_run REAL NOT NULL,
+        pid INTEGER,
+        returncode INTEGER,
+        created REAL NOT NULL,
+        started REAL,
+        finished REAL,
+        log TEXT
+    );
+    CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, priority, id);
+"""
+
+
+class JobQueue:
+
+    def __init__(self, filename=DEFAULT_DB):
+        os.makedirs(os.path.dirname(os.path.abspath(filename)), exist_ok=True)
+        self.filename = filename
+        self.db = sqlite3.connect(filename, timeout=60)
+        self.db.row_factory = sqlite3.Row
+        self.db.executescript(SCHEMA)
+
+    def add(self, command, label=None, chain=None, priority=0, after=None, retries=3, backoff=300, cwd=None):
+        """Queue command (list), returns job ID"""
+        if chain is not None and chain not in CHAINS:
+            raise ValueError('unknown chain "{}", one of: {}'.format(chain, ', '.join(sorted(CHAINS))))
+        now = time.time()
+        cur = self.db.execute(
+            'INSERT INTO jobs (command, cwd, label, chain, priority, after, state, max_attempts, backoff, next_run, created) '
+            "VALUES (?, ?, ?, ?, ?, ?, 'queued', ?, ?, ?, ?)",
+            (json.dumps(command), cwd or os.getcwd(), label, chain, priority, after, retries + 1, backoff, now, now))
+        self.db.commit()
+        return cur.lastrowid
+
+    def get(self, job_id):
+        return self.db.execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+
+    def jobs(self, state=None):
+        if state is None:
+            return self.db.execute('SELECT * FROM jobs ORDER BY id').fetchall()
+        return self.db.execute('SELECT * FROM jobs WHERE state = ? ORDER BY id', (state,)).fetchall()
+
+    def update(self, job_id, **values):
+        columns = sorted(values)
+        self.db.execute('UPDATE jobs SET {} WHERE id = ?'.format(', '.join('{} = ?'.format(c) for c in columns)),
+                        [values[c] for c in columns] + [job_id])
+        self.db.commit()
+
+    def runnable(self, now):
+        """Queued jobs that are due and whose --after job is done, in order"""
+        return self.db.execute(
+            "SELECT j.* FROM jobs j LEFT JOIN jobs a ON j.after = a.id "
+            "WHERE j.state = 'queued' AND j.next_run <= ? AND (j.after IS NULL OR a.state = 'done') "
+            "ORDER BY j.priority DESC, j.id", (now,)).fetchall()
+
+    def fail_orphans(self):
+        """Fail queued jobs waiting on a job that failed (or was cancelled)"""
+        orphans = self.db.execute(
+            "SELECT j.id, j.after FROM jobs j JOIN jobs a ON j.after = a.id "
+            "WHERE j.state = 'queued' AND a.state IN ('failed', 'cancelled')").fetchall()
+        for job in orphans:
+            log('job #{} failed: job #{} it was waiting on failed'.format(job['id'], job['after']))
+            self.update(job['id'], state='failed', finished=time.time())
+
+    def next_due(self):
+        """Earliest next_run of queued jobs, None if there aren't any"""
+        row = self.db.execute("SELECT MIN(next_run) AS t FROM jobs WHERE state = 'queued'").fetchone()
+        return row['t']
+
+
+def log(msg):
+    print('#{} jobq[{}] {}'.format(time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()), os.getpid(), msg), file=sys.stderr, flush=True)
+
+
+# Chains: name → function(queue, finished job) queueing follow-up jobs
+
+def date_ranges(dates):
+    """Sorted YYYYMMDD strings → [(first, last)] runs of consecutive days"""
+    ranges = []
+    for ymd in sorted(set(dates)):
+        t = calendar.timegm(time.strptime(ymd, '%Y%m%d'))
+        if ranges and t - ranges[-1][2] == 86400:
+            ranges[-1][1:] = [ymd, t]
+        else:
+            ranges.append([ymd, ymd, t])
+    return [(first, last) for first, last, t in ranges]
+
+
+def nam_order_chain(queue, job):
+    """Queue maps_input.sh processing (resume mode) of the days and model
+       cycles in the NAM-NMM files of an NCEI order, from the file list
+       nam-archive-dl.sh saves ($FOGHAT_BASE/var/file_list_ORDER.txt).
+       Processing command is $FOGHAT_JOBQ_PROCESS (default maps_input.sh,
+       e.g. "sbatch --wait hpc_maps.sbatch" to run it on the HPC)
+    """
+    order_id = json.loads(job['command'])[2]
+    file_list = os.path.join(os.environ.get('FOGHAT_BASE', '.'), 'var', 'file_list_{}.txt'.format(order_id))
+    if not os.path.exists(file_list):
+        log('job #{} chain nam-order: no file list {}, nothing to process'.format(job['id'], file_list))
+        return
+    cycles = {}
+    with open(file_list) as f:
+        for line in f:
+            m = re.match(r'nam_218_(\d{8})(\d{2})\.g2\.tar$', line.strip())
+            if m:
+                cycles.setdefault(int(m.group(2)), []).append(m.group(1))
+    process = shlex.split(os.environ.get('FOGHAT_JOBQ_PROCESS', os.path.join(os.environ.get('FOGHAT_EXE_DIR', '.'), 'maps_input.sh')))
+    for cycle, dates in sorted(cycles.items()):
+        for first, last in date_ranges(dates):
+            # MUR SST is cropped by the model cycle 0 job only, like queue-hpc-1year.sh
+            options = ['-r', '-c', str(cycle)] + (['-n'] if cycle else [])
+            command = process + options + ['{}-{}-{}'.format(d[:4], d[4:6], d[6:]) for d in (first, last)]
+            new_id = queue.add(command, label='maps:{}:{}-{}'.format(cycle, first, last), after=job['id'], cwd=job['cwd'])
+            log('job #{} queued job #{}: {}'.format(job['id'], new_id, ' '.join(command)))
+
+
+CHAINS = {
+    'nam-order': nam_order_chain,
+}
+
+
+def alive(pid):
+    """True if process pid exists"""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def start(queue, job):
+    """Start job, returns its Popen object"""
+    os.makedirs(LOG_DIR, exist_ok=True)
+    log_fn = os.path.join(LOG_DIR, 'job-{}.log'.format(job['id']))
+    command = json.loads(job['command'])
+    now = time.time()
+    with open(log_fn, 'a') as f:
+        f.write('# job #{} attempt {} of {} started {}: {}\n'.format(
+            job['id'], job['attempts'] + 1, job['max_attempts'], time.ctime(now), ' '.join(command)))
+        f.flush()
+        proc = subprocess.Popen(command, cwd=job['cwd'], stdin=subprocess.DEVNULL, stdout=f, stderr=subprocess.STDOUT)
+    queue.update(job['id'], state='running', pid=proc.pid, started=now, finished=None, log=log_fn,
+                 attempts=job['attempts'] + 1)
+    log('job #{} started (pid {}): {}'.format(job['id'], proc.pid, ' '.join(command)))
+    return proc
+
+
+def finish(queue, job_id, returncode):
+    """Record a job's exit, retry it (w/ backoff) or run its chain"""
+    job = queue.get(job_id)
+    now = time.time()
+    if returncode == 0:
+        queue.update(job_id, state='done', returncode=0, pid=None, finished=now)
+        log('job #{} done in {:.0f} seconds'.format(job_id, now - job['started']))
+        if job['chain']:
+            try:
+                CHAINS[job['chain']](queue, job)
+            except (OSError, KeyError, IndexError, ValueError) as err:
+                log('job #{} chain {} failed: {}'.format(job_id, job['chain'], err))
+    elif job['attempts'] < job['max_attempts']:
+        delay = job['backoff'] * 2 ** (job['attempts'] - 1)
+        queue.update(job_id, state='queued', returncode=returncode, pid=None, finished=now, next_run=now + delay)
+        log('job #{} exited w/ {}, retry {} of {} in {:.0f} seconds'.format(
+            job_id, returncode, job['attempts'], job['max_attempts'] - 1, delay))
+    else:
+        queue.update(job_id, state='failed', returncode=returncode, pid=None, finished=now)
+        log('job #{} failed (exit status {}) after {} attempt(s), see {}'.format(job_id, returncode, job['attempts'], job['log']))
+
+
+def run(queue, slots=2, wait=600):
+    """Run queued jobs until there's nothing left to do (retries due more
+       than wait seconds from now are left for the next run)
+    """
+    lock = open(queue.filename + '.lock', 'w')
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        log('another scheduler is running, quitting')
+        return
+    running = {}                        # job ID → Popen
+    # Only one scheduler, so anything "running" was left by one that died.
+    # Its process may still be going, wait for it (exit status unknown)
+    adopted = {}                        # job ID → pid
+    for job in queue.jobs('running'):
+        if job['pid'] and alive(job['pid']):
+            log('job #{} was left running and still is (pid {}), waiting for it'.format(job['id'], job['pid']))
+            adopted[job['id']] = job['pid']
+        else:
+            log('job #{} was left running (pid {} is gone), requeueing it'.format(job['id'], job['pid']))
+            finish(queue, job['id'], -1)
+
+    while True:
+        for job_id, proc in list(running.items()):
+            if proc.poll() is not None:
+                del running[job_id]
+                finish(queue, job_id, proc.returncode)
+        for job_id, pid in list(adopted.items()):
+            if not alive(pid):
+                del adopted[job_id]
+                log('job #{} (pid {}) left running by another scheduler is gone, exit status unknown'.format(job_id, pid))
+                finish(queue, job_id, -1)
+        queue.fail_orphans()
+        now = time.time()
+        for job in queue.runnable(now)[:max(0, slots - len(running) - len(adopted))]:
+            try:
+                running[job['id']] = start(queue, job)
+            except OSError as err:
+                queue.update(job['id'], attempts=job['attempts'] + 1, started=now)
+                log('job #{} could not be started: {}'.format(job['id'], err))
+                finish(queue, job['id'], 127)
+        if not running and not adopted:
+            due = queue.next_due()
+            if due is None or due > now + wait:
+                break
+            # Only retries (or jobs waiting on them) left
+            if not queue.runnable(due):
+                break
+            time.sleep(max(POLL_SECONDS, due - now))
+            continue
+        time.sleep(POLL_SECONDS)
+    lock.close()
+
+
+def show(queue, state=None):
+    print('{:>6} {:<9} {:>3} {:>8} {:<20} {}'.format('id', 'state', 'try', 'seconds', 'label', 'command'))
+    for job in queue.jobs(state):
+        elapsed = (job['finished'] or time.time()) - job['started'] if job['started'] else 0
+        print('{:>6} {:<9} {:>3} {:>8.0f} {:<20} {}'.format(job['id'], job['state'], job['attempts'], elapsed,
+                                                          job['label'] or '-', ' '.join(json.loads(job['command']))))
+
+
+def stats(queue, hours=24):
+    """Per kind of job (command name) state counts, run times and
+       throughput over the last hours
+    """
+    since = time.time() - hours * 3600
+    kinds = {}
+    for job in queue.jobs():
+        kind = os.path.basename(json.loads(job['command'])[0])
+        k = kinds.setdefault(kind, {'states': {}, 'times': [], 'recent': 0})
+        k['states'][job['state']] = k['states'].get(job['state'], 0) + 1
+        if job['state'] == 'done':
+            k['times'].append(job['finished'] - job['started'])
+            if job['finished'] >= since:
+                k['recent'] += 1
+    print('{:<20} {:>6} {:>7} {:>6} {:>6} {:>9} {:>9} {:>8}'.format(
+        'kind', 'queued', 'running', 'done', 'failed', 'mean s', 'max s', 'per hour'))
+    for kind, k in sorted(kinds.items()):
+        times = k['times']
+        print('{:<20} {:>6} {:>7} {:>6} {:>6} {:>9.0f} {:>9.0f} {:>8.2f}'.format(
+            kind, k['states'].get('queued', 0), k['states'].get('running', 0), k['states'].get('done', 0),
+            k['states'].get('failed', 0), sum(times) / len(times) if times else 0, max(times) if times else 0,
+            k['recent'] / hours))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Persistent job queue w/ retries and chaining (replaces Task Spooler)')
+    parser.add_argument('--db', default=DEFAULT_DB, help='Job database (default: {})'.format(DEFAULT_DB))
+    subparsers = parser.add_subparsers(dest='action')
+    p = subparsers.add_parser('add', help='Queue a command, prints its job ID')
+    p.add_argument('-l', '--label', help='Label, e.g. order:12345')
+    p.add_argument('-c', '--chain', choices=sorted(CHAINS), help='Queue follow-up jobs when this one is done')
+    p.add_argument('-p', '--priority', type=int, default=0, help='Higher runs first (default: 0)')
+    p.add_argument('-a', '--after', type=int, help="Don't run until job ID is done")
+    p.add_argument('-r', '--retries', type=int, default=3, help='Retries if it fails (default: 3)')
+    p.add_argument('-b', '--backoff', type=float, default=300, help='Seconds before first retry, doubled each time (default: 300)')
+    p.add_argument('command', nargs=argparse.REMAINDER, help='Command and its arguments')
+    p = subparsers.add_parser('run', help='Run queued jobs until there are none left')
+    p.add_argument('-j', '--slots', type=int, default=int(os.environ.get('FOGHAT_JOBQ_SLOTS', 2)), help='Jobs to run at once (default: $FOGHAT_JOBQ_SLOTS or 2)')
+    p.add_argument('-w', '--wait', type=float, default=600, help='Wait for retries due w/in this many seconds (default: 600)')
+    p = subparsers.add_parser('list', help='List jobs')
+    p.add_argument('-s', '--state', help='Only jobs in this state (queued, running, done, failed, cancelled)')
+    p = subparsers.add_parser('stats', help='Per kind of job counts, run times and throughput')
+    p.add_argument('--hours', type=float, default=24, help='Throughput over the last HOURS (default: 24)')
+    p = subparsers.add_parser('retry', help='Queue failed (or cancelled) job(s) again')
+    p.add_argument('id', type=int, nargs='+')
+    p = subparsers.add_parser('cancel', help="Cancel queued job(s)")
+    p.add_argument('id', type=int, nargs='+')
+    args = parser.parse_args()
+
+    queue = JobQueue(args.db)
+    if args.action == 'add':
+        command = args.command[1:] if args.command[:1] == ['--'] else args.command
+        if not command:
+            parser.error('no command to add')
+        try:
+            print(queue.add(command, args.label, args.chain, args.priority, args.after, args.retries, args.backoff))
+        except ValueError as err:
+            print('?{}'.format(err), file=sys.stderr)
+            sys.exit(1)
+    elif args.action == 'run':
+        run(queue, max(1, args.slots), args.wait)
+    elif args.action == 'list':
+        show(queue, args.state)
+    elif args.action == 'stats':
+        stats(queue, args.hours)
+    elif args.action in ('retry', 'cancel'):
+        for job_id in args.id:
+            job = queue.get(job_id)
+            if job is None:
+                print('?no job #{}'.format(job_id), file=sys.stderr)
+            elif args.action == 'retry' and job['state'] in ('failed', 'cancelled'):
+                queue.update(job_id, state='queued', attempts=0, next_run=time.time())
+            elif args.action == 'cancel' and job['state'] == 'queued':
+                queue.update(job_id, state='cancelled', finished=time.time())
+            else:
+                print('?job #{} is {}, not changed'.format(job_id, job['state']), file=sys.stderr)
+    else:
+        parser.print_help()
+        sys.exit(2)
@@ -0,0 +1,368 @@
+#!/usr/bin/env python3
+
+"""
+Benchmarks of the derived variable and QA paths on synthetic NAM-like
+fixtures, so performance changes can be measured (and compared across
+commits) w/o production data.
+
+Fixtures look like maps_input.sh's wgrib2 -netcdf output
+(maps_YYYYMMDD_CC00_0HH_wip.nc): time, latitude/longitude and every
+predictor in maps_grib.ORDER (TMP/RH/UGRD/VGRD/VVEL/TKE at 975-700 mb,
+2 m/10 m above ground and surface fields, MSLET_meansealevel) on a
+SIZE x SIZE grid (square, the derived variables are (time, x, y)), w/
+plausible random values and a --fill fraction of fill values.
+
+Benchmarks, each run in a fresh worker process (so peak RSS is its own):
+
+    derived       maps_derived.process_file() (in place, on fresh copies)
+    write         maps_derived.write_file() (fresh *_input.nc files)
+    humidity      specific humidity/DeltaQ/DeltaZ fields (in memory)
+    lclt          LCL_T field (in memory)
+    dateval       DateVal field (in memory)
+    find_outlier  find_outlier.process_file() (on derived files)
+
+Reported per benchmark: median (and min) seconds per file over --repeat
+rounds, files/s, MB/s of input, peak numpy/python allocations
+(tracemalloc, in an extra untimed round) and peak RSS.  Results are saved as JSON, w/ the git
+commit, to compare w/ `maps_bench.py compare OLD.json NEW.json`.
+
+E.g., maps_bench.py run -s 32 -s 128 -n 37
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+
+from netCDF4 import Dataset
+import netCDF4
+import numpy as np
+
+import find_outlier
+import maps_derived
+from maps_grib import FILL_VALUE, ORDER, PARAMETERS
+
+BENCHMARKS = ('derived', 'write', 'humidity', 'lclt', 'dateval', 'find_outlier')
+
+OUTPUT_DIR = os.path.join(os.environ['FOGHAT_BASE'], 'var', 'bench') if 'FOGHAT_BASE' in os.environ else 'bench'
+
+# Units and descriptions by wgrib2 name, e.g. TMP → ('Temperature', 'K')
+DESCRIPTIONS = {name: (description, units) for name, description, units in PARAMETERS.values()}
+
+# Value ranges of the fixtures' fields by wgrib2 name
+RANGES = {
+    'TMP': (270, 305),                  # K
+    'DPT': (265, 300),                  # K
+    'RH': (20, 100),                    # %
+    'UGRD': (-20, 20),                  # m/s
+    'VGRD': (-20, 20),                  # m/s
+    'VVEL': (-2, 2),                    # Pa/s
+    'TKE': (0, 5),                      # J/kg
+    'FRICV': (0, 1),                    # m/s
+    'VIS': (0, 24000),                  # m
+    'MSLET': (99000, 103000),           # Pa
+}
+
+# 2020-01-01 00Z, model cycle time of the fixtures
+CYCLE_T = 1577836800
+
+
+def level(name):
+    """wgrib2 -netcdf level of a variable name, TMP_975mb → 975 mb"""
+    suffix = name.split('_', 1)[1]
+    if suffix.endswith('mb'):
+        return f'{suffix[:-2]} mb'
+    return {'2maboveground': '2 m above ground', '10maboveground': '10 m above ground',
+            'surface': 'surface', 'meansealevel': 'mean sea level'}[suffix]
+
+
+def write_fixture(filename, size, hour, fill=0.0, seed=0):
+    """Write a synthetic forecast hour wgrib2 -netcdf file w/ a size x
+       size grid
+    """
+    rng = np.random.default_rng(seed + hour) if hasattr(np.random, 'default_rng') else np.random.RandomState(seed + hour)
+    nc = Dataset(filename, 'w', format='NETCDF3_CLASSIC')
+    try:
+        nc.Conventions = 'COARDS'
+        nc.History = f'created by {os.path.basename(sys.argv[0])} (synthetic benchmark fixture)'
+        nc.GRIB2_grid_template = 30
+        nc.createDimension('time', None)
+        nc.createDimension('y', size)
+        nc.createDimension('x', size)
+        t = nc.createVariable('time', 'd', ('time',))
+        t.setncatts({'units': 'seconds since 1970-01-01 00:00:00.0 0:00', 'reference_time': float(CYCLE_T)})
+        lat = nc.createVariable('latitude', 'd', ('y', 'x'))
+        lat.setncatts({'units': 'degrees_north', 'long_name': 'latitude'})
+        lon = nc.createVariable('longitude', 'd', ('y', 'x'))
+        lon.setncatts({'units': 'degrees_east', 'long_name': 'longitude'})
+        for name in ORDER:
+            description, units = DESCRIPTIONS[name.split('_')[0]]
+            var = nc.createVariable(name, 'f', ('time', 'y', 'x'), fill_value=FILL_VALUE)
+            var.setncatts({'short_name': name, 'long_name': description, 'level': level(name), 'units': units})
+
+        t[:] = [CYCLE_T + hour * 3600]
+        lats, lons = np.meshgrid(np.linspace(25.4, 28.85, size), np.linspace(-98.01, -94.20, size), indexing='ij')
+        lat[:] = lats
+        lon[:] = lons
+        for name in ORDER:
+            low, high = RANGES[name.split('_')[0]]
+            values = rng.uniform(low, high, (1, size, size)).astype(np.float32)
+            if fill:
+                values[rng.uniform(size=values.shape) < fill] = FILL_VALUE
+            nc.variables[name][:] = values
+    finally:
+        nc.close()
+
+
+def make_fixtures(directory, size, count, fill=0.0, seed=0):
+    """count forecast hour fixture files (size x size) in directory"""
+    os.makedirs(directory, exist_ok=True)
+    filenames = []
+    for hour in range(count):
+        fn = os.path.join(directory, f'maps_20200101_0000_{hour:03d}_wip.nc')
+        write_fixture(fn, size, hour, fill, seed)
+        filenames.append(fn)
+    return filenames
+
+
+def fresh_copies(filenames, directory, suffix='_wip.nc'):
+    """Copy filenames into (emptied) directory, renamed *suffix"""
+    shutil.rmtree(directory, ignore_errors=True)
+    os.makedirs(directory)
+    copies = []
+    for fn in filenames:
+        copy = os.path.join(directory, os.path.basename(fn).replace('_wip.nc', suffix))
+        shutil.copyfile(fn, copy)
+        copies.append(copy)
+    return copies
+
+
+def in_memory(field):
+    """Benchmark function computing a derived field from an open fixture"""
+    def run(filename):
+        nc = Dataset(filename, 'r')
+        try:
+            if field == 'humidity':
+                # Kernel buffers are reused, consume one field at a time
+                for _ in maps_derived.humidity_fields(nc.variables, filename):
+                    pass
+            elif field == 'lclt':
+                maps_derived.lclt_field(nc.variables)
+            else:
+                maps_derived.dateval_field(nc.variables)
+        finally:
+            nc.close()
+        return True
+    return run
+
+
+def quiet_find_outlier(filename):
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        find_outlier.process_file(filename)
+    return True
+
+
+def derived(filename):
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stderr(devnull):
+        return maps_derived.process_file(filename)
+
+
+def write(filename, output):
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stderr(devnull):
+        return maps_derived.write_file(filename, output)
+
+
+def run_benchmark(name, fixtures, repeat, workdir):
+    """Time benchmark name on fixtures, repeat rounds.  Runs in a worker
+       process.  Returns result dict
+    """
+    if name == 'derived':
+        func, suffix = derived, '_wip.nc'
+    elif name == 'write':
+        os.makedirs(workdir, exist_ok=True)
+        func, suffix = lambda fn: write(fn, os.path.join(workdir, 'maps_write_input.nc')), None
+    elif name == 'find_outlier':
+        func, suffix = quiet_find_outlier, '_input.nc'
+        # find_outlier reads what maps_derived.py wrote
+        fixtures = fresh_copies(fixtures, os.path.join(workdir, 'derived'), suffix)
+        for fn in fixtures:
+            derived(fn)
+    else:
+        func, suffix = in_memory(name), None
+
+    def round_of(files, timed=True):
+        for fn in files:
+            start_t = time.perf_counter()
+            if not func(fn):
+                raise RuntimeError(f'{name} failed on {fn}')
+            if timed:
+                times.append(time.perf_counter() - start_t)
+
+    def files():
+        # Copying isn't timed, derived modifies files in place
+        return fresh_copies(fixtures, os.path.join(workdir, name), suffix) if name == 'derived' else fixtures
+
+    times = []
+    for _ in range(repeat):
+        round_of(files())
+    # tracemalloc slows down python code a lot, so peak allocations come
+    # from an extra, untimed round
+    tracemalloc.start()
+    round_of(files(), timed=False)
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        'files': len(fixtures),
+        'repeat': repeat,
+        'median': float(np.median(times)),
+        'min': min(times),
+        'total': sum(times),
+        'peak_alloc_mb': peak / 2**20,
+        'max_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+
+def git_commit():
+    """(commit hash, True if the working tree has changes), None if not
+       in a git repository
+    """
+    here = os.path.dirname(os.path.abspath(__file__))
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=here, check=True, stdout=subprocess.PIPE,
+                                stderr=subprocess.DEVNULL, universal_newlines=True).stdout.strip()
+        status = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=here, check=True,
+                                stdout=subprocess.PIPE, universal_newlines=True).stdout
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+    return commit, bool(status.strip())
+
+
+def run(sizes, count, repeat, benchmarks=BENCHMARKS, fill=0.0, workdir=None):
+    """Run benchmarks on fixtures of every grid size.  Returns results
+       dict (see save())
+    """
+    commit, dirty = git_commit()
+    results = {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'commit': commit, 'dirty': dirty,
+        'host': platform.node(), 'python': platform.python_version(),
+        'numpy': np.__version__, 'netCDF4': netCDF4.__version__,
+        'files': count, 'repeat': repeat, 'fill': fill,
+        'benchmarks': [],
+    }
+    tmp = tempfile.mkdtemp(prefix='maps_bench-', dir=workdir)
+    try:
+        for size in sizes:
+            fixtures = make_fixtures(os.path.join(tmp, f'fixtures-{size}'), size, count, fill)
+            mb = sum(os.path.getsize(fn) for fn in fixtures) / 2**20
+            for name in benchmarks:
+                # Fresh process per benchmark, so peak RSS is its own
+                with ProcessPoolExecutor(max_workers=1) as executor:
+                    result = executor.submit(run_benchmark, name, fixtures, repeat, os.path.join(tmp, f'work-{size}')).result()
+                per_file = result['median']
+                result.update(name=name, size=size, input_mb=mb,
+                              files_per_s=1 / per_file if per_file else float('inf'),
+                              mb_per_s=mb / count / per_file if per_file else float('inf'))
+                results['benchmarks'].append(result)
+                print(f'?{name} {size}x{size}: {per_file * 1000:.2f} ms/file', file=sys.stderr)
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+    return results
+
+
+def show(results, out=sys.stdout):
+    commit = (results['commit'] or 'unknown')[:10] + ('+' if results['dirty'] else '')
+    print(f'# {results["created"]} commit {commit} on {results["host"]}, python {results["python"]}, '
+          f'numpy {results["numpy"]}, netCDF4 {results["netCDF4"]}, {results["files"]} file(s) x {results["repeat"]}', file=out)
+    print(f'{"benchmark":<13} {"grid":>9} {"ms/file":>9} {"min ms":>9} {"files/s":>9} {"MB/s":>8} '
+          f'{"alloc MB":>9} {"rss MB":>8}', file=out)
+    for b in results['benchmarks']:
+        print(f'{b["name"]:<13} {b["size"]:>4}x{b["size"]:<4} {b["median"] * 1000:>9.2f} {b["min"] * 1000:>9.2f} '
+              f'{b["files_per_s"]:>9.1f} {b["mb_per_s"]:>8.1f} {b["peak_alloc_mb"]:>9.1f} {b["max_rss_mb"]:>8.1f}', file=out)
+
+
+def save(results, output_dir=OUTPUT_DIR):
+    """Write results to output_dir/maps_bench-YYYYmmddTHHMMSS-COMMIT.json"""
+    os.makedirs(output_dir, exist_ok=True)
+    commit = (results['commit'] or 'unknown')[:10] + ('-dirty' if results['dirty'] else '')
+    stamp = results['created'].replace('-', '').replace(':', '').rstrip('Z')
+    filename = os.path.join(output_dir, f'maps_bench-{stamp}-{commit}.json')
+    tmp = f'{filename}.tmp{os.getpid()}'
+    with open(tmp, 'w') as f:
+        json.dump(results, f, indent=1)
+    os.replace(tmp, filename)
+    return filename
+
+
+def compare(old, new, out=sys.stdout):
+    """Per (benchmark, grid size) median time and peak memory of new vs
+       old results
+    """
+    def key(b):
+        return b['name'], b['size']
+
+    before = {key(b): b for b in old['benchmarks']}
+    print(f'# {(old["commit"] or "unknown")[:10]} → {(new["commit"] or "unknown")[:10]}'
+          + ('+' if new['dirty'] else ''), file=out)
+    print(f'{"benchmark":<13} {"grid":>9} {"old ms":>9} {"new ms":>9} {"speedup":>8} '
+          f'{"old alloc":>9} {"new alloc":>9}', file=out)
+    for b in new['benchmarks']:
+        a = before.get(key(b))
+        if a is None:
+            continue
+        speedup = a['median'] / b['median'] if b['median'] else float('inf')
+        print(f'{b["name"]:<13} {b["size"]:>4}x{b["size"]:<4} {a["median"] * 1000:>9.2f} {b["median"] * 1000:>9.2f} '
+              f'{speedup:>7.2f}x {a["peak_alloc_mb"]:>9.1f} {b["peak_alloc_mb"]:>9.1f}', file=out)
+
+
+def read_results(filename):
+    with open(filename) as f:
+        return json.load(f)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark derived variable and QA paths on synthetic fixtures')
+    subparsers = parser.add_subparsers(dest='command')
+    p = subparsers.add_parser('run', help='Run benchmarks, save and show results')
+    p.add_argument('-s', '--size', type=int, action='append', help='Grid size (SIZE x SIZE), repeat for more (default: 32, 128)')
+    p.add_argument('-n', '--files', type=int, default=37, help='Forecast hour files per grid size (default: 37)')
+    p.add_argument('-r', '--repeat', type=int, default=3, help='Rounds per benchmark (default: 3)')
+    p.add_argument('-b', '--benchmark', action='append', choices=BENCHMARKS, help='Benchmark(s) to run (default: all)')
+    p.add_argument('--fill', type=float, default=0.01, help='Fraction of fill values in fixtures (default: 0.01)')
+    p.add_argument('-o', '--output-dir', default=OUTPUT_DIR, help=f'Where to save results (default: {OUTPUT_DIR})')
+    p.add_argument('--tmpdir', help='Where to write fixtures (default: $TMPDIR)')
+    p = subparsers.add_parser('show', help='Show saved results')
+    p.add_argument('file', nargs='+', help='maps_bench-*.json file(s)')
+    p = subparsers.add_parser('compare', help='Compare saved results')
+    p.add_argument('old', help='maps_bench-*.json file, e.g. before a change')
+    p.add_argument('new', help='maps_bench-*.json file, e.g. after a change')
+    args = parser.parse_args()
+
+    try:
+        if args.command == 'run':
+            if args.files < 1 or args.repeat < 1:
+                parser.error('need at least one file and one round')
+            results = run(args.size or [32, 128], args.files, args.repeat, args.benchmark or BENCHMARKS,
+                          args.fill, args.tmpdir)
+            show(results)
+            print(f'?results saved to {save(results, args.output_dir)}', file=sys.stderr)
+        elif args.command == 'show':
+            for fn in args.file:
+                show(read_results(fn))
+        elif args.command == 'compare':
+            compare(read_results(args.old), read_results(args.new))
+        else:
+            parser.print_help()
+            sys.exit(2)
+    except (OSError, ValueError, KeyError, RuntimeError) as err:
+        print(f'?{args.command} failed: {err}', file=sys.stderr)
+        sys.exit(1)
@@ -1,133 +1,322 @@
 #!/usr/bin/env python3
 
 import argparse
+import glob
 import time
 import math
 import sys
 import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from netCDF4 import Dataset
 import numpy as np
 
-def specific_humidity(nc):
-    """Given a NetCDF dataset, calculate mixing ratio for all desired
-       pressure levels and save as new variables in the supplied dataset
+import metrics
+
+# Pressure levels (in millibars) we calculate specific humidity at,
+# ordered from the surface up
+LEVELS = range(975, 700-1, -25)
+
+# Not written to output files (--write), as per Waylon (what ncks -x -v
+# MSLET_meansealevel did, see maps_grib.DROP)
+DROP = ('MSLET_meansealevel',)
+
+
+def _work_dtype(dtype):
+    """Floating point type numpy.ma arithmetic w/ Python scalars promotes
+       dtype to: float32 stays float32 w/ NumPy's legacy (value-based)
+       casting, but becomes float64 w/ NumPy 2's promotion rules (NEP 50)
+    """
+    return np.result_type(np.empty(0, dtype), np.array(1.0))
+
+
+def _read_levels(variables, prefix, out, mask):
+    """Read prefix_{level}mb for all LEVELS into out, a single stacked
+       (level, time, x, y) array, OR'ing their NetCDF masks into mask
+    """
+    for i, pres in enumerate(LEVELS):
+        values = variables[f'{prefix}_{pres}mb'][:]
+        out[i] = np.ma.getdata(values)
+        mask[i] |= np.ma.getmaskarray(values)
+
+
+def _read_surface(variables, name, out, mask):
+    """Read (time, x, y) variable name into out, OR'ing its mask into mask"""
+    values = variables[name][:]
+    out[...] = np.ma.getdata(values)
+    mask |= np.ma.getmaskarray(values)
+
+
+def _invalid(values, mask):
+    """Flag non-finite results (e.g. division by zero) in mask, like
+       numpy.ma division does
     """
-    scratch = {}                        # temporary Numpy arrays/layers used for calculations
-    # Loop over each desired pressure level (in millibars)
-    for pres in range(975, 700-1, -25):
-        level = f'{pres}mb'             # label for NetCDF variable reference
-        # For stauration vapor pressure (es), calculate
-        #     temperature in C°
-        temp_c = nc.variables[f'TMP_{level}'][:] - 273.15
+    mask |= ~np.isfinite(values)
+    return mask
+
+
+def _moisture(temp, read_rh, pres, mask, scratch, es):
+    """Specific humidity (q) and virtual temperature (Tv) from
+       temperature (°K), relative humidity (%) and pressure (mb).
+
+       Works in place: temp is overwritten w/ Tv, mask (input masks,
+       OR'd together) w/ the Tv mask, scratch w/ q, and es (another
+       array the same size as temp) is left free for reuse.
+       read_rh(out, mask) loads relative humidity into scratch once it's
+       available.  Returns (q, q_mask, tv, tv_mask).  Operation order
+       matches the original per level numpy.ma calculations so results
+       are identical
+    """
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        # For saturation vapor pressure (es), calculate temperature in C°
+        temp_c = temp
+        temp_c -= 273.15
         #     π  [exponent]
-        pi = (17.67*temp_c) / (temp_c + 243.5)
+        np.multiply(temp_c, 17.67, out=scratch)
+        np.add(temp_c, 243.5, out=es)
+        np.divide(scratch, es, out=es)
+        _invalid(es, mask)
         # Saturation vapor Pressure (es)
-        es = 6.112*np.exp(pi)           # saturation vapor pressure at level l
+        np.exp(es, out=es)
+        es *= 6.112
         # Vapor Pressure (e)
-        vap_pres = es*( nc.variables[f'RH_{level}'][:] / 100)
+        rh = scratch
+        read_rh(rh, mask)
+        rh /= 100
+        _invalid(rh, mask)
+        vap_pres = es
+        vap_pres *= rh
         # Mixing Ratio (mr)
-        mr = ( (0.622*vap_pres) / (pres-vap_pres) )
+        np.subtract(pres, vap_pres, out=scratch)
+        mr = vap_pres
+        mr *= 0.622
+        mr /= scratch
+        _invalid(mr, mask)
         # Specific Humidity (q)
-        q = mr / (1+mr)
-        scratch[f'Q_{level}'] = q
+        np.add(mr, 1, out=scratch)
+        q = np.divide(mr, scratch, out=scratch)
+        q_mask = _invalid(q, mask.copy())
+        # Virtual temperature (in °K)
+        mr *= 0.61
+        mr += 1
+        temp_c += 237.15
+        tv = np.multiply(mr, temp_c, out=temp_c)
+    return q, q_mask, tv, mask
+
+
+# At most this many bad coordinates are reported per variable (stderr
+# and QA attributes), a bad file could otherwise have thousands
+MAX_REPORTED = 10
+
+
+def _report_zeros(delta_z, dz_mask, label, filepath, describe):
+    """Print count and (the first MAX_REPORTED) coordinates of
+       [unmasked] zeros in delta_z to stderr.  Not an error, DeltaQ /
+       DeltaZ there is non-finite and so masked.  Returns QA attributes
+       for the variable calculated w/ delta_z
+    """
+    zeros = (delta_z == 0.0) & ~dz_mask
+    zero_count = int(np.count_nonzero(zeros))
+    if zero_count == 0:
+        return {'qa_zero_delta_z': 0}
+    print(f'? {zero_count} zero(s) in delta_z array used to calculate {label} in file {filepath}', file=sys.stderr)
+    coordinates = [tuple(int(i) for i in c) for c in zip(*(index[:MAX_REPORTED] for index in np.nonzero(zeros)))]
+    first = f' (first {MAX_REPORTED})' if zero_count > MAX_REPORTED else ''
+    print(f'? Indice(s) of zero(s) in delta_z array{first} are: {coordinates}', file=sys.stderr)
+    for c in coordinates:
+        print(f'    @{c} ⇒ {describe(c)}', file=sys.stderr)
+    return {'qa_zero_delta_z': zero_count, 'qa_zero_delta_z_indices': ' '.join(str(c) for c in coordinates)}
+
+
+def qa_attributes(values):
+    """Summary statistics of a derived variable's values, as NetCDF
+       attributes, so QA doesn't need to read the data back.  qa_nan
+       counts non-finite results (they're masked, i.e. written as fill
+       values), qa_fill all masked values
+    """
+    data = np.ma.getdata(values)
+    mask = np.ma.getmaskarray(values)
+    attributes = {'qa_nan': int(np.count_nonzero(~np.isfinite(data))), 'qa_fill': int(np.count_nonzero(mask))}
+    valid = data[~mask]
+    if valid.size:
+        attributes.update(qa_min=float(valid.min()), qa_max=float(valid.max()), qa_mean=float(valid.mean(dtype=np.float64)))
+    return attributes
+
+
+def humidity_kernel(variables, filepath=''):
+    """Calculate specific humidity (Q) at every pressure level and the
+       surface, plus DeltaQ/DeltaZ between each adjacent pair of levels,
+       from stacked (level, time, x, y) arrays.
+
+       Generates (name, long_name, values, QA attributes) tuples, values
+       being masked arrays, in the order the variables are added to a
+       dataset.
+       Results match the per level numpy.ma calculations bit-for-bit.
+       Memory: two float stacks (temperature, reused for Tv then
+       DeltaQ/DeltaZ, and q) plus their masks, other working storage is
+       a single (time, x, y) level
+    """
+    first = variables[f'TMP_{LEVELS[0]}mb']
+    dtype = _work_dtype(first.dtype)
+    temp = np.empty((len(LEVELS),) + first.shape, dtype=dtype)
+    mask = np.zeros(temp.shape, dtype=bool)
+    _read_levels(variables, 'TMP', temp, mask)
+    q = np.empty_like(temp)
+    q_mask = np.empty_like(mask)
+    # A level at a time, so working storage (es) is one level's worth
+    # rather than another stack
+    es = np.empty(first.shape, dtype=dtype)
+    for i, level in enumerate(LEVELS):
+        _, q_mask[i], _, _ = _moisture(temp[i], lambda out, m: _read_surface(variables, f'RH_{level}mb', out, m),
+                                       dtype.type(level), mask[i], q[i], es)
+    tv, tv_mask = temp, mask
+    for i, level in enumerate(LEVELS):
         # Put specific humidity values in the dataset as per Waylon
-        name = f'Q_{level}'
-        qanon = nc.createVariable(name, 'f', ('time','x','y'))
-        qanon[:] = q
-        qanon.long_name = f'Specific humidity (q) at {level}mb'
-        qanon.short_name = name
+        # (long_name's doubled "mb" kept so existing files' metadata matches)
+        yield f'Q_{level}mb', f'Specific humidity (q) at {level}mbmb', np.ma.masked_array(q[i], q_mask[i]), {}
 
-        # Virtual temperature (in °K)
-        tv = (1 + 0.61*mr)*(temp_c + 237.15)
-        scratch[f'Tv_{level}'] = tv
     # Calculate Specific Humidity (q) for the "surface"
-    temp_c = nc.variables['TMP_2maboveground'][:] - 273.15
-    # π  [exponent]
-    pi = (17.67*temp_c) / (temp_c + 243.5)
-    # Saturation vapor Pressure (es)
-    es = 6.112*np.exp(pi)               # saturation vapor pressure at level l
-    # Vapor Pressure (e)
-    vap_pres = es*( nc.variables['RH_2maboveground'][:] / 100)
-    # Mixing Ratio (mr)
-    pres_mb = nc.variables['MSLET_meansealevel'][:] / 100 # Convert Pascals → mbar
+    sfc_temp = np.empty(first.shape, dtype=dtype)
+    sfc_mask = np.zeros(first.shape, dtype=bool)
+    _read_surface(variables, 'TMP_2maboveground', sfc_temp, sfc_mask)
     # XXX  Note the pressure in this calculation is gridded/an array, _not_ a scalar
-    mr = ( (0.622*vap_pres)/(pres_mb - vap_pres) )
-    # Specific Humidity (q)
-    q = mr / (1+mr)
-    scratch['Q_surface'] = q
-    # Virtual temperature (in °K)
-    tv = (1 + 0.61*mr)*(temp_c + 237.15)
-    scratch['Tv_surface'] = tv
-
+    pres_mb = np.empty(first.shape, dtype=dtype)
+    pres_mask = np.zeros(first.shape, dtype=bool)
+    _read_surface(variables, 'MSLET_meansealevel', pres_mb, pres_mask)
+    pres_mb /= 100                      # Convert Pascals → mbar
+    _invalid(pres_mb, pres_mask)
+    sfc_mask |= pres_mask
+    q_sfc, q_sfc_mask, tv_sfc, tv_sfc_mask = _moisture(sfc_temp, lambda out, m: _read_surface(variables, 'RH_2maboveground', out, m),
+                                                       pres_mb, sfc_mask, np.empty_like(sfc_temp), es)
     # We want Specific Humidity (q) at surface in dataset, I believe
-    qsfc = nc.createVariable('Q_surface', 'f', ('time','x','y'))
-    qsfc[:] = q
-    qsfc.long_name = 'Specific humidity (q) at surface'
-    qsfc.short_name = 'Q_surface'
+    yield 'Q_surface', 'Specific humidity (q) at surface', np.ma.masked_array(q_sfc, q_sfc_mask), {}
 
     # Add DeltaQ/DeltaZ variables to NetCDF dataset/file
 
-    # Average of virtual temperatures
-    tv_avg = (scratch['Tv_975mb'] + scratch['Tv_surface']) / 2
-    # DeltaZ = (Rd*avg(Tv)*ln(P1/P2)) / g
-    # XXX  _If_ pres_mb == 975.0, result of np.log() will be 0 | tv_avg == 0 → delta_z is 0
-    # Waylon: Surface pressure shouldn't reach 975mb except maybe during hurricanes
-    delta_z =  (287.0*tv_avg * np.log(pres_mb/975.0)) / 9.8
-    zero_count = np.sum(delta_z == 0.0)
-    if zero_count > 0:
-        result = np.where(delta_z == 0.0)
-        print(f'? {zero_count} zero(s) in delta_z array used to calculate dqdz975sfc in file {nc.filepath()}', file=sys.stderr)
-        coordinates = list(zip(result[0], result[1], result[2]))
-        print(f'? Indice(s) of zero(s) in delta_z array are: {coordinates}', file=sys.stderr)
-        for c in coordinates:
-            print(f'    @{c} ⇒ tv_avg={tv_avg[c]} , pres_mb={pres_mb[c]}', file=sys.stderr)
-        # TODO  Throw exception ?
-    # DeltaQ / DeltaZ
-    dqdz975sfc = nc.createVariable('DQDZ975SFC', 'f', ('time','x','y'))
-    dqdz975sfc[:] = (scratch['Q_975mb'] - scratch['Q_surface']) / delta_z
-    dqdz975sfc.long_name = f'DeltaQ over DeltaZ between 975mb and surface'
-    dqdz975sfc.short_name = 'DQDZ975SFC'
-
-    for p1 in range(975, 725-1, -25):
-        p2 = p1 - 25                    # lower pressure → higher elevation
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
         # Average of virtual temperatures
-        tv_avg = (scratch[f'Tv_{p1}mb'] + scratch[f'Tv_{p2}mb']) / 2
+        tv_avg = tv[0] + tv_sfc
+        tv_avg /= 2
+        dz_mask = _invalid(tv_avg, tv_mask[0] | tv_sfc_mask)
         # DeltaZ = (Rd*avg(Tv)*ln(P1/P2)) / g
-        # XXX  Where tv_avg == 0 → delta_z is 0 !
-        delta_z = (287.0*tv_avg * np.log(p1/p2)) / 9.8
-        zero_count = np.sum(delta_z == 0.0)
-        if zero_count > 0:
-            print(f'? {zero_count} zero(s) in delta_z array used to calculate dqdz{p2}{p1} in file {nc.filepath()}', file=sys.stderr)
-            result = np.where(delta_z == 0.0)
-            coordinates = list(zip(result[0], result[1], result[2]))
-            print(f'? Indice(s) of zero(s) in delta_z array are: {coordinates}', file=sys.stderr)
-            for c in coordinates:
-                tv1, tv2 = scratch[f'Tv_{p1}mb'][c], scratch[f'Tv_{p2}mb'][c]
-                print(f'    @{c} ⇒ tv_avg={tv_avg[c]}, Tv_{p1}mb={tv1}, Tv_{p2}mb={tv2}', file=sys.stderr)
-            # TODO  Throw exception ?
+        # XXX  _If_ pres_mb == 975.0, result of np.log() will be 0 | tv_avg == 0 → delta_z is 0
+        # Waylon: Surface pressure shouldn't reach 975mb except maybe during hurricanes
+        ratio = pres_mb / 975.0
+        ratio_mask = _invalid(ratio, pres_mask.copy())
+        ratio_mask |= ratio <= 0
+        log_ratio = np.log(ratio, out=ratio)
+        delta_z = tv_avg
+        delta_z *= 287.0
+        delta_z *= log_ratio
+        delta_z /= 9.8
+        dz_mask |= ratio_mask
+        _invalid(delta_z, dz_mask)
+        qa = _report_zeros(delta_z, dz_mask, 'dqdz975sfc', filepath,
+                      lambda c: f'tv_avg={(tv[0][c] + tv_sfc[c])/2} , pres_mb={pres_mb[c]}')
         # DeltaQ / DeltaZ
-        name = f'DQDZ{p2}{p1}'
-        dqdzp2p1 = nc.createVariable(name, 'f', ('time','x','y'))
-        dqdzp2p1[:] = (scratch[f'Q_{p2}mb'] - scratch[f'Q_{p1}mb']) / delta_z
-        dqdzp2p1.long_name = f'DeltaQ over DeltaZ between {p2}mb and {p1}mb'
-        dqdzp2p1.short_name = name
+        dqdz = q[0] - q_sfc
+        dqdz /= delta_z
+        dqdz_mask = _invalid(dqdz, dz_mask | q_mask[0] | q_sfc_mask)
+    yield 'DQDZ975SFC', 'DeltaQ over DeltaZ between 975mb and surface', np.ma.masked_array(dqdz, dqdz_mask), qa
+
+    # Adjacent pairs of levels, p1 → p2 (lower pressure → higher
+    # elevation).  DeltaZ uses es's storage, DeltaQ/DeltaZ overwrites
+    # p1's Tv (and Tv mask), which later pairs don't need
+    levels = np.array(LEVELS, dtype=np.float64)
+    # ln(P1/P2) is a (float64) scalar per pair, cast to working precision
+    log_ratios = np.log(levels[:-1]/levels[1:]).astype(dtype)
+    for i, (p1, p2) in enumerate(zip(LEVELS[:-1], LEVELS[1:])):
+        with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+            # Average of virtual temperatures
+            tv_avg = np.add(tv[i], tv[i+1], out=es)
+            tv_avg /= 2
+            dz_mask = tv_mask[i]
+            dz_mask |= tv_mask[i+1]
+            _invalid(tv_avg, dz_mask)
+            # DeltaZ = (Rd*avg(Tv)*ln(P1/P2)) / g
+            # XXX  Where tv_avg == 0 → delta_z is 0 !
+            delta_z = tv_avg
+            delta_z *= 287.0
+            delta_z *= log_ratios[i]
+            delta_z /= 9.8
+            _invalid(delta_z, dz_mask)
+            qa = _report_zeros(delta_z, dz_mask, f'dqdz{p2}{p1}', filepath,
+                               lambda c: f'tv_avg={(tv[i][c] + tv[i+1][c])/2}, Tv_{p1}mb={tv[i][c]}, Tv_{p2}mb={tv[i+1][c]}')
+            # DeltaQ / DeltaZ
+            dqdz = np.subtract(q[i+1], q[i], out=tv[i])
+            dqdz /= delta_z
+            dqdz_mask = dz_mask
+            dqdz_mask |= q_mask[i]
+            dqdz_mask |= q_mask[i+1]
+            _invalid(dqdz, dqdz_mask)
+        yield f'DQDZ{p2}{p1}', f'DeltaQ over DeltaZ between {p2}mb and {p1}mb', np.ma.masked_array(dqdz, dqdz_mask), qa
+
+def add_variable(nc, name, dimensions, attributes, values):
+    """Create (float) variable name in dataset nc w/ the given attributes
+       and values.  Attributes are set before the data is written so a
+       NetCDF classic file's header is only redefined once per variable
+    """
+    var = nc.createVariable(name, 'f', dimensions)
+    var.setncatts(attributes)
+    var[:] = values
+    return var
+
+
+def humidity_fields(variables, filepath=''):
+    """Generate (name, dimensions, attributes, values) for the specific
+       humidity derived variables (see humidity_kernel())
+    """
+    for name, long_name, values, qa in humidity_kernel(variables, filepath):
+        yield name, ('time','x','y'), {'long_name': long_name, 'short_name': name, **qa}, values
 
 
-def lclt(nc):
+def specific_humidity(nc, variables=None):
+    """Given a NetCDF dataset, calculate mixing ratio for all desired
+       pressure levels and save as new variables in the supplied dataset
+    """
+    for field in humidity_fields(nc.variables if variables is None else variables, nc.filepath()):
+        add_variable(nc, *field)
+
+
+def lclt_field(variables):
+    """Lifted condensation level temperature (LCL_T) [at surface?] as a
+       (name, dimensions, attributes, values) tuple
+    """
+    denominator = 1/(variables['TMP_2maboveground'][:] - 55) - ( np.log(variables['RH_2maboveground'][:]/100) / 2840 )
+    temp = 1/denominator + 55
+    attributes = {
+        'long_name': 'Lifted Condensation Level Temperature',
+        'short_name': 'LCL_T',
+        'units': 'Kelvin',
+    }
+    return 'LCLT', ('time','x','y'), attributes, temp
+
+
+def lclt(nc, variables=None):
     """Given a NetCDF dataset, calculate lifted condensation level
        temperature (LCL_T) [at surface?] and save as new variables in
        the supplied dataset
     """
-    denominator = 1/(nc.variables['TMP_2maboveground'][:] - 55) - ( np.log(nc.variables['RH_2maboveground'][:]/100) / 2840 )
-    temp = 1/denominator + 55
-    lcl_t = nc.createVariable('LCLT', 'f', ('time','x','y'))
-    lcl_t[:] = temp
-    lcl_t.long_name = 'Lifted Condensation Level Temperature'
-    lcl_t.short_name = 'LCL_T'
-    lcl_t.units = 'Kelvin'
+    add_variable(nc, *lclt_field(nc.variables if variables is None else variables))
+
+
+def dateval_field(variables):
+    """DateVal(t) (see dateval()) as a (name, dimensions, attributes,
+       values) tuple
+    """
+    # Model cycle time + Forecast hour time value in seconds since epoch (float)
+    times = variables['time'][:]
+    gmt = times[0]
+    # Julian Day for above ([1,366] → [0,365])
+    doy = time.gmtime(gmt).tm_yday - 1
+    dv_float = (math.sin(math.pi*doy/365))**2
+    attributes = {
+        'long_name': 'Date Value (sine of Julian Day)',
+        'short_name': 'DateVal',
+    }
+    return 'DateVal', ('time',), attributes, np.full(np.shape(times), dv_float)
 
 
-def dateval(nc):
+def dateval(nc, variables=None):
     """Given a NetCDF dataset, calculate the DateVal(t) function for
        the time of day the predictions _represent_ (model cycle time
        + forecast hour) and save as a new variable in the supplied
@@ -135,56 +324,264 @@ def dateval(nc):
 
        This is used to tell the model what time of year it is.
     """
-    # Model cycle time + Forecast hour time value in seconds since epoch (float)
-    gmt = nc.variables['time'][:][0]
-    # Julian Day for above ([1,366] → [0,365])
-    doy = time.gmtime(gmt).tm_yday - 1
-    dv_float = (math.sin(math.pi*doy/365))**2
-    dv = nc.createVariable('DateVal', 'f', ('time'))
-    dv[:] = dv_float
-    dv.long_name = 'Date Value (sine of Julian Day)'
-    dv.short_name = 'DateVal'
+    add_variable(nc, *dateval_field(nc.variables if variables is None else variables))
+
+
+def derived_fields(variables, filepath=''):
+    """Generate (name, dimensions, attributes, values) for every derived
+       variable, in the order they're added to a dataset, from variables
+       (a NetCDF dataset's variables or any mapping of names to arrays).
+       Attributes include QA statistics (see qa_attributes())
+    """
+    def fields():
+        # Specific humidity derived variables
+        yield from humidity_fields(variables, filepath)
+        # Lifted Condensation Level Temperature (LCL_T)
+        yield lclt_field(variables)
+        # DateVal (sine of Julian day)
+        yield dateval_field(variables)
 
+    # Kernel buffers are reused, so one field at a time
+    for name, dimensions, attributes, values in fields():
+        yield name, dimensions, {**attributes, **qa_attributes(values)}, values
+
+
+def add_derived(nc, variables=None):
+    """Add all derived variables to NetCDF dataset nc, calculated from
+       variables (by default, nc's own)
+    """
+    for field in derived_fields(nc.variables if variables is None else variables, nc.filepath()):
+        add_variable(nc, *field)
 
-def add_cli_history(nc):
+
+def add_cli_history(nc, argv=None):
     """Add this command line invocation information to NetCDF file history"""
+    if argv is None:
+        argv = sys.argv
     old_hist = nc.History
-    argv0 = os.path.basename(sys.argv[0])
-    argv_star = ' '.join(sys.argv[1:])
+    argv0 = os.path.basename(argv[0])
+    argv_star = ' '.join(argv[1:])
     when = time.ctime(time.time())
     modified = f'{when}: {argv0} {argv_star}\n{old_hist}'
     nc.History = modified
 
 
 def process_file(filename):
+    """Add derived variables to a single NetCDF file (in place).  Returns
+       True on success, False if the file couldn't be processed
+    """
     try:
         # Opening in append mode means every createVariable() call will
         # add another variable to the file
         nc = Dataset(filename, 'a')
+    except OSError as err:
+        print(f'?error when trying to process file "{filename}": {err.strerror}', file=sys.stderr)
+        return False
 
-        # Add specific humidity derived variables to dataset
-        specific_humidity(nc)
-        # Add Lifted Condensation Level Temperature (LCL_T)s to dataset
-        lclt(nc)
-        # Add DateVal (sine of Julian day) to dataset
-        dateval(nc)
+    try:
+        # Add specific humidity, Lifted Condensation Level Temperature
+        # (LCL_T) and DateVal (sine of Julian day) derived variables to
+        # dataset
+        add_derived(nc)
 
         # XXX  Can't remove "surface" pressure (MSLET) from dataset here
         #      as NetCDF-API doesn't support deletion from a NetCDF
-        #      dataset.  Do w/ CLI tool ncks
-
-        # Add modified message to NetCDF file history
-        add_cli_history(nc)
+        #      dataset.  Do w/ CLI tool ncks (or see write_file())
 
+        # Add modified message to NetCDF file history.  Only name _this_
+        # file (not every file in a batch) so history matches a single
+        # file invocation
+        add_cli_history(nc, [sys.argv[0], filename])
+    except (OSError, KeyError, RuntimeError) as err:
+        print(f'?error when trying to process file "{filename}": {err}', file=sys.stderr)
+        return False
+    finally:
         # Flushing dataset to file should be automatic
         nc.close()
+    return True
+
+
+def output_filename(filename):
+    """maps_20190101_0000_000_wip.nc → maps_20190101_0000_000_input.nc"""
+    base = filename[:-len('_wip.nc')] if filename.endswith('_wip.nc') else os.path.splitext(filename)[0]
+    return f'{base}_input.nc'
+
+
+def _create_variable(nc, name, datatype, dimensions, fill_value=None, complevel=0):
+    """createVariable(), zlib compressed w/ a chunk per time step (the
+       whole grid) if complevel
+    """
+    if not complevel:
+        return nc.createVariable(name, datatype, dimensions, fill_value=fill_value)
+    chunks = None
+    if dimensions[:1] == ('time',):
+        chunks = (1,) + tuple(len(nc.dimensions[d]) for d in dimensions[1:])
+    return nc.createVariable(name, datatype, dimensions, fill_value=fill_value, zlib=True, complevel=complevel,
+                             shuffle=True, chunksizes=chunks)
+
+
+def write_file(filename, output=None, complevel=0):
+    """Read a NetCDF file once and write a fresh output file (default:
+       *_wip.nc → *_input.nc) w/ its variables (except DROP), the derived
+       variables and history appended.  Everything is defined before any
+       data is written, so the file is written once, instead of growing
+       w/ every derived variable (process_file()) and being rewritten by
+       ncks to drop MSLET.  W/ complevel, the output is NetCDF4 (classic
+       model), zlib compressed.  Returns output filename, None on failure
+    """
+    output = output or output_filename(filename)
+    try:
+        nc = Dataset(filename, 'r')
     except OSError as err:
         print(f'?error when trying to process file "{filename}": {err.strerror}', file=sys.stderr)
+        return None
+
+    tmp = f'{output}.tmp{os.getpid()}'
+    try:
+        arrays = {name: var[:] for name, var in nc.variables.items()}
+        derived = list(derived_fields(arrays, filename))
+
+        out = Dataset(tmp, 'w', format='NETCDF4_CLASSIC' if complevel else 'NETCDF3_CLASSIC')
+        try:
+            out.setncatts({k: nc.getncattr(k) for k in nc.ncattrs()})
+            for name, dim in nc.dimensions.items():
+                out.createDimension(name, None if dim.isunlimited() else len(dim))
+            for name, var in nc.variables.items():
+                if name in DROP:
+                    continue
+                fill_value = var.getncattr('_FillValue') if '_FillValue' in var.ncattrs() else None
+                new = _create_variable(out, name, var.datatype, var.dimensions, fill_value, complevel)
+                new.setncatts({k: var.getncattr(k) for k in var.ncattrs() if k != '_FillValue'})
+            for name, dimensions, attributes, _ in derived:
+                new = _create_variable(out, name, 'f', dimensions, None, complevel)
+                new.setncatts(attributes)
+            add_cli_history(out, [sys.argv[0], '--write', filename])
+
+            # Definitions done, now the data
+            for name, values in arrays.items():
+                if name not in DROP:
+                    out.variables[name][:] = values
+            for name, _, _, values in derived:
+                out.variables[name][:] = values
+        finally:
+            out.close()
+        os.replace(tmp, output)
+    except Exception as err:
+        print(f'?error when trying to process file "{filename}": {type(err).__name__}: {err}', file=sys.stderr)
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        return None
+    finally:
+        nc.close()
+    return output
+
+
+def expand_paths(paths, pattern='*_wip.nc'):
+    """Expand list of files, directories (files matching pattern w/in)
+       and glob patterns into a sorted list of unique filenames
+    """
+    filenames = []
+    for path in paths:
+        if os.path.isdir(path):
+            filenames.extend(glob.glob(os.path.join(path, pattern)))
+        elif os.path.exists(path):
+            filenames.append(path)
+        else:
+            # Quoted glob (avoids shell argument list limits)
+            matches = glob.glob(path)
+            if not matches:
+                print(f'?no files match "{path}", skipping', file=sys.stderr)
+            filenames.extend(matches)
+    return sorted(set(filenames))
+
+
+def default_jobs():
+    """Number of worker processes to use by default: the CPUs Slurm
+       allocated to this task, otherwise 1 (serial)
+    """
+    try:
+        return max(1, int(os.environ.get('SLURM_CPUS_PER_TASK', 1)))
+    except ValueError:
+        return 1
+
+
+def _timed_process_file(filename, write=False, complevel=0):
+    """process_file() (or write_file()) wrapper returning (filename,
+       success, elapsed seconds, file written).  Any exception fails just
+       this file, not the batch
+    """
+    file_t = time.perf_counter()
+    with metrics.Stage('derived', filename) as stage:
+        try:
+            if write:
+                written = write_file(filename, complevel=complevel)
+            else:
+                written = filename if process_file(filename) else None
+        except Exception as err:
+            print(f'?error when trying to process file "{filename}": {type(err).__name__}: {err}', file=sys.stderr)
+            written = None
+        stage.status = 0 if written else 1
+    return filename, bool(written), time.perf_counter() - file_t, written
+
+
+def _result(future, filename):
+    """Result of a _timed_process_file() future, a failure if the worker
+       process died
+    """
+    try:
+        return future.result()
+    except Exception as err:
+        print(f'?error when trying to process file "{filename}": {type(err).__name__}: {err}', file=sys.stderr)
+        return filename, False, 0.0, None
+
+
+def process_files(filenames, list_ok=False, jobs=1, write=False, complevel=0):
+    """Process many NetCDF files in this one (long-lived) process, or a
+       pool of jobs worker processes, reporting per-file timings and
+       failures on stderr.  W/ write, *_input.nc files are written (see
+       write_file()) instead of modifying files in place.  Returns list
+       of filenames that failed
+    """
+    start_t = time.perf_counter()
+    if jobs > 1 and len(filenames) > 1:
+        executor = ProcessPoolExecutor(max_workers=min(jobs, len(filenames)))
+        futures = {executor.submit(_timed_process_file, fn, write, complevel): fn for fn in filenames}
+        results = (_result(f, futures[f]) for f in as_completed(futures))
+    else:
+        executor = None
+        results = (_timed_process_file(fn, write, complevel) for fn in filenames)
+
+    failed = []
+    for fn, ok, delta_t, written in results:
+        if ok:
+            print(f'?processed {fn} in {delta_t:.3f} seconds', file=sys.stderr)
+            if list_ok:
+                print(written, flush=True)
+        else:
+            print(f'?failed {fn} after {delta_t:.3f} seconds', file=sys.stderr)
+            failed.append(fn)
+    if executor:
+        executor.shutdown()
+
+    delta_t = time.perf_counter() - start_t
+    print(f'?{len(filenames) - len(failed)} of {len(filenames)} file(s) processed in {delta_t:.3f} seconds ({jobs} job(s))', file=sys.stderr)
+    for fn in sorted(failed):
+        print(f'?failed to process {fn}', file=sys.stderr)
+    return failed
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
-    parser.add_argument('file', help='NetCDF file to modify in place')
+    parser.add_argument('file', nargs='+', help='NetCDF file(s), directories or glob patterns to modify in place (or read w/ --write)')
+    parser.add_argument('--pattern', default='*_wip.nc', help='Filename pattern to match in directory arguments (default: %(default)s)')
+    parser.add_argument('-l', '--list', action='store_true', help='Print names of successfully processed (or written) files on stdout')
+    parser.add_argument('-j', '--jobs', type=int, default=default_jobs(), help='Number of worker processes (default: $SLURM_CPUS_PER_TASK or 1)')
+    parser.add_argument('-w', '--write', action='store_true', help='Write *_input.nc files w/ the derived variables and w/o '
+                        'MSLET_meansealevel instead of modifying files in place (no ncks needed)')
+    parser.add_argument('--complevel', type=int, default=0, choices=range(10), metavar='{0-9}',
+                        help='W/ --write, zlib compression level of NetCDF4 output (default: 0, uncompressed NetCDF3)')
     args = parser.parse_args()
-    if args.file:
-        process_file(args.file)
+    filenames = expand_paths(args.file, args.pattern)
+    failed = process_files(filenames, args.list, max(1, args.jobs), args.write, args.complevel)
+    if failed or not filenames:
+        sys.exit(1)
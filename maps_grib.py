@@ -0,0 +1,436 @@
+#!/usr/bin/env python3
+
+"""
+In-process replacement for the per forecast hour GRIB → NetCDF chain in
+maps_input.sh (wgrib2 -small_grib, grib2_inv_reorder.pl, wgrib2
+-netcdf, maps_derived.py and ncks -x -v MSLET_meansealevel).
+
+Each NAM GRIB file is decoded once, only the messages matching MATCH_RE
+are kept (clipped to the MapS bounding box), they're put in Waylon's
+predictor order and the final maps_*_input.nc file is written once, w/
+the derived variables and w/o MSLET.  Variable names, dimensions and
+attributes mirror what wgrib2 -netcdf produces.
+
+Requires pygrib <https://github.com/jswhit/pygrib> (not needed for the
+wgrib2 pipeline, so it isn't in requirements.txt).
+"""
+
+import argparse
+import calendar
+import os
+import re
+import sys
+import tarfile
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, as_completed, wait
+from queue import Queue
+from netCDF4 import Dataset
+import numpy as np
+
+import grid_index
+import maps_derived
+import metrics
+
+try:
+    import pygrib
+except ImportError:
+    pygrib = None
+
+# Bounding box for Hamid's MapS DL NN (grid_index.BOXES, should match
+# LON_LAT in maps_input.sh)
+BOX = 'maps'
+
+# Build a single regex w/ all the predictors at all the levels we want
+# (should match MATCH_RE in maps_input.sh)
+ATMOSPHERIC = ':(TMP|RH|UGRD|VGRD|TKE|VVEL):(700|725|750|775|800|825|850|875|900|925|950|975) mb:'
+ABOVE_GROUND = ':(TMP|DPT|RH|UGRD|VGRD):(2|10) m above ground:'
+SURFACE = ':(FRICV|VIS|TMP):surface:'
+# Mean sea level (pressure) is only used to calculate derived parameter(s)
+UNIQUE = ':MSLET:'
+MATCH_RE = re.compile(f'({ATMOSPHERIC}|{ABOVE_GROUND}|{SURFACE}|{UNIQUE})')
+
+# Not written to the output file, as per Waylon
+DROP = ('MSLET_meansealevel',)
+
+# wgrib2 names, descriptions and units for the GRIB2 parameters we use,
+# keyed by (discipline, parameter category, parameter number)
+PARAMETERS = {
+    (0, 0, 0): ('TMP', 'Temperature', 'K'),
+    (0, 0, 6): ('DPT', 'Dew Point Temperature', 'K'),
+    (0, 1, 1): ('RH', 'Relative Humidity', '%'),
+    (0, 2, 2): ('UGRD', 'U-Component of Wind', 'm/s'),
+    (0, 2, 3): ('VGRD', 'V-Component of Wind', 'm/s'),
+    (0, 2, 8): ('VVEL', 'Vertical Velocity (Pressure)', 'Pa/s'),
+    (0, 2, 30): ('FRICV', 'Frictional Velocity', 'm/s'),
+    (0, 3, 192): ('MSLET', 'MSLP (Eta model reduction)', 'Pa'),
+    (0, 19, 0): ('VIS', 'Visibility', 'm'),
+    (0, 19, 11): ('TKE', 'Turbulent Kinetic Energy', 'J/kg'),
+}
+
+# wgrib2 -netcdf fill value for undefined grid points
+FILL_VALUE = np.float32(9.999e20)
+
+
+def layers(*names):
+    """Enumerate all atmospheric levels from 975 mb to 700 mb"""
+    return [f'{name}_{pres}mb' for name in names for pres in range(975, 700-1, -25)]
+
+
+# Desired predictor order, see grib2_inv_reorder.pl
+ORDER = (['UGRD_10maboveground'] + layers('UGRD') + ['VGRD_10maboveground'] + layers('VGRD', 'VVEL', 'TKE')
+         + ['TMP_surface', 'TMP_2maboveground'] + layers('TMP', 'RH')
+         + ['DPT_2maboveground', 'FRICV_surface', 'VIS_surface', 'RH_2maboveground', 'MSLET_meansealevel'])
+
+
+# Forecast hours 0-36 members of a (day, model cycle) NAM tarfile
+FORECAST_HOUR_RE = re.compile(r'nam_218_\d{8}_\d{2}00_0([012]\d|3[0-6])\.grb2$')
+
+
+def output_filename(filename, output_dir='.'):
+    """nam_218_20190101_0000_000.grb2 → maps_20190101_0000_000_input.nc"""
+    base = re.sub(r'\.grb2$', '', os.path.basename(filename))
+    base = re.sub(r'^nam_218', 'maps', base)
+    return os.path.join(output_dir, f'{base}_input.nc')
+
+
+def level_description(grb):
+    """wgrib2 style level description of a GRIB message, e.g. 975 mb"""
+    surface = grb['typeOfFirstFixedSurface']
+    if surface == 100:                  # isobaric surface (level in hPa)
+        return f'{grb["level"]:g} mb'
+    if surface == 103:                  # specified height above ground
+        return f'{grb["level"]:g} m above ground'
+    if surface == 1:
+        return 'surface'
+    if surface == 101:
+        return 'mean sea level'
+    return f'level type {surface}'
+
+
+def describe(grb):
+    """(wgrib2 style inventory match string, variable name, long name,
+       level, units) for a GRIB message, e.g. ':TMP:975 mb:'
+    """
+    key = (grb['discipline'], grb['parameterCategory'], grb['parameterNumber'])
+    name, long_name, units = PARAMETERS.get(key, ('var{}_{}_{}'.format(*key), 'desc', 'unit'))
+    level = level_description(grb)
+    # wgrib2 -netcdf variable names strip whitespace from level, e.g. TMP_2maboveground
+    squeezed = re.sub(r'\s+', '', level)
+    return f':{name}:{level}:', f'{name}_{squeezed}', long_name, level, units
+
+
+def grib_time(date, hhmm):
+    """GRIB date (YYYYMMDD) and time (HHMM) → seconds since epoch"""
+    t = time.strptime(f'{int(date):08d}{int(hhmm):04d}', '%Y%m%d%H%M')
+    return calendar.timegm(t)
+
+
+# Clip index bounds for each grid, loaded from/saved to the grid index file
+_index = None
+
+
+def clip_indices(grb, box=BOX):
+    """Return (row slice, column slice, latitudes, longitudes) of the
+       smallest part of the message's grid containing every grid point
+       w/in the box (like wgrib2 -small_grib).  Latitude and longitude
+       are the clipped coordinate arrays.  Calculated once per grid
+       definition and kept in the grid index file
+    """
+    global _index
+    if _index is None:
+        _index = grid_index.GridIndex()
+    window = grid_index.grib_window(_index, grb, box)
+    if _index.dirty:
+        try:
+            _index.save()
+        except OSError as err:
+            print(f'?unable to save grid index "{_index.filename}": {err}', file=sys.stderr)
+    return window
+
+
+def read_messages(messages, box=BOX):
+    """Decode and clip matching GRIB messages.  Returns (variables,
+       grid) where variables maps wgrib2 -netcdf names to (long name,
+       level, units, clipped values) in the desired predictor order
+       and grid is (latitudes, longitudes, analysis time, valid time)
+    """
+    found = {}
+    grid = None
+    for grb in messages:
+        match, name, long_name, level, units = describe(grb)
+        if not MATCH_RE.search(match):
+            continue
+        rows, cols, lats, lons = clip_indices(grb, box)
+        values = grb.values
+        data = np.ma.getdata(values)[rows, cols].astype(np.float32)
+        mask = np.ma.getmaskarray(values)[rows, cols]
+        # wgrib2 writes grids south → north, flip if stored north → south
+        if lats[0, 0] > lats[-1, 0]:
+            data, mask, lats, lons = data[::-1], mask[::-1], lats[::-1], lons[::-1]
+        found[name] = (long_name, level, units, np.ma.masked_array(data, mask))
+        if grid is None:
+            grid = (lats, lons, grib_time(grb['dataDate'], grb['dataTime']), grib_time(grb['validityDate'], grb['validityTime']))
+
+    # Reorder grib2 variables [predictors] as noted in Waylon's document
+    if len(found) != len(ORDER) or set(found) != set(ORDER):
+        raise ValueError(f'inventory count mismatch between input ({len(found)}) and output ({len(ORDER)})')
+    return {name: found[name] for name in ORDER}, grid
+
+
+def write_netcdf(filename, variables, grid, history):
+    """Write the final MapS input NetCDF file: time, latitude and
+       longitude, every GRIB variable except DROP and the derived
+       variables.  Everything is defined before any data is written, to
+       a temporary file renamed to filename once complete (-r resumes)
+    """
+    lats, lons, ref_time, valid_time = grid
+    ny, nx = lats.shape
+    # Masked arrays (w/ a time axis) for maps_derived
+    arrays = {name: values[np.newaxis] for name, (_, _, _, values) in variables.items()}
+    arrays['time'] = np.array([valid_time], dtype=np.float64)
+    derived = list(maps_derived.derived_fields(arrays, filename))
+
+    tmp = f'{filename}.tmp{os.getpid()}'
+    try:
+        nc = Dataset(tmp, 'w', format='NETCDF3_CLASSIC')
+        try:
+            nc.Conventions = 'COARDS'
+            nc.History = history
+            nc.GRIB2_grid_template = 30
+            nc.createDimension('time', None)
+            nc.createDimension('y', ny)
+            nc.createDimension('x', nx)
+
+            t = nc.createVariable('time', 'd', ('time',))
+            ref_date = time.strftime('%Y.%m.%d %H:%M:%S UTC', time.gmtime(ref_time))
+            t.setncatts({
+                'units': 'seconds since 1970-01-01 00:00:00.0 0:00',
+                'long_name': 'verification time generated by wgrib2 function verftime()',
+                'reference_time': float(ref_time),
+                'reference_time_type': 0,
+                'reference_date': ref_date,
+                'reference_time_description': 'kind of product unclear, reference date is variable, min found reference date is given',
+                'time_step_setting': 'auto',
+                'time_step': 0.0,
+            })
+            lat = nc.createVariable('latitude', 'd', ('y', 'x'))
+            lat.setncatts({'units': 'degrees_north', 'long_name': 'latitude'})
+            lon = nc.createVariable('longitude', 'd', ('y', 'x'))
+            lon.setncatts({'units': 'degrees_east', 'long_name': 'longitude'})
+
+            for name, (long_name, level, units, _) in variables.items():
+                if name in DROP:
+                    continue
+                var = nc.createVariable(name, 'f', ('time', 'y', 'x'), fill_value=FILL_VALUE)
+                var.setncatts({'short_name': name, 'long_name': long_name, 'level': level, 'units': units})
+            for name, dimensions, attributes, _ in derived:
+                var = nc.createVariable(name, 'f', dimensions)
+                var.setncatts(attributes)
+
+            # Definitions done, now the data
+            t[:] = arrays['time']
+            lat[:] = lats
+            lon[:] = lons
+            for name, (_, _, _, values) in variables.items():
+                if name not in DROP:
+                    nc.variables[name][:] = values[np.newaxis]
+            for name, _, _, values in derived:
+                nc.variables[name][:] = values
+        finally:
+            nc.close()
+        os.replace(tmp, filename)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
+
+
+def split_messages(data):
+    """Split the contents of a GRIB file into individual messages"""
+    view = memoryview(data)
+    offset = 0
+    while True:
+        start = data.find(b'GRIB', offset)
+        if start < 0 or start + 16 > len(data):
+            return
+        edition = view[start+7]
+        if edition == 2:
+            length = int.from_bytes(view[start+8:start+16], 'big')
+        elif edition == 1:
+            length = int.from_bytes(view[start+4:start+7], 'big')
+        else:                           # "GRIB" inside a message, keep looking
+            offset = start + 4
+            continue
+        yield view[start:start+length]
+        offset = start + length
+
+
+def process_grib_file(filename, output_dir='.', box=BOX, data=None):
+    """Convert one NAM forecast hour GRIB file into a MapS input NetCDF
+       file.  If data (the file's contents) is given, it is decoded
+       instead of reading filename.  Returns output filename
+    """
+    if pygrib is None:
+        raise RuntimeError('pygrib module is required to decode GRIB files')
+    output = output_filename(filename, output_dir)
+    if data is None:
+        grbs = pygrib.open(filename)
+        try:
+            variables, grid = read_messages(grbs, box)
+        finally:
+            grbs.close()
+    else:
+        messages = (pygrib.fromstring(bytes(m)) for m in split_messages(data))
+        variables, grid = read_messages(messages, box)
+    argv0 = os.path.basename(sys.argv[0])
+    history = f'{time.ctime(time.time())}: {argv0} {filename}\ncreated by {argv0}'
+    write_netcdf(output, variables, grid, history)
+    return output
+
+
+def iter_tar_members(filename, pattern=FORECAST_HOUR_RE):
+    """Stream (member name, contents) for each member of tarfile
+       filename matching pattern, w/o extracting anything to disk
+    """
+    with tarfile.open(filename, mode='r|*') as tar:
+        for member in tar:
+            if member.isfile() and pattern.search(member.name):
+                yield os.path.basename(member.name), tar.extractfile(member).read()
+
+
+def prefetch(iterable, size=1):
+    """Iterate over iterable in a background thread, up to size items
+       ahead, so reading the next item overlaps w/ processing this one
+    """
+    queue = Queue(maxsize=size)
+    done = object()
+
+    def reader():
+        try:
+            for item in iterable:
+                queue.put(item)
+        except (OSError, tarfile.TarError) as err:
+            queue.put(err)
+        finally:
+            queue.put(done)
+
+    threading.Thread(target=reader, daemon=True).start()
+    while True:
+        item = queue.get()
+        if item is done:
+            return
+        if isinstance(item, Exception):
+            raise item
+        yield item
+
+
+def _timed_process_grib_file(filename, output_dir, data=None):
+    """process_grib_file() wrapper returning (filename, output filename or
+       None on failure, elapsed seconds)
+    """
+    start_t = time.perf_counter()
+    with metrics.Stage('grib', filename) as stage:
+        try:
+            output = process_grib_file(filename, output_dir, data=data)
+        except (OSError, KeyError, ValueError, RuntimeError) as err:
+            print(f'?error when trying to process file "{filename}": {err}', file=sys.stderr)
+            output = None
+            stage.status = 1
+    return filename, output, time.perf_counter() - start_t
+
+
+def _pool_results(executor, items, output_dir, limit):
+    """Submit (filename, data) items to executor, w/ no more than limit
+       in flight (bounds memory when streaming), yielding results as
+       they complete
+    """
+    pending = set()
+    for filename, data in items:
+        if len(pending) >= limit:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for f in done:
+                yield f.result()
+        pending.add(executor.submit(_timed_process_grib_file, filename, output_dir, data))
+    for f in as_completed(pending):
+        yield f.result()
+
+
+def process_grib_files(items, output_dir='.', list_ok=False, jobs=1):
+    """Convert many GRIB files, w/ a pool of jobs worker processes,
+       reporting per-file timings and failures on stderr.  items are
+       filenames or (filename, contents) tuples.  Returns (count, list
+       of filenames that failed)
+    """
+    start_t = time.perf_counter()
+    items = ((i, None) if isinstance(i, str) else i for i in items)
+    if jobs > 1:
+        executor = ProcessPoolExecutor(max_workers=jobs)
+        results = _pool_results(executor, items, output_dir, 2*jobs)
+    else:
+        executor = None
+        results = (_timed_process_grib_file(fn, output_dir, data) for fn, data in items)
+
+    count = 0
+    failed = []
+    for fn, output, delta_t in results:
+        count += 1
+        if output:
+            print(f'?processed {fn} in {delta_t:.3f} seconds', file=sys.stderr)
+            if list_ok:
+                print(output, flush=True)
+        else:
+            print(f'?failed {fn} after {delta_t:.3f} seconds', file=sys.stderr)
+            failed.append(fn)
+    if executor:
+        executor.shutdown()
+
+    delta_t = time.perf_counter() - start_t
+    print(f'?{count - len(failed)} of {count} GRIB file(s) processed in {delta_t:.3f} seconds ({jobs} job(s))', file=sys.stderr)
+    for fn in sorted(failed):
+        print(f'?failed to process {fn}', file=sys.stderr)
+    return count, failed
+
+
+def process_tarfile(filename, output_dir='.', jobs=1, pattern=FORECAST_HOUR_RE):
+    """Convert the forecast hour members of a NAM tarfile straight from
+       the (streamed) tarfile, reading the next member while the current
+       one(s) are processed.  Returns (list of member names seen, list of
+       members that failed)
+    """
+    seen = []
+
+    def members():
+        for name, data in prefetch(iter_tar_members(filename, pattern), jobs):
+            seen.append(name)
+            yield name, data
+
+    _, failed = process_grib_files(members(), output_dir, jobs=jobs)
+    return seen, failed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Convert NAM forecast hour GRIB files into MapS input NetCDF files')
+    parser.add_argument('file', nargs='*', help='NAM GRIB file(s) (nam_218_*.grb2)')
+    parser.add_argument('-t', '--tar', help='Stream forecast hour GRIB files out of this NAM tarfile (member names are printed on stdout, like tar xv)')
+    parser.add_argument('-o', '--output-dir', default='.', help='Directory to write maps_*_input.nc files in (default: current directory)')
+    parser.add_argument('-l', '--list', action='store_true', help='Print names of generated NetCDF files on stdout')
+    parser.add_argument('-j', '--jobs', type=int, default=maps_derived.default_jobs(), help='Number of worker processes (default: $SLURM_CPUS_PER_TASK or 1)')
+    args = parser.parse_args()
+    if pygrib is None:
+        print('?pygrib module is required, try: pip install pygrib', file=sys.stderr)
+        sys.exit(1)
+    if bool(args.tar) == bool(args.file):
+        parser.error('specify either GRIB file(s) or --tar TARFILE')
+    jobs = max(1, args.jobs)
+    if args.tar:
+        try:
+            members, failed = process_tarfile(args.tar, args.output_dir, jobs)
+        except (OSError, tarfile.TarError) as err:
+            print(f'?error when trying to read tarfile "{args.tar}": {err}', file=sys.stderr)
+            sys.exit(1)
+        print('\n'.join(members))
+    else:
+        _, failed = process_grib_files(args.file, args.output_dir, args.list, jobs)
+    if failed:
+        sys.exit(1)
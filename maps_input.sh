@@ -2,10 +2,11 @@
 
 # Generate Deep Learning Neural Net MapS fog input data for Hamid
 
-# Bounding box for Hamid's MapS DL NN
+# Bounding box for Hamid's MapS DL NN (should match the 'maps' box in grid_index.py)
 LON_LAT='-98.01:-94.20 25.4:28.85'
 
-# MUR SST ncks latitude/longitude filtering CLI options (should match above)
+# MUR SST ncks latitude/longitude filtering CLI options (should match above
+# and the 'mur' box in grid_index.py)
 MUR_NCKS_ARGS='-d lat,25.24,29.0 -d lon,-98.01,-94.25'
 
 # Build a single regex w/ all the predictors at all the levels we want
@@ -30,8 +31,15 @@ MUR_ARCHIVE_DIR=$FOGHAT_ARCHIVE_DIR/ghrsst-l4
 
 OUTPUT_DIR=$FOGHAT_INPUT_DIR/fog-maps   # XXX confusing naming
 TODAY=`date -u '+%Y%m%d'`
-# Include PID in log filename in case multiple instances of this process are running simultaneously
-LOG_FILE="$FOGHAT_LOG_DIR/maps_input-$TODAY-$$.log"
+# Include PID in log filename in case multiple instances of this process
+# are running simultaneously.  Slurm array tasks (see maps_shards.py) run
+# on different nodes, where PIDs can repeat, so add their job/task IDs
+JOB_ID=$$
+[[ -n "$SLURM_ARRAY_JOB_ID" && -n "$SLURM_ARRAY_TASK_ID" ]] && JOB_ID=${SLURM_ARRAY_JOB_ID}_${SLURM_ARRAY_TASK_ID}-$$
+LOG_FILE="$FOGHAT_LOG_DIR/maps_input-$TODAY-$JOB_ID.log"
+# Per-stage resource usage (JSON lines, see metrics.py and metrics_report.py)
+METRICS_FILE="$FOGHAT_LOG_DIR/maps_input-$TODAY-$JOB_ID.metrics.jsonl"
+export FOGHAT_METRICS_FILE=$METRICS_FILE FOGHAT_JOB_ID=$JOB_ID
 
 mkdir -p "$FOGHAT_LOG_DIR"  "$OUTPUT_DIR"
 
@@ -46,19 +54,34 @@ note() {
     echo $msg >>"$fn"
 }
 
+# Run a pipeline stage, appending its resource usage to $METRICS_FILE as a
+# JSON line (same fields as metrics.py).  Usage: timed STAGE FILE CMD [ARG...]
+timed() {
+    local stage=$1
+    local file=`basename "$2"`
+    shift 2
+    if [[ -x /usr/bin/time ]]
+    then
+        /usr/bin/time --append --output="$METRICS_FILE" --format="{\"t\": `date '+%s'`, \"stage\": \"$stage\", \"file\": \"$file\", \"job\": \"$JOB_ID\", \"wall\": %e, \"user\": %U, \"sys\": %S, \"max_rss_kb\": %M, \"read_blocks\": %I, \"write_blocks\": %O, \"status\": %x}" "$@"
+    else
+        "$@"
+    fi
+}
+
 process_grib_file() {
     local filename=$1
     local noext=`echo $filename | sed 's/^nam_218/maps/; s/\.grb2//;'`
     local unsorted=${noext}_raw.grb2
     local sorted=${noext}_sorted.grb2
     local netcdf=${noext}_wip.nc
-    local final_netcdf=${noext}_input.nc
 
     # Clip out the variables and levels we want w/in the desired bounding box
-    wgrib2 $FOGHAT_WGRIB_OPTS $filename -set_grib_type c2 -match "$MATCH_RE" -small_grib $LON_LAT $unsorted >/dev/null
+    timed clip $filename wgrib2 $FOGHAT_WGRIB_OPTS $filename -set_grib_type c2 -match "$MATCH_RE" -small_grib $LON_LAT $unsorted >/dev/null
 
     # Reorder grib2 variables [predictors] as noted in Waylon's document
-    wgrib2 $FOGHAT_WGRIB_OPTS $unsorted | $FOGHAT_EXE_DIR/grib2_inv_reorder.pl | wgrib2 $FOGHAT_WGRIB_OPTS -i $unsorted -set_grib_type c2 -grib_out $sorted >/dev/null
+    # (pipeline run by bash so the stage's usage includes all of it)
+    timed reorder $filename bash -c 'wgrib2 $0 "$1" | "$2" | wgrib2 $0 -i "$1" -set_grib_type c2 -grib_out "$3"' \
+        "$FOGHAT_WGRIB_OPTS" $unsorted $FOGHAT_EXE_DIR/grib2_inv_reorder.pl $sorted >/dev/null
 
     # Make sure temporary GRIB file exists _and_ has content before continuing
     local size=`stat -c '%s' $sorted 2>/dev/null || echo 0`
@@ -69,13 +92,36 @@ process_grib_file() {
     fi
 
     # Convert to NetCDF
-    wgrib2 $FOGHAT_WGRIB_OPTS $sorted -netcdf $netcdf >/dev/null
+    timed netcdf $filename wgrib2 $FOGHAT_WGRIB_OPTS $sorted -netcdf $netcdf >/dev/null
+}
 
-    # Using variables in NetCDF file, add derived variables (in place)
-    $FOGHAT_EXE_DIR/maps_derived.py $netcdf
+# Process NAM grib files w/ wgrib2 and maps_derived.py
+process_grib_files() {
+    # Forecast hours are independent so run up to $JOBS of them at once
+    for fn in $*
+    do
+        # Strip any preceeding path information ("./") from filename string
+        clean_fn=$(basename $fn)
+        # Check for errors/unavailable files ?
+        wait_for_slot
+        process_grib_file $clean_fn &
+    done
+    wait
+
+    local netcdf_files=''
+    for fn in $*
+    do
+        netcdf=`basename $fn | sed 's/^nam_218/maps/; s/\.grb2$/_wip.nc/;'`
+        [[ -e "$netcdf" ]] && netcdf_files="$netcdf_files $netcdf"
+    done
 
-    # Remove mean sea level pressure (surface pressure)  from NetCDF file, as per waylon
-    ncks --no_alphabetize -O -x -v MSLET_meansealevel $netcdf $final_netcdf
+    # Using variables in NetCDF files, calculate derived variables and
+    # write final maps_*_input.nc files w/ them and w/o mean sea level
+    # pressure (MSLET, as per waylon) in a single pass, no ncks rewrite.
+    # All forecast hours are handled by a single python process (w/ a
+    # pool of $JOBS workers).  zlib compressed NetCDF4 output if
+    # $FOGHAT_NC_COMPLEVEL is set
+    [[ -n "$netcdf_files" ]] && $FOGHAT_EXE_DIR/maps_derived.py --jobs $JOBS --write --complevel ${FOGHAT_NC_COMPLEVEL:-0} $netcdf_files
 }
 
 # Process all forecast hours files in a given (date, model cycle) NAM tarfile
@@ -99,24 +145,54 @@ process_day_cycle() {
         return
     fi
 
+    local output_subdir=`date -d "$when" '+%Y/%Y%j'`
+    local dest_path="$OUTPUT_DIR/$output_subdir"
+    # Consolidated (year, model cycle) store, see maps_store.py
+    local store="$OUTPUT_DIR/$year/maps_${year}_${mc}00.nc"
+    if [[ $RESUME && $CONSOLIDATE ]] && $FOGHAT_EXE_DIR/maps_store.py check "$store" $year$md$mc
+    then
+        echo "?($year$md, $cycle) already in $store, skipping" 1>&2
+        return
+    elif [[ $RESUME && ! $CONSOLIDATE ]] && $FOGHAT_EXE_DIR/maps_manifest.py check "$dest_path" "$tarfile"
+    then
+        echo "?($year$md, $cycle) already processed from unchanged $tarfile, skipping" 1>&2
+        return
+    fi
+
     # Extract forecast hours 0-36 from (day, model cycle) grib tarfile
     # XXX  CLI testing made it seem I have to be _really_ specific w/ my file glob otherwise it matches unwanted files?!
     local EXPECTED_COUNT=37
-    local grib_files=`tar xvf "$tarfile" --directory=$TMP_DIR --wildcards *nam_218_$year${md}_${mc}00_0{[012][0-9],3[0-6]}.grb2`
+    local grib_files
+    if [[ $GRIB_PY ]]
+    then
+        # Stream forecast hour files straight out of the tarfile (nothing
+        # extracted to disk) and decode, clip, reorder, derive and write
+        # final NetCDF files in a single python process (w/ a pool of
+        # $JOBS workers).  Member names are listed on stdout like tar xv
+        grib_files=`$FOGHAT_EXE_DIR/maps_grib.py --jobs $JOBS --tar "$tarfile"`
+    else
+        grib_files=`timed tar "$tarfile" tar xvf "$tarfile" --directory=$TMP_DIR --wildcards *nam_218_$year${md}_${mc}00_0{[012][0-9],3[0-6]}.grb2`
+        process_grib_files $grib_files
+    fi
+    local count=`echo $grib_files | wc -w`
 
-    # Process NAM grib files
-    local count=0
+    # Collect forecast hour files that failed somewhere along the way
+    local failed=''
     for fn in $grib_files
     do
-        # Strip any preceeding path information ("./") from filename string
-        clean_fn=$(basename $fn)
-        # Check for errors/unavailable files ?
-        process_grib_file $clean_fn
-        count=$((count + 1))
+        final_netcdf=`basename $fn | sed 's/^nam_218/maps/; s/\.grb2$/_input.nc/;'`
+        [[ ! -s "$final_netcdf" ]] && failed="$failed $final_netcdf"
     done
+    if [[ -n "$failed" ]]
+    then
+        echo "?Failed to generate forecast hour file(s):$failed" 1>&2
+        note "$when" "($year$md, $cycle) Failed to generate forecast hour file(s):$failed"
+    fi
 
     local delta_t=$((`date '+%s'` - start_t))
     echo "?$count forecast hour files processed from $tarfile in $delta_t seconds" 1>&2
+    local status=$(( count != EXPECTED_COUNT ))
+    echo "{\"t\": $start_t, \"stage\": \"cycle\", \"file\": \"`basename $tarfile`\", \"job\": \"$JOB_ID\", \"wall\": $delta_t, \"count\": $count, \"status\": $status}" >>"$METRICS_FILE"
 
     # Count should be 37 files, if not then log [somewhere else], [probably] discard?
     if [ $count -ne $EXPECTED_COUNT ]
@@ -126,11 +202,21 @@ process_day_cycle() {
         return
     fi
 
+    if [[ $CONSOLIDATE ]]
+    then
+        # Add forecast hours to the (year, model cycle) store instead of
+        # copying individual files
+        mkdir -p "$OUTPUT_DIR/$year"
+        timed store "$tarfile" $FOGHAT_EXE_DIR/maps_store.py append "$store" maps_$year${md}_${mc}00_0*_input.nc
+        return
+    fi
+
     # Copy resulting MapS input files to destination directory for given day
-    local output_subdir=`date -d "$when" '+%Y/%Y%j'`
-    local dest_path="$OUTPUT_DIR/$output_subdir"
     mkdir -p "$dest_path"
-    cp maps_$year*_input.nc "$dest_path"
+    timed copy "$tarfile" cp maps_$year*_input.nc "$dest_path"
+
+    # Record completed (day, cycle) w/ output checksums for resuming (-r)
+    $FOGHAT_EXE_DIR/maps_manifest.py record "$dest_path" "$tarfile" maps_$year${md}_${mc}00_0*_input.nc
 
     # TODO  ¿ Add CLI option to copy temporary (WIP) NetCDF files ± source [clipped/sorted] .grb2 files into destination directory for verification ?
 }
@@ -151,9 +237,30 @@ crop_mur() {
     mkdir -p "$dest_path"
     local dest_fqpn="$dest_path/murs_${murdate}_0000_009_input.nc"
 
+    if [[ $RESUME && -s "$dest_fqpn" && "$dest_fqpn" -nt "$input_fqpn" ]]
+    then
+        echo "?$mur_fn already cropped, skipping" 1>&2
+        return
+    fi
+
     # TODO ¿ Write output cropped MUR to local storage ($TMP_DIR?) _then_ copy to destination?
     echo "?Cropping $mur_fn" 1>&2
-    ncks --no_alphabetize $MUR_NCKS_ARGS "$input_fqpn" -O "$dest_fqpn"
+    # Only reads the hyperslab we keep, index bounds come from the grid
+    # index ($FOGHAT_BASE/var/grid_index.json), fall back to ncks
+    if ! timed mur "$input_fqpn" $FOGHAT_EXE_DIR/clip_mur.py -o "$dest_fqpn" "$input_fqpn"
+    then
+        echo "?clip_mur.py failed, cropping $mur_fn w/ ncks" 1>&2
+        timed mur "$input_fqpn" ncks --no_alphabetize $MUR_NCKS_ARGS "$input_fqpn" -O "$dest_fqpn"
+    fi
+}
+
+# Block until fewer than $JOBS background jobs are running
+wait_for_slot () {
+    while (( `jobs -rp | wc -l` >= JOBS ))
+    do
+        # wait -n requires bash 4.3+, fall back to polling
+        wait -n 2>/dev/null || sleep 0.2
+    done
 }
 
 # Convert from julian/ordinal day to YYYY-MM-DD for easy conversion by date (1)
@@ -175,12 +282,23 @@ seconds2hms () {
 usage () {
     local zero=`basename $0`
     cat <<EndOfUsage 1>&2
-Usage: $zero [-p] [-c CYCLE] <start_date> <end_date>
+Usage: $zero [-p] [-g] [-r] [-C] [-c CYCLE] [-j JOBS] <start_date> <end_date>
 
 Options:
+  -C            Consolidated output: add forecast hours to one NetCDF4 store
+                per (year, model cycle), YYYY/maps_YYYY_CC00.nc, instead of
+                individual maps_*_input.nc files (see maps_store.py)
+  -g            Convert GRIB to NetCDF in-process w/ maps_grib.py (pygrib),
+                streamed from the tarfile, instead of tar, wgrib2 and
+                grib2_inv_reorder.pl
   -n            No MUR SST cropping
   -p            Preserve intermediate files (debug only)
+  -r            Resume: skip (day, cycle)s already processed from an
+                unchanged tarfile (as per their maps_*_manifest.json), or
+                w/ -C, already complete in the store
   -c CYCLE      Only calculate model cycle hour CYCLE (0, 6, 12, 18)
+  -j JOBS       Process up to JOBS forecast hours in parallel
+                (default: \$SLURM_CPUS_PER_TASK or 1)
 
 E.g., $zero 2018-11-01 2018-11-30
 
@@ -192,10 +310,15 @@ EndOfUsage
 
 # Default is to crop MUR SST files
 MUR_CROP=1
+# Default is to use every CPU Slurm allocated to us
+JOBS=${SLURM_CPUS_PER_TASK:-1}
 
 # Parse command line options
-while getopts "c:hnp" OPTION; do
+while getopts "Cc:ghj:npr" OPTION; do
     case $OPTION in
+    C)
+        CONSOLIDATE=1
+        ;;
     c)
         CYCLE=$OPTARG
         [[ ! $CYCLE =~ 0|6|12|18 ]] && {
@@ -203,15 +326,28 @@ while getopts "c:hnp" OPTION; do
             exit 1
         }
         ;;
+    g)
+        GRIB_PY=1
+        ;;
     h)
         usage
         ;;
+    j)
+        JOBS=$OPTARG
+        [[ ! $JOBS =~ ^[1-9][0-9]*$ ]] && {
+            echo "Invalid number of jobs specified ($OPTARG)"
+            exit 1
+        }
+        ;;
     n)
         MUR_CROP=
         ;;
     p)
         PRESERVE=1
         ;;
+    r)
+        RESUME=1
+        ;;
     *)
         echo "Incorrect option ($OPTION) provided"
         exit 1
@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+
+"""
+Per (day, model cycle) completion manifests for maps_input.sh, so an
+interrupted year can be resumed (maps_input.sh -r) w/o reprocessing
+every (day, cycle) from scratch.
+
+A manifest (maps_YYYYMMDD_CC00_manifest.json) sits next to the outputs
+in the day's destination directory and records the source tarfile's
+size and mtime plus the size and md5 checksum of every maps_*_input.nc
+file copied there.  A (day, cycle) is complete if its manifest exists,
+the tarfile hasn't changed since and every output is still there (w/ the
+same size, or checksum w/ --verify).  W/ consolidated output
+(maps_input.sh -C) there are no manifests, gaps goes by what's complete
+in the (year, cycle) stores instead (see maps_store.py).
+
+Usage: maps_manifest.py record DEST_DIR TARFILE FILE...
+       maps_manifest.py check [--verify] DEST_DIR TARFILE
+       maps_manifest.py gaps [-c CYCLE] YEAR
+"""
+
+import argparse
+import datetime
+import glob
+import hashlib
+import json
+import os
+import re
+import sys
+import time
+
+OUTPUT_DIR = os.path.join(os.environ.get('FOGHAT_INPUT_DIR', '.'), 'fog-maps')
+
+# nam_218_20190101_0000_000.grb2 / nam_218_2019010100.g2.tar / maps_20190101_0000_000_input.nc
+TARFILE_RE = re.compile(r'nam_218_(\d{8})(\d{2})\.g2\.tar$')
+MANIFEST_RE = re.compile(r'maps_(\d{8})_(\d{2})00_manifest\.json$')
+# Notes written by maps_input.sh's note(), e.g. "(20190101, 6) Can't find ..."
+NOTE_RE = re.compile(r'\((\d{8}), (\d{1,2})\)')
+
+CYCLES = (0, 6, 12, 18)
+EXPECTED_COUNT = 37
+
+
+def md5sum(filename, blocksize=1 << 20):
+    """md5 hex digest of filename"""
+    md5 = hashlib.md5()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b''):
+            md5.update(block)
+    return md5.hexdigest()
+
+
+def manifest_filename(dest_dir, tarfile):
+    """DEST_DIR/maps_YYYYMMDD_CC00_manifest.json for a NAM tarfile"""
+    match = TARFILE_RE.search(os.path.basename(tarfile))
+    if not match:
+        raise ValueError(f'unexpected NAM tarfile name "{tarfile}"')
+    ymd, cycle = match.groups()
+    return os.path.join(dest_dir, f'maps_{ymd}_{cycle}00_manifest.json')
+
+
+def tarfile_stat(tarfile):
+    st = os.stat(tarfile)
+    return {'path': os.path.abspath(tarfile), 'size': st.st_size, 'mtime': int(st.st_mtime)}
+
+
+def record(dest_dir, tarfile, files):
+    """Write the manifest for (day, cycle) tarfile, outputs files (in
+       dest_dir).  Written last, so it only exists for completed work
+    """
+    outputs = {}
+    for fn in files:
+        path = os.path.join(dest_dir, os.path.basename(fn))
+        outputs[os.path.basename(fn)] = {'size': os.path.getsize(path), 'md5': md5sum(path)}
+    manifest = {
+        'tarfile': tarfile_stat(tarfile),
+        'outputs': outputs,
+        'completed': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+    }
+    filename = manifest_filename(dest_dir, tarfile)
+    tmp = f'{filename}.tmp{os.getpid()}'
+    with open(tmp, 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(tmp, filename)
+    return filename
+
+
+def check(dest_dir, tarfile, verify=False):
+    """Return None if (day, cycle) tarfile is complete in dest_dir,
+       otherwise why it needs to be (re)processed
+    """
+    filename = manifest_filename(dest_dir, tarfile)
+    try:
+        with open(filename) as f:
+            manifest = json.load(f)
+    except FileNotFoundError:
+        return 'no manifest'
+    except (OSError, ValueError) as err:
+        return f'unreadable manifest ({err})'
+
+    try:
+        current = tarfile_stat(tarfile)
+    except OSError as err:
+        return f'tarfile unavailable ({err})'
+    previous = manifest.get('tarfile', {})
+    if (previous.get('size'), previous.get('mtime')) != (current['size'], current['mtime']):
+        return 'tarfile changed since it was processed'
+
+    outputs = manifest.get('outputs', {})
+    if len(outputs) != EXPECTED_COUNT:
+        return f'manifest lists {len(outputs)} output(s), expected {EXPECTED_COUNT}'
+    for name, expected in sorted(outputs.items()):
+        path = os.path.join(dest_dir, name)
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            return f'{name} missing'
+        if size != expected['size']:
+            return f'{name} size changed'
+        if verify and md5sum(path) != expected['md5']:
+            return f'{name} checksum mismatch'
+    return None
+
+
+def read_notes(year, output_dir=OUTPUT_DIR):
+    """{(YYYYMMDD, cycle): [note, ...]} from processing-notes-YEAR.txt"""
+    notes = {}
+    try:
+        with open(os.path.join(output_dir, f'processing-notes-{year}.txt')) as f:
+            for line in f:
+                match = NOTE_RE.search(line)
+                if match:
+                    notes.setdefault((match.group(1), int(match.group(2))), []).append(line.strip())
+    except FileNotFoundError:
+        pass
+    return notes
+
+
+def gaps(year, cycles=CYCLES, output_dir=OUTPUT_DIR):
+    """Report (day, cycle)s of year w/o a manifest (or, w/ maps_input.sh
+       -C, not complete in the year's consolidated store), and whether
+       they're accounted for in the processing notes.  Returns number of
+       unexplained gaps
+    """
+    complete = set()
+    for fn in glob.glob(os.path.join(output_dir, str(year), f'{year}???', 'maps_*_manifest.json')):
+        ymd, cycle = MANIFEST_RE.search(fn).groups()
+        complete.add((ymd, int(cycle)))
+    for cycle in cycles:
+        store = os.path.join(output_dir, str(year), f'maps_{year}_{cycle:02d}00.nc')
+        if os.path.exists(store):
+            # Imported here, it needs netCDF4
+            import maps_store
+            complete.update((time.strftime('%Y%m%d', time.gmtime(t)), cycle)
+                            for t in maps_store.complete_cycles(store))
+    notes = read_notes(year, output_dir)
+
+    today = datetime.date.today()
+    day = datetime.date(year, 1, 1)
+    missing = noted = 0
+    while day.year == year and day <= today:
+        ymd = day.strftime('%Y%m%d')
+        for cycle in cycles:
+            key = (ymd, cycle)
+            if key in complete:
+                if key in notes:
+                    print(f'({ymd}, {cycle}) complete, but noted: {notes[key][-1]}')
+                continue
+            if key in notes:
+                noted += 1
+                print(f'({ymd}, {cycle}) missing, noted: {notes[key][-1]}')
+            else:
+                missing += 1
+                print(f'({ymd}, {cycle}) missing, NOT in processing-notes-{year}.txt')
+        day += datetime.timedelta(days=1)
+    print(f'?{year}: {len(complete)} complete, {noted} noted gap(s), {missing} unexplained gap(s)', file=sys.stderr)
+    return missing
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Record/check per (day, model cycle) MapS input completion manifests')
+    subparsers = parser.add_subparsers(dest='command')
+    p = subparsers.add_parser('record', help='Write manifest for a completed (day, cycle)')
+    p.add_argument('dest_dir', help="Day's destination directory")
+    p.add_argument('tarfile', help='Source NAM tarfile')
+    p.add_argument('file', nargs='+', help='maps_*_input.nc output file(s)')
+    p = subparsers.add_parser('check', help='Exit 0 if (day, cycle) is complete and current, 1 otherwise')
+    p.add_argument('--verify', action='store_true', help='Verify output checksums (default: sizes)')
+    p.add_argument('dest_dir', help="Day's destination directory")
+    p.add_argument('tarfile', help='Source NAM tarfile')
+    p = subparsers.add_parser('gaps', help='Report incomplete (day, cycle)s vs processing-notes-YEAR.txt')
+    p.add_argument('-c', '--cycle', type=int, action='append', choices=CYCLES, help='Model cycle(s) (default: all)')
+    p.add_argument('-d', '--output-dir', default=OUTPUT_DIR, help=f'MapS input directory (default: {OUTPUT_DIR})')
+    p.add_argument('year', type=int)
+    args = parser.parse_args()
+
+    try:
+        if args.command == 'record':
+            record(args.dest_dir, args.tarfile, args.file)
+        elif args.command == 'check':
+            reason = check(args.dest_dir, args.tarfile, args.verify)
+            if reason:
+                print(f'?{os.path.basename(args.tarfile)} needs processing: {reason}', file=sys.stderr)
+                sys.exit(1)
+        elif args.command == 'gaps':
+            sys.exit(1 if gaps(args.year, args.cycle or CYCLES, args.output_dir) else 0)
+        else:
+            parser.print_help()
+            sys.exit(2)
+    except (OSError, ValueError) as err:
+        print(f'?{args.command} failed: {err}', file=sys.stderr)
+        sys.exit(1)
@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+
+"""
+QA scan of generated MapS input files (maps_*_input.nc): NaN, fill and
+out-of-range counts plus min/max/mean for every variable of every file,
+in one CSV table (one row per file and variable).  Derived variables'
+statistics come from the QA attributes maps_derived.py adds, so their
+values are only read back if they're out of range.
+
+Files are scanned in parallel and the scan is incremental: files already
+in the table w/ the same size and mtime aren't rescanned.  Supersedes
+find_outlier.py (two variables, serial) and nan_hunt.sh (rebuilding days
+to look for NaNs in the GRIB files).
+
+E.g., maps_qa.py -o qa-2020.csv $FOGHAT_INPUT_DIR/fog-maps/2020
+"""
+
+import argparse
+import csv
+import math
+import os
+import re
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from netCDF4 import Dataset
+import numpy as np
+
+import maps_derived
+
+FIELDS = ('file', 'size', 'mtime', 'variable', 'count', 'nan', 'fill', 'out_of_range', 'min', 'max', 'mean')
+
+# Plausible value ranges, keyed by variable name w/o its level suffix
+# (e.g. TMP_975mb → TMP).  Variables w/o a range are only checked for
+# huge values, like find_outlier.py did
+RANGES = {
+    'TMP': (150, 350),                  # K
+    'DPT': (150, 350),                  # K
+    'LCLT': (150, 350),                 # K
+    'RH': (0, 105),                     # %
+    'UGRD': (-150, 150),                # m/s
+    'VGRD': (-150, 150),                # m/s
+    'VVEL': (-100, 100),                # Pa/s
+    'TKE': (0, 100),                    # J/kg
+    'FRICV': (0, 10),                   # m/s
+    'VIS': (0, 100000),                 # m
+    'Q': (0, 0.05),                     # kg/kg
+    'DateVal': (-1, 1),
+}
+HUGE = 9999
+
+# Variables not worth checking
+SKIP = ('time', 'latitude', 'longitude')
+
+
+def value_range(name):
+    """(low, high) for variable name, DQDZ950975 → DQDZ, Q_975mb → Q"""
+    base = re.match(r'[A-Za-z]+', name).group(0)
+    if base.startswith('DQDZ'):
+        return (-HUGE, HUGE)
+    return RANGES.get(name, RANGES.get(base, (-HUGE, HUGE)))
+
+
+def variable_stats(var):
+    """Count, NaN, fill, out of range, min, max and mean of a variable's
+       raw values (fill and NaN values excluded from the statistics)
+    """
+    var.set_auto_maskandscale(False)
+    data = var[:]
+    fill_value = var.getncattr('_FillValue') if '_FillValue' in var.ncattrs() else None
+    if data.dtype.kind != 'f':
+        data = data.astype(np.float64)
+    nan = np.isnan(data)
+    fill = np.zeros(data.shape, dtype=bool)
+    if fill_value is not None:
+        fill |= data == fill_value
+    # Unwritten values of variables w/o _FillValue (e.g. derived ones)
+    fill |= np.abs(data) >= 9.96e36
+    valid = ~(nan | fill)
+    values = data[valid]
+    nan_count, fill_count = int(nan.sum()), int(fill.sum())
+    if 'qa_nan' in var.ncattrs():
+        # maps_derived.py wrote non-finite results as fill values, count
+        # them as NaN like inline_stats()
+        written = min(int(var.qa_nan), fill_count)
+        nan_count, fill_count = nan_count + written, fill_count - written
+    low, high = value_range(var.name)
+    out_of_range = int(np.count_nonzero((values < low) | (values > high)))
+    if values.size:
+        vmin, vmax, mean = float(values.min()), float(values.max()), float(values.mean(dtype=np.float64))
+    else:
+        vmin = vmax = mean = math.nan
+    return data.size, nan_count, fill_count, out_of_range, vmin, vmax, mean
+
+
+def inline_stats(var):
+    """Statistics from the QA attributes maps_derived.py writes, None if
+       there aren't any or values are out of range (so they need counting)
+    """
+    attrs = var.ncattrs()
+    if 'qa_fill' not in attrs or 'qa_nan' not in attrs:
+        return None
+    if 'qa_min' in attrs:
+        vmin, vmax, mean = float(var.qa_min), float(var.qa_max), float(var.qa_mean)
+    else:
+        vmin = vmax = mean = math.nan
+    low, high = value_range(var.name)
+    if vmin < low or vmax > high:
+        return None
+    # Non-finite results were masked, i.e. written as fill values and
+    # counted in qa_fill too, a scan counts them as NaN or fill
+    nan = int(var.qa_nan)
+    return var.size, nan, int(var.qa_fill) - nan, 0, vmin, vmax, mean
+
+
+def scan_file(filename):
+    """QA rows for every variable of filename, or (filename, error)"""
+    try:
+        st = os.stat(filename)
+        nc = Dataset(filename, 'r')
+    except OSError as err:
+        return filename, str(err)
+    rows = []
+    try:
+        for name, var in nc.variables.items():
+            if name in SKIP:
+                continue
+            count, nan, fill, oob, vmin, vmax, mean = inline_stats(var) or variable_stats(var)
+            rows.append({'file': filename, 'size': st.st_size, 'mtime': int(st.st_mtime), 'variable': name,
+                         'count': count, 'nan': nan, 'fill': fill, 'out_of_range': oob,
+                         'min': f'{vmin:.7g}', 'max': f'{vmax:.7g}', 'mean': f'{mean:.7g}'})
+    except Exception as err:
+        # Any error fails just this file, not the scan
+        return filename, f'{type(err).__name__}: {err}'
+    finally:
+        nc.close()
+    return filename, rows
+
+
+def _result(future, filename):
+    """Result of a scan_file() future, an error if the worker process died"""
+    try:
+        return future.result()
+    except Exception as err:
+        return filename, f'{type(err).__name__}: {err}'
+
+
+def find_files(paths, pattern=re.compile(r'maps_\d{8}_\d{4}_\d{3}_input\.nc$')):
+    for path in paths:
+        if os.path.isdir(path):
+            for dirpath, dirnames, filenames in os.walk(path):
+                dirnames.sort()
+                for fn in sorted(filenames):
+                    if pattern.search(fn):
+                        yield os.path.join(dirpath, fn)
+        else:
+            yield path
+
+
+def read_table(filename):
+    """{file: [rows]} from an existing QA table"""
+    table = {}
+    try:
+        with open(filename, newline='') as f:
+            for row in csv.DictReader(f):
+                table.setdefault(row['file'], []).append(row)
+    except FileNotFoundError:
+        pass
+    return table
+
+
+def write_table(filename, table):
+    tmp = f'{filename}.tmp{os.getpid()}'
+    with open(tmp, 'w', newline='') as f:
+        writer = csv.DictWriter(f, FIELDS)
+        writer.writeheader()
+        for fn in sorted(table):
+            writer.writerows(table[fn])
+    os.replace(tmp, filename)
+
+
+def unchanged(rows, filename):
+    """True if QA rows are for the current version of filename"""
+    try:
+        st = os.stat(filename)
+    except OSError:
+        return False
+    return bool(rows) and int(rows[0]['size']) == st.st_size and int(rows[0]['mtime']) == int(st.st_mtime)
+
+
+def scan(paths, output, jobs=1, rescan=False):
+    """Update QA table output w/ new/changed files under paths.  Returns
+       (table, list of files that couldn't be scanned)
+    """
+    start_t = time.perf_counter()
+    table = {} if rescan else read_table(output)
+    filenames = [fn for fn in find_files(paths) if not unchanged(table.get(fn), fn)]
+    print(f'?{len(filenames)} new or changed file(s) to scan, {len(table)} in {output}', file=sys.stderr)
+
+    if jobs > 1 and len(filenames) > 1:
+        executor = ProcessPoolExecutor(max_workers=min(jobs, len(filenames)))
+        futures = {executor.submit(scan_file, fn): fn for fn in filenames}
+        results = (_result(f, futures[f]) for f in as_completed(futures))
+    else:
+        executor = None
+        results = (scan_file(fn) for fn in filenames)
+
+    failed = []
+    for fn, rows in results:
+        if isinstance(rows, str):
+            print(f'?error when trying to scan file "{fn}": {rows}', file=sys.stderr)
+            failed.append(fn)
+            table.pop(fn, None)
+        else:
+            table[fn] = rows
+    if executor:
+        executor.shutdown()
+
+    write_table(output, table)
+    delta_t = time.perf_counter() - start_t
+    print(f'?scanned {len(filenames) - len(failed)} file(s) in {delta_t:.3f} seconds ({jobs} job(s))', file=sys.stderr)
+    return table, failed
+
+
+def summarize(table):
+    """Per variable totals of rows w/ NaN, fill or out of range values"""
+    totals = {}
+    for rows in table.values():
+        for row in rows:
+            t = totals.setdefault(row['variable'], [0, 0, 0, 0])
+            bad = [int(row['nan']), int(row['fill']), int(row['out_of_range'])]
+            if any(bad):
+                t[0] += 1
+                for i, n in enumerate(bad):
+                    t[i + 1] += n
+    print(f'{"variable":<20} {"files":>7} {"nan":>10} {"fill":>10} {"out_of_range":>12}')
+    for name, (files, nan, fill, oob) in sorted(totals.items()):
+        if files:
+            print(f'{name:<20} {files:>7} {nan:>10} {fill:>10} {oob:>12}')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Incremental, parallel QA scan of MapS input NetCDF files')
+    parser.add_argument('path', nargs='+', help='maps_*_input.nc file(s) or director(y|ies) to search')
+    parser.add_argument('-o', '--output', default='maps_qa.csv', help='QA table (CSV) to update (default: maps_qa.csv)')
+    parser.add_argument('-j', '--jobs', type=int, default=maps_derived.default_jobs(), help='Number of worker processes (default: $SLURM_CPUS_PER_TASK or 1)')
+    parser.add_argument('--rescan', action='store_true', help='Rescan every file, even unchanged ones')
+    parser.add_argument('-q', '--quiet', action='store_true', help="Don't print per variable summary of problems")
+    args = parser.parse_args()
+    table, failed = scan(args.path, args.output, max(1, args.jobs), args.rescan)
+    if not args.quiet:
+        summarize(table)
+    if failed:
+        sys.exit(1)
@@ -0,0 +1,394 @@
+#!/usr/bin/env python3
+
+"""
+Plan and submit MapS input processing of a date range as a Slurm job
+array, instead of queue-hpc-1year.sh's four fixed year long (one per
+model cycle) jobs.
+
+The (day, model cycle)s in the range are split into shards, each a run of
+consecutive days of one model cycle (i.e. one maps_input.sh -c CYCLE
+START END), so that shards take about the same time:
+
+- (day, cycle)s w/o a NAM tarfile cost next to nothing (maps_input.sh
+  just notes them), ones already complete w/ --resume (maps_input.sh -r)
+  nothing
+- the rest cost the median (day, cycle) processing time of their model
+  cycle, measured from maps_input.sh's metrics (see metrics_report.py),
+  plus cropping MUR SST for cycle 0 shards (the others use -n)
+
+Shards are handed out to model cycles by their share of the work, then
+each cycle's days are cut into contiguous blocks of even cost.  W/ -C
+(consolidated output) it's one shard per (year, model cycle) instead,
+since a store (maps_store.py) can only have one writer at a time.  The plan
+is a JSON file read back by hpc_maps_array.sbatch (maps_shards.py shard
+PLAN INDEX prints maps_input.sh's arguments for array task INDEX).
+`submit` queues the array and, once every task succeeded, a
+hpc_tarball.sbatch job per year.  W/ --dry-run nothing is submitted,
+the sbatch commands are printed instead (no Slurm needed).
+
+E.g., maps_shards.py plan -r -n 48 2020-01-01 2020-12-31
+      maps_shards.py submit -r --dry-run 2020-01-01 2020-12-31
+"""
+
+import argparse
+import datetime
+import glob
+import json
+import math
+import os
+import subprocess
+import sys
+import time
+
+import maps_manifest
+from metrics_report import read_records
+
+ARCHIVE_DIR = os.environ.get('FOGHAT_ARCHIVE_DIR', '.')
+NMM_ARCHIVE_DIR = os.path.join(ARCHIVE_DIR, 'nam-grib', 'nmm')
+LOG_DIR = os.environ.get('FOGHAT_LOG_DIR', '.')
+
+CYCLES = maps_manifest.CYCLES
+
+# Seconds per (day, cycle) and MUR crop if there are no metrics to go by
+DEFAULT_COST = 600
+DEFAULT_MUR_COST = 20
+# maps_input.sh only notes a (day, cycle) w/o a tarfile
+MISSING_COST = 1
+
+# Time limit of array tasks is the longest shard's estimate times this
+# (+ 1 hour), capped at the HPC's maximum job time (4 days)
+SAFETY = 2
+MAX_TIME = 4 * 86400
+
+# nam_218_2019010100.g2.tar → cycle 0
+TARFILE_RE = maps_manifest.TARFILE_RE
+
+
+def tarfile_path(day, cycle):
+    """Source NAM tarfile of (day, cycle), like maps_input.sh"""
+    return os.path.join(NMM_ARCHIVE_DIR, f'{day.year}', f'nam_218_{day:%Y%m%d}{cycle:02d}.g2.tar')
+
+
+def measured_costs(filenames):
+    """Median (day, cycle) seconds per model cycle and of MUR crops, from
+       maps_input.sh metrics files.  Returns ({cycle: seconds}, seconds),
+       missing values are None
+    """
+    walls = {}
+    mur = []
+    for r in read_records(filenames):
+        if r.get('stage') == 'cycle' and not r.get('status'):
+            match = TARFILE_RE.search(os.path.basename(r.get('file', '')))
+            if match:
+                walls.setdefault(int(match.group(2)), []).append(float(r['wall']))
+        elif r.get('stage') == 'mur' and not r.get('status'):
+            mur.append(float(r['wall']))
+
+    def median(values):
+        values = sorted(values)
+        n = len(values)
+        return (values[n // 2] + values[(n - 1) // 2]) / 2 if n else None
+
+    return {cycle: median(values) for cycle, values in walls.items()}, median(mur)
+
+
+def costs_w_defaults(filenames):
+    """Per cycle and MUR seconds, measured where possible.  Cycles w/o
+       metrics cost the median of the ones that have them
+    """
+    cycle_costs, mur_cost = measured_costs(filenames) if filenames else ({}, None)
+    known = sorted(cycle_costs.values())
+    fallback = known[len(known) // 2] if known else DEFAULT_COST
+    return {c: cycle_costs.get(c, fallback) for c in CYCLES}, DEFAULT_MUR_COST if mur_cost is None else mur_cost
+
+
+def days(start, end):
+    day = start
+    while day <= end:
+        yield day
+        day += datetime.timedelta(days=1)
+
+
+def is_complete(day, cycle, tarfile, consolidated):
+    """True if maps_input.sh -r would skip (day, cycle)"""
+    if consolidated:
+        # Imported here, it needs netCDF4
+        import maps_store
+        store = os.path.join(maps_manifest.OUTPUT_DIR, f'{day.year}', f'maps_{day.year}_{cycle:02d}00.nc')
+        return maps_store.check(store, f'{day:%Y%m%d}{cycle:02d}')
+    dest_dir = os.path.join(maps_manifest.OUTPUT_DIR, f'{day:%Y}', f'{day:%Y%j}')
+    return maps_manifest.check(dest_dir, tarfile) is None
+
+
+def is_cropped(day):
+    """True if maps_input.sh -r would skip cropping MUR SST of day"""
+    mur_fn = f'{day:%Y%m%d}090000-JPL-L4_GHRSST-SSTfnd-MUR-GLOB-v02.0-fv04.1.nc'
+    cropped = os.path.join(maps_manifest.OUTPUT_DIR, f'{day:%Y}', f'{day:%Y%j}', f'murs_{day:%Y%m%d}_0000_009_input.nc')
+    try:
+        return os.path.getsize(cropped) > 0 and \
+            os.path.getmtime(cropped) > os.path.getmtime(os.path.join(ARCHIVE_DIR, 'ghrsst-l4', f'{day.year}', mur_fn))
+    except OSError:
+        return False
+
+
+def unit_costs(start, end, cycle, cost, mur_cost, resume=False, consolidated=False):
+    """[(day, seconds, status)] for every day of cycle, status is one of
+       todo, missing (no tarfile) or complete
+    """
+    units = []
+    for day in days(start, end):
+        tarfile = tarfile_path(day, cycle)
+        # MUR is cropped by cycle 0 shards, whether or not there's NAM data
+        seconds = mur_cost if cycle == 0 and not (resume and is_cropped(day)) else 0
+        if not os.path.exists(tarfile):
+            status = 'missing'
+            seconds += MISSING_COST
+        elif resume and is_complete(day, cycle, tarfile, consolidated):
+            status = 'complete'
+        else:
+            status = 'todo'
+            seconds += cost
+        units.append((day, seconds, status))
+    return units
+
+
+def allocate(totals, count, limits):
+    """Number of shards per cycle, {cycle: total seconds} → {cycle: n},
+       each extra shard going to the cycle w/ the longest shards, but no
+       more than limits[cycle] (days to process) shards for a cycle.
+       Every cycle w/ work gets a shard, so count needs to be at least
+       len(totals) (checked by the command line) to be an upper bound
+    """
+    shares = {c: 1 for c, total in totals.items() if total > 0}
+    for _ in range(count - len(shares)):
+        more = [c for c in shares if shares[c] < limits[c]]
+        if not more:
+            break
+        worst = max(more, key=lambda c: totals[c] / shares[c])
+        shares[worst] += 1
+    return shares
+
+
+def split(units, count):
+    """Cut units (consecutive days) into up to count contiguous blocks of
+       about the same cost.  Blocks w/ nothing to do are dropped
+    """
+    total = sum(seconds for day, seconds, status in units)
+    # Cut after the day the running cost reaches each 1/count of the total
+    cuts = set()
+    done = 0
+    k = 1
+    for i, (day, seconds, status) in enumerate(units):
+        done += seconds
+        while k < count and done >= total * k / count:
+            cuts.add(i)
+            k += 1
+    blocks = []
+    block = []
+    for i, unit in enumerate(units):
+        block.append(unit)
+        if i in cuts:
+            blocks.append(block)
+            block = []
+    if block:
+        blocks.append(block)
+    return [b for b in blocks if any(seconds for day, seconds, status in b)]
+
+
+def by_year(units):
+    """Cut units (consecutive days) into a block per year.  Blocks w/
+       nothing to do are dropped
+    """
+    blocks = {}
+    for unit in units:
+        blocks.setdefault(unit[0].year, []).append(unit)
+    return [b for year, b in sorted(blocks.items()) if any(seconds for day, seconds, status in b)]
+
+
+def plan(start, end, shards, metrics=(), cycles=CYCLES, resume=False, options=()):
+    """Shard plan (dict) for processing start through end (dates)"""
+    cycle_costs, mur_cost = costs_w_defaults(metrics)
+    consolidated = '-C' in options
+    per_cycle = {c: unit_costs(start, end, c, cycle_costs[c], mur_cost, resume, consolidated) for c in cycles}
+    totals = {c: sum(seconds for day, seconds, status in units) for c, units in per_cycle.items()}
+
+    if consolidated:
+        # maps_store.py has no locking, so every (year, model cycle) store
+        # gets a single writer: one shard per cycle and year
+        blocks = {c: by_year(units) for c, units in per_cycle.items() if totals[c] > 0}
+    else:
+        limits = {c: max(1, sum(1 for u in units if u[2] == 'todo')) for c, units in per_cycle.items()}
+        blocks = {c: split(per_cycle[c], count) for c, count in allocate(totals, shards, limits).items()}
+
+    result = []
+    for cycle in sorted(blocks):
+        for block in blocks[cycle]:
+            first, last = block[0][0], block[-1][0]
+            args = list(options) + (['-r'] if resume else []) + ([] if cycle == 0 else ['-n'])
+            args += ['-c', str(cycle), f'{first:%Y-%m-%d}', f'{last:%Y-%m-%d}']
+            result.append({
+                'cycle': cycle, 'start': f'{first:%Y-%m-%d}', 'end': f'{last:%Y-%m-%d}', 'days': len(block),
+                'todo': sum(1 for u in block if u[2] == 'todo'),
+                'missing': sum(1 for u in block if u[2] == 'missing'),
+                'complete': sum(1 for u in block if u[2] == 'complete'),
+                'seconds': round(sum(u[1] for u in block)),
+                'args': args,
+            })
+    longest = max((s['seconds'] for s in result), default=0)
+    return {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'start': f'{start:%Y-%m-%d}', 'end': f'{end:%Y-%m-%d}',
+        'costs': {'cycle': {str(c): cycle_costs[c] for c in cycles}, 'mur': mur_cost},
+        'metrics': len(metrics),
+        'years': sorted({day.year for day in days(start, end)}),
+        'time_limit': min(MAX_TIME, longest * SAFETY + 3600),
+        'shards': result,
+    }
+
+
+def hms(seconds):
+    seconds = int(math.ceil(seconds))
+    return f'{seconds // 3600:02d}:{seconds % 3600 // 60:02d}:{seconds % 60:02d}'
+
+
+def show(the_plan, out=sys.stdout):
+    shards = the_plan['shards']
+    costs = the_plan['costs']
+    print(f'# {the_plan["start"]} - {the_plan["end"]}: {len(shards)} shard(s), (day, cycle) seconds '
+          + ', '.join(f'{c}: {s:g}' for c, s in costs['cycle'].items())
+          + f', MUR {costs["mur"]:g} (from {the_plan["metrics"]} metrics file(s))', file=out)
+    print(f'{"index":>5} {"cycle":>5} {"start":<10} {"end":<10} {"days":>4} {"todo":>4} {"missing":>7} '
+          f'{"complete":>8} {"estimate":>9}', file=out)
+    for i, s in enumerate(shards):
+        print(f'{i:>5} {s["cycle"]:>5} {s["start"]:<10} {s["end"]:<10} {s["days"]:>4} {s["todo"]:>4} {s["missing"]:>7} '
+              f'{s["complete"]:>8} {hms(s["seconds"]):>9}', file=out)
+    if shards:
+        total = sum(s['seconds'] for s in shards)
+        longest = max(s['seconds'] for s in shards)
+        print(f'# total {hms(total)}, longest shard {hms(longest)}, array task time limit {hms(the_plan["time_limit"])}',
+              file=out)
+
+
+def write_plan(the_plan, filename):
+    tmp = f'{filename}.tmp{os.getpid()}'
+    with open(tmp, 'w') as f:
+        json.dump(the_plan, f, indent=1)
+    os.replace(tmp, filename)
+
+
+def read_plan(filename):
+    with open(filename) as f:
+        return json.load(f)
+
+
+def submit_commands(the_plan, plan_file, max_running=None, tarballs=True, sbatch='hpc_maps_array.sbatch',
+                    tarball='hpc_tarball.sbatch'):
+    """sbatch command lines (lists) for the array and the dependent
+       per-year tarball jobs.  The tarball jobs' dependency is filled in
+       w/ the array's job ID, {jobid}
+    """
+    years = the_plan['years']
+    name = f'fogm{years[0] % 100:02d}' + (f'-{years[-1] % 100:02d}' if len(years) > 1 else '')
+    array = f'0-{len(the_plan["shards"]) - 1}' + (f'%{max_running}' if max_running else '')
+    commands = [['sbatch', '--parsable', '--job-name', name, f'--array={array}',
+                 f'--time={hms(the_plan["time_limit"])}', sbatch, os.path.abspath(plan_file)]]
+    for year in years if tarballs else ():
+        commands.append(['sbatch', '--job-name', f'fogtar{year % 100:02d}', '--dependency=afterok:{jobid}',
+                         tarball, str(year)])
+    return commands
+
+
+def submit(the_plan, plan_file, max_running=None, tarballs=True, dry_run=False):
+    """Submit the array and tarball jobs, returns the array's job ID"""
+    commands = submit_commands(the_plan, plan_file, max_running, tarballs)
+    jobid = 'JOBID'
+    for i, command in enumerate(commands):
+        command = [arg.format(jobid=jobid) for arg in command]
+        if dry_run:
+            print(' '.join(command))
+            continue
+        output = subprocess.run(command, check=True, stdout=subprocess.PIPE, universal_newlines=True).stdout
+        if i == 0:
+            # --parsable: "jobid[;cluster]"
+            jobid = output.strip().split(';')[0]
+            print(f'?Data processing job array {jobid} ({len(the_plan["shards"])} task(s))', file=sys.stderr)
+        else:
+            print(f'?{output.strip()} ({command[-1]} tarball, after job array {jobid})', file=sys.stderr)
+    return jobid
+
+
+def date_arg(text):
+    try:
+        return datetime.datetime.strptime(text, '%Y-%m-%d').date()
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'invalid date "{text}", expected YYYY-MM-DD')
+
+
+def plan_args(p):
+    p.add_argument('-n', '--shards', type=int, default=48, help='Maximum number of shards (array tasks, default: 48), '
+                   'at least the number of model cycles (-c) since a shard is one cycle\'s days '
+                   '(ignored w/ -C: one per year and model cycle)')
+    p.add_argument('-c', '--cycle', type=int, action='append', choices=CYCLES, help='Model cycle(s) (default: all)')
+    p.add_argument('-r', '--resume', action='store_true', help="Skip (day, cycle)s that are already complete (maps_input.sh -r)")
+    p.add_argument('-C', dest='options', action='append_const', const='-C', help='Consolidated output (maps_input.sh -C)')
+    p.add_argument('-g', dest='options', action='append_const', const='-g', help='maps_grib.py decoding (maps_input.sh -g)')
+    p.add_argument('-m', '--metrics', nargs='*', help='maps_input.sh metrics file(s) to measure costs w/ '
+                   '(default: $FOGHAT_LOG_DIR/maps_input-*.metrics.jsonl)')
+    p.add_argument('-o', '--output', help='Plan file to write (default: $FOGHAT_LOG_DIR/maps_shards-START-END.json)')
+    p.add_argument('start', type=date_arg, help='First day (YYYY-MM-DD)')
+    p.add_argument('end', type=date_arg, help='Last day (YYYY-MM-DD), inclusive')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Plan/submit MapS input processing as a Slurm job array')
+    subparsers = parser.add_subparsers(dest='command')
+    p = subparsers.add_parser('plan', help='Write and show a shard plan')
+    plan_args(p)
+    p = subparsers.add_parser('submit', help='Plan, then submit job array and tarball job(s)')
+    plan_args(p)
+    p.add_argument('--max-running', type=int, help='Run at most this many array tasks at once')
+    p.add_argument('--no-tarball', dest='tarball', action='store_false', help="Don't queue tarball job(s), e.g. for part of a year")
+    p.add_argument('--dry-run', action='store_true', help="Print sbatch commands, don't run them")
+    p = subparsers.add_parser('show', help='Show an existing plan')
+    p.add_argument('plan', help='Plan file')
+    p = subparsers.add_parser('shard', help="Print maps_input.sh arguments of a plan's shard")
+    p.add_argument('plan', help='Plan file')
+    p.add_argument('index', type=int, help='Shard index ($SLURM_ARRAY_TASK_ID)')
+    args = parser.parse_args()
+
+    try:
+        if args.command in ('plan', 'submit'):
+            if args.end < args.start:
+                parser.error(f'end date {args.end} is before start date {args.start}')
+            cycles = sorted(args.cycle or CYCLES)
+            if args.shards < len(cycles) and '-C' not in (args.options or ()):
+                # A shard is a run of days of one model cycle
+                parser.error(f'need at least one shard per model cycle ({len(cycles)})')
+            metrics = args.metrics
+            if metrics is None:
+                metrics = sorted(glob.glob(os.path.join(LOG_DIR, 'maps_input-*.metrics.jsonl')))
+            the_plan = plan(args.start, args.end, args.shards, metrics, cycles,
+                            args.resume, sorted(set(args.options or ())))
+            output = args.output or os.path.join(LOG_DIR, f'maps_shards-{args.start:%Y%m%d}-{args.end:%Y%m%d}.json')
+            show(the_plan, sys.stderr if args.command == 'submit' else sys.stdout)
+            if not the_plan['shards']:
+                print('?nothing to do', file=sys.stderr)
+                sys.exit(0)
+            write_plan(the_plan, output)
+            print(f'?plan written to {output}', file=sys.stderr)
+            if args.command == 'submit':
+                submit(the_plan, output, args.max_running, args.tarball, args.dry_run)
+        elif args.command == 'show':
+            show(read_plan(args.plan))
+        elif args.command == 'shard':
+            shards = read_plan(args.plan)['shards']
+            if not 0 <= args.index < len(shards):
+                print(f'?no shard {args.index} in {args.plan} ({len(shards)} shard(s))', file=sys.stderr)
+                sys.exit(1)
+            print(' '.join(shards[args.index]['args']))
+        else:
+            parser.print_help()
+            sys.exit(2)
+    except (OSError, ValueError, KeyError, subprocess.CalledProcessError) as err:
+        print(f'?{args.command} failed: {err}', file=sys.stderr)
+        sys.exit(1)
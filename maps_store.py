@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+
+"""
+Consolidated MapS input store: every forecast hour of a (year, model
+cycle) in one compressed, chunked NetCDF4 file (maps_input.sh -C)
+instead of ~15k small maps_YYYYMMDD_CC00_0HH_input.nc files.
+
+Each variable of the forecast hour files gets two leading dimensions,
+cycle_time (unlimited, model cycle/analysis time) and forecast_hour
+(0-36), followed by its own spatial dimensions, e.g. TMP_975mb(cycle_time,
+forecast_hour, y, x) and Q_975mb(cycle_time, forecast_hour, x, y), so
+values are exactly as in the forecast hour files.  time (valid time) and
+DateVal become (cycle_time, forecast_hour), latitude and longitude are
+stored once.  A chunk is one forecast hour's grid (or chunk_hours of
+them), what a training sample reads.
+
+cycle_time is in the order cycles were appended (maps_input.sh goes
+through days in order, a rerun overwrites a cycle in place), so use the
+coordinate values rather than assuming a sorted axis.  A forecast
+hour's time is written after its other variables, so a valid (not
+masked) time means the hour is complete.
+
+Usage: maps_store.py append STORE FILE...
+       maps_store.py check STORE YYYYMMDDCC
+"""
+
+import argparse
+import calendar
+import os
+import re
+import sys
+import time
+from netCDF4 import Dataset
+import numpy as np
+
+FORECAST_HOURS = 37
+FILENAME_RE = re.compile(r'maps_(\d{8})_(\d{2})00_0(\d{2})_input\.nc$')
+CYCLE_RE = re.compile(r'^(\d{8})(\d{2})$')
+
+# Shared by all forecast hours, stored once
+GRID_VARIABLES = ('latitude', 'longitude')
+CYCLE_UNITS = 'seconds since 1970-01-01 00:00:00.0 0:00'
+
+
+def cycle_seconds(ymd, cycle):
+    """YYYYMMDD, model cycle hour → seconds since epoch"""
+    return calendar.timegm(time.strptime(f'{ymd}{int(cycle):02d}', '%Y%m%d%H'))
+
+
+def parse_filename(filename):
+    """maps_20190101_0600_012_input.nc → (cycle time, forecast hour)"""
+    match = FILENAME_RE.search(os.path.basename(filename))
+    if not match:
+        raise ValueError(f'unexpected MapS input filename "{filename}"')
+    ymd, cycle, hour = match.groups()
+    return cycle_seconds(ymd, cycle), int(hour)
+
+
+def create_store(filename, template, chunk_hours=1, complevel=4):
+    """Create an empty store w/ the variables, attributes of NetCDF file
+       template (a forecast hour file)
+    """
+    store = Dataset(filename, 'w', format='NETCDF4')
+    store.createDimension('cycle_time', None)
+    store.createDimension('forecast_hour', FORECAST_HOURS)
+    for name, dim in template.dimensions.items():
+        if name != 'time':
+            store.createDimension(name, dim.size)
+
+    cycle_time = store.createVariable('cycle_time', 'f8', ('cycle_time',))
+    cycle_time.setncatts({'units': CYCLE_UNITS, 'long_name': 'model cycle (analysis) time'})
+    hour = store.createVariable('forecast_hour', 'i4', ('forecast_hour',))
+    hour.setncatts({'units': 'hours', 'long_name': 'forecast hour'})
+    hour[:] = np.arange(FORECAST_HOURS)
+
+    for name, var in template.variables.items():
+        # Per file QA statistics (maps_derived.py) don't apply to the store
+        attrs = {k: var.getncattr(k) for k in var.ncattrs() if k != '_FillValue' and not k.startswith('qa_')}
+        fill_value = var.getncattr('_FillValue') if '_FillValue' in var.ncattrs() else None
+        if name in GRID_VARIABLES:
+            out = store.createVariable(name, var.datatype, var.dimensions, zlib=True, complevel=complevel)
+            out.setncatts(attrs)
+            out[:] = var[:]
+            continue
+        if var.dimensions[:1] != ('time',):
+            raise ValueError(f'variable {name} has no time dimension')
+        if name == 'time':
+            # Per file reference time is the cycle time now
+            attrs = {k: v for k, v in attrs.items() if not k.startswith('reference_')}
+        dims = ('cycle_time', 'forecast_hour') + var.dimensions[1:]
+        chunks = (1, chunk_hours) + tuple(template.dimensions[d].size for d in var.dimensions[1:])
+        out = store.createVariable(name, var.datatype, dims, zlib=True, complevel=complevel,
+                                   shuffle=True, chunksizes=chunks, fill_value=fill_value)
+        out.setncatts(attrs)
+
+    store.setncatts({k: template.getncattr(k) for k in template.ncattrs()})
+    return store
+
+
+def cycle_index(store, cycle_t):
+    """Index of cycle_t in the store's cycle_time axis, appended if new"""
+    cycle_time = store.variables['cycle_time']
+    times = cycle_time[:]
+    found = np.nonzero(np.ma.filled(times, np.nan) == cycle_t)[0]
+    if found.size:
+        return int(found[0])
+    cycle_time[len(times)] = cycle_t
+    return len(times)
+
+
+def append(store_filename, filenames, chunk_hours=1, complevel=4):
+    """Write forecast hour files into the store (created if need be).
+       Returns list of files that failed
+    """
+    failed = []
+    store = None
+    try:
+        for fn in filenames:
+            try:
+                cycle_t, hour = parse_filename(fn)
+                nc = Dataset(fn, 'r')
+            except (OSError, ValueError) as err:
+                print(f'?error when trying to read file "{fn}": {err}', file=sys.stderr)
+                failed.append(fn)
+                continue
+            try:
+                if store is None:
+                    if os.path.exists(store_filename):
+                        store = Dataset(store_filename, 'a')
+                    else:
+                        store = create_store(store_filename, nc, chunk_hours, complevel)
+                i = cycle_index(store, cycle_t)
+                # A valid time marks the hour complete (check()), so it's
+                # masked while the hour is (re)written and written last
+                store.variables['time'][i, hour] = np.ma.masked
+                for name, var in nc.variables.items():
+                    if name in GRID_VARIABLES or name == 'time':
+                        continue
+                    store.variables[name][i, hour] = var[0]
+                store.variables['time'][i, hour] = nc.variables['time'][0]
+            except (OSError, KeyError, IndexError, ValueError, RuntimeError) as err:
+                print(f'?error when trying to store file "{fn}": {err}', file=sys.stderr)
+                failed.append(fn)
+            finally:
+                nc.close()
+        if store is not None:
+            store.history = f'{time.ctime(time.time())}: {os.path.basename(sys.argv[0])} last updated'
+    finally:
+        if store is not None:
+            store.close()
+    return failed
+
+
+def complete_cycles(store_filename):
+    """Cycle times (seconds since epoch) w/ every forecast hour in the store"""
+    store = Dataset(store_filename, 'r')
+    try:
+        cycle_times = np.ma.filled(store.variables['cycle_time'][:], np.nan)
+        counts = np.ma.count(store.variables['time'][:len(cycle_times)], axis=1)
+    finally:
+        store.close()
+    return {int(t) for t, count in zip(cycle_times, counts) if not np.isnan(t) and count == FORECAST_HOURS}
+
+
+def check(store_filename, cycle):
+    """True if every forecast hour of cycle (YYYYMMDDCC) is in the store"""
+    match = CYCLE_RE.match(cycle)
+    if not match:
+        raise ValueError(f'expected YYYYMMDDCC, not "{cycle}"')
+    try:
+        return cycle_seconds(*match.groups()) in complete_cycles(store_filename)
+    except OSError:
+        return False
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Consolidated (year, model cycle) MapS input NetCDF4 store')
+    subparsers = parser.add_subparsers(dest='command')
+    p = subparsers.add_parser('append', help='Add forecast hour files to store (created if need be)')
+    p.add_argument('--chunk-hours', type=int, default=1, help='Forecast hours per chunk (default: 1)')
+    p.add_argument('--complevel', type=int, default=4, help='zlib compression level (default: 4)')
+    p.add_argument('store', help='Store NetCDF file')
+    p.add_argument('file', nargs='+', help='maps_YYYYMMDD_CC00_0HH_input.nc file(s)')
+    p = subparsers.add_parser('check', help='Exit 0 if store has all forecast hours of cycle, 1 otherwise')
+    p.add_argument('store', help='Store NetCDF file')
+    p.add_argument('cycle', help='Model cycle, YYYYMMDDCC')
+    args = parser.parse_args()
+
+    if args.command == 'append':
+        failed = append(args.store, args.file, args.chunk_hours, args.complevel)
+        sys.exit(1 if failed else 0)
+    elif args.command == 'check':
+        try:
+            sys.exit(0 if check(args.store, args.cycle) else 1)
+        except ValueError as err:
+            print(f'?{err}', file=sys.stderr)
+            sys.exit(2)
+    else:
+        parser.print_help()
+        sys.exit(2)
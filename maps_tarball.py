@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+
+"""
+Parallel, indexed replacement for `tar czf` + `cp` in hpc_tarball.sbatch.
+
+The tarball is a series of gzip members, one per day directory (and one
+per top level file), compressed by a pool of worker processes and
+written, in order, straight to the destination while an md5 checksum is
+calculated.  Concatenated gzip members are a valid gzip file and the tar
+segments inside them form a single tar archive, so `tar xzf` works as
+usual.  Sidecar files:
+
+    TARBALL.md5          md5sum -c compatible checksum
+    TARBALL.index.json   gzip member offsets/lengths, tar members and
+                         their offsets w/in each (uncompressed) member
+
+so one day can be pulled out w/o decompressing the whole archive:
+
+    maps_tarball.py extract fog-maps-input-2020.tgz 2020123
+
+E.g., cd $FOGHAT_INPUT_DIR && maps_tarball.py -o fog-maps-input-2020.tgz fog-maps/processing-notes-2020.txt fog-maps/2020
+"""
+
+import argparse
+import gzip
+import hashlib
+import io
+import json
+import os
+import sys
+import tarfile
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+# End of tar archive, two zero filled blocks
+END_OF_ARCHIVE = b'\0' * (2 * tarfile.BLOCKSIZE)
+
+
+def default_jobs():
+    """CPUs Slurm allocated to this task, otherwise 1.  Same as
+       maps_derived.default_jobs(), w/o importing netCDF4 and numpy
+    """
+    try:
+        return max(1, int(os.environ.get('SLURM_CPUS_PER_TASK', 1)))
+    except ValueError:
+        return 1
+
+
+def plan_members(paths):
+    """Group paths into gzip members: a file is its own member, a
+       directory is one member per subdirectory (day) and per file in it.
+       Returns list of (member name, [paths to add, non-recursively])
+    """
+    groups = []
+    for path in paths:
+        path = os.path.normpath(path)
+        if not os.path.isdir(path):
+            groups.append((os.path.basename(path), [path]))
+            continue
+        first = True
+        for entry in sorted(os.listdir(path)):
+            full = os.path.join(path, entry)
+            if os.path.isdir(full):
+                contents = [full] + sorted(os.path.join(dirpath, fn)
+                                           for dirpath, dirnames, filenames in os.walk(full)
+                                           for fn in dirnames + filenames)
+            else:
+                contents = [full]
+            # Directory entry itself goes w/ its first member
+            groups.append((entry, ([path] if first else []) + contents))
+            first = False
+        if first:
+            groups.append((os.path.basename(path), [path]))
+    return groups
+
+
+def compress_member(name, paths, compresslevel=6):
+    """Tar (w/o end of archive blocks) and gzip paths.  Returns (name,
+       compressed bytes, uncompressed size, [(tar member, offset, size)])
+    """
+    buf = io.BytesIO()
+    members = []
+    with gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=compresslevel) as gz:
+        # Not closed: that would add the end of archive blocks
+        tar = tarfile.TarFile(fileobj=gz, mode='w', format=tarfile.GNU_FORMAT)
+        for path in paths:
+            offset = tar.offset
+            tar.add(path, recursive=False)
+            members.append((path, offset, 0 if os.path.isdir(path) else os.path.getsize(path)))
+        size = tar.offset
+    return name, buf.getvalue(), size, members
+
+
+def _ordered_results(executor, groups, compresslevel, limit):
+    """Compressed members in order, w/ no more than limit in flight"""
+    pending = {}
+    next_i = 0
+    for i, (name, paths) in enumerate(groups):
+        pending[i] = executor.submit(compress_member, name, paths, compresslevel)
+        while len(pending) >= limit or (next_i in pending and pending[next_i].done()):
+            if not pending[next_i].done():
+                wait([pending[next_i]], return_when=FIRST_COMPLETED)
+            yield pending.pop(next_i).result()
+            next_i += 1
+    while pending:
+        yield pending.pop(next_i).result()
+        next_i += 1
+
+
+def create(output, paths, jobs=1, compresslevel=6):
+    """Write tarball output from paths, plus its .md5 and .index.json"""
+    start_t = time.perf_counter()
+    groups = plan_members(paths)
+    if jobs > 1:
+        executor = ProcessPoolExecutor(max_workers=jobs)
+        results = _ordered_results(executor, groups, compresslevel, 2 * jobs)
+    else:
+        executor = None
+        results = (compress_member(name, members, compresslevel) for name, members in groups)
+
+    md5 = hashlib.md5()
+    index = {'tarball': os.path.basename(output), 'members': []}
+    tmp = f'{output}.tmp{os.getpid()}'
+    offset = 0
+    try:
+        with open(tmp, 'wb') as f:
+            for name, data, size, members in results:
+                f.write(data)
+                md5.update(data)
+                index['members'].append({'name': name, 'offset': offset, 'length': len(data),
+                                         'size': size, 'tar_members': members})
+                offset += len(data)
+                print(f'?{name}: {size} → {len(data)} bytes', file=sys.stderr)
+            # Last gzip member just ends the tar archive
+            data = gzip.compress(END_OF_ARCHIVE, compresslevel)
+            f.write(data)
+            md5.update(data)
+        os.replace(tmp, output)
+    finally:
+        if executor:
+            executor.shutdown()
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+    index['md5'] = md5.hexdigest()
+    with open(output + '.index.json', 'w') as f:
+        json.dump(index, f, indent=1)
+    with open(output + '.md5', 'w') as f:
+        f.write(f'{index["md5"]}  {os.path.basename(output)}\n')
+    delta_t = time.perf_counter() - start_t
+    print(f'?{len(groups)} member(s), {offset + len(data)} bytes written to {output} in {delta_t:.1f} seconds ({jobs} job(s))', file=sys.stderr)
+
+
+def extract(tarball, names, directory='.'):
+    """Extract the gzip member(s) called names (e.g. day directory
+       YYYYJJJ) using the index, w/o decompressing anything else
+    """
+    with open(tarball + '.index.json') as f:
+        index = json.load(f)
+    members = {m['name']: m for m in index['members']}
+    missing = [n for n in names if n not in members]
+    if missing:
+        raise KeyError(f'not in {tarball}: {" ".join(missing)}')
+    with open(tarball, 'rb') as f:
+        for name in names:
+            f.seek(members[name]['offset'])
+            data = gzip.decompress(f.read(members[name]['length'])) + END_OF_ARCHIVE
+            with tarfile.open(fileobj=io.BytesIO(data), mode='r:') as tar:
+                tar.extractall(directory)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Create (or extract from) an indexed, parallel compressed tarball')
+    subparsers = parser.add_subparsers(dest='command')
+    p = subparsers.add_parser('create', help='Create tarball (default command)')
+    p.add_argument('-o', '--output', required=True, help='Tarball to write (.tgz)')
+    p.add_argument('-j', '--jobs', type=int, default=default_jobs(), help='Number of compression processes (default: $SLURM_CPUS_PER_TASK or 1)')
+    p.add_argument('-l', '--level', type=int, default=6, help='gzip compression level (default: 6, like gzip)')
+    p.add_argument('path', nargs='+', help='Files and (year) directories to include, relative paths')
+    p = subparsers.add_parser('extract', help='Extract member(s), e.g. day directories, using the index')
+    p.add_argument('-d', '--directory', default='.', help='Extract into this directory (default: current directory)')
+    p.add_argument('tarball')
+    p.add_argument('name', nargs='+', help='Member name(s), e.g. 2020123')
+    argv = sys.argv[1:]
+    if argv and argv[0] not in ('create', 'extract', '-h', '--help'):
+        argv = ['create'] + argv
+    args = parser.parse_args(argv)
+
+    try:
+        if args.command == 'extract':
+            extract(args.tarball, args.name, args.directory)
+        elif args.command == 'create':
+            create(args.output, args.path, max(1, args.jobs), args.level)
+        else:
+            parser.print_help()
+            sys.exit(2)
+    except (OSError, KeyError, ValueError, tarfile.TarError) as err:
+        print(f'?{args.command} failed: {err}', file=sys.stderr)
+        sys.exit(1)
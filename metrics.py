@@ -0,0 +1,82 @@
+"""
+Per-stage resource usage records for the MapS input pipeline, one JSON
+object per line appended to $FOGHAT_METRICS_FILE (if set).
+
+maps_input.sh wraps its shell stages w/ /usr/bin/time -f, writing the
+same fields; python stages use Stage below.  metrics_report.py
+summarizes them.  Fields:
+
+    t             start time (seconds since epoch)
+    stage         e.g. tar, clip, reorder, netcdf, derived, ncks, copy
+    file          file (or tarfile) processed
+    job           maps_input.sh process ID: its PID, prefixed w/
+                  JOBID_TASKID- in Slurm array tasks
+    wall          elapsed seconds
+    user, sys     CPU seconds
+    max_rss_kb    peak resident set size (KiB), for python stages the
+                  worker process's peak so far
+    read_blocks, write_blocks   file system inputs/outputs (512 byte blocks)
+    status        exit status (0 OK)
+"""
+
+import json
+import os
+import resource
+import time
+
+METRICS_ENV = 'FOGHAT_METRICS_FILE'
+BLOCK_SIZE = 512
+
+
+def write_record(record, filename=None):
+    """Append record (dict) as a single JSON line to the metrics file.
+       Single O_APPEND write, so concurrent writers don't interleave
+    """
+    filename = filename or os.environ.get(METRICS_ENV)
+    if not filename:
+        return
+    line = (json.dumps(record) + '\n').encode()
+    fd = os.open(filename, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, line)
+    finally:
+        os.close(fd)
+
+
+class Stage:
+    """Context manager recording resource usage of a python stage, e.g.
+
+           with metrics.Stage('derived', filename) as stage:
+               stage.status = 0 if process_file(filename) else 1
+    """
+
+    def __init__(self, name, filename):
+        self.name = name
+        self.filename = filename
+        self.status = 0
+
+    def __enter__(self):
+        self.t = time.time()
+        self.start_t = time.perf_counter()
+        self.usage = resource.getrusage(resource.RUSAGE_SELF)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.status = 1
+        wall = time.perf_counter() - self.start_t
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        write_record({
+            't': int(self.t),
+            'stage': self.name,
+            'file': os.path.basename(self.filename),
+            'job': os.environ.get('FOGHAT_JOB_ID', str(os.getpid())),
+            'wall': round(wall, 3),
+            'user': round(usage.ru_utime - self.usage.ru_utime, 3),
+            'sys': round(usage.ru_stime - self.usage.ru_stime, 3),
+            'max_rss_kb': usage.ru_maxrss,
+            'read_blocks': usage.ru_inblock - self.usage.ru_inblock,
+            'write_blocks': usage.ru_oublock - self.usage.ru_oublock,
+            'status': self.status,
+        })
+        return False
@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+
+"""
+Summarize MapS input pipeline per-stage metrics (maps_input-*.metrics.jsonl,
+see metrics.py) for HPC analysis/troubleshooting: per-stage totals, share
+of wall time, percentiles, CPU, I/O and peak memory, plus a histogram and
+mean/stddev of (day, model cycle) processing times (what processing-times.sh
+used to scrape out of the logs).
+
+Older maps_input-*.log files (no metrics) are accepted too, only the
+per (day, cycle) processing times are available from them.
+
+E.g., metrics_report.py $FOGHAT_LOG_DIR/maps_input-2020*.metrics.jsonl
+"""
+
+import argparse
+import json
+import re
+import sys
+
+import numpy as np
+
+from metrics import BLOCK_SIZE
+
+# "?37 forecast hour files processed from .../nam_218_2019010100.g2.tar in 212 seconds"
+CYCLE_RE = re.compile(r'forecast hour files processed from (\S+) in (\d+) seconds$')
+
+PERCENTILES = (50, 90, 99)
+
+
+def read_records(filenames):
+    """Metrics records from JSON lines or (older) log files.  Lines that
+       aren't records (e.g. /usr/bin/time's "Command exited w/ non-zero
+       status" line) are skipped
+    """
+    records = []
+    for fn in filenames:
+        with open(fn) as f:
+            for line in f:
+                line = line.strip()
+                if line.startswith('{'):
+                    try:
+                        records.append(json.loads(line))
+                    except ValueError:
+                        print(f'?skipping malformed record in {fn}: {line}', file=sys.stderr)
+                    continue
+                match = CYCLE_RE.search(line)
+                if match:
+                    records.append({'stage': 'cycle', 'file': match.group(1), 'wall': float(match.group(2))})
+    return records
+
+
+def by_stage(records):
+    """{stage: [records]} in order of first appearance"""
+    stages = {}
+    for r in records:
+        stages.setdefault(r.get('stage', '?'), []).append(r)
+    return stages
+
+
+def column(records, field):
+    return np.array([r[field] for r in records if r.get(field) is not None], dtype=np.float64)
+
+
+def stage_table(stages):
+    """Per-stage breakdown.  cycle records (whole (day, cycle) times) are
+       left out of the share of wall time since they include the others
+    """
+    total_wall = sum(column(rs, 'wall').sum() for stage, rs in stages.items() if stage != 'cycle')
+    header = (f'{"stage":<10} {"n":>6} {"fail":>5} {"wall s":>10} {"%wall":>6} {"mean":>8} '
+              + ' '.join(f'{"p" + str(p):>8}' for p in PERCENTILES)
+              + f' {"max":>8} {"cpu s":>10} {"cpu/wall":>8} {"read MB":>9} {"write MB":>9} {"rss MB":>8}')
+    lines = [header, '-' * len(header)]
+    for stage, rs in stages.items():
+        wall = column(rs, 'wall')
+        if wall.size == 0:
+            continue
+        cpu = column(rs, 'user').sum() + column(rs, 'sys').sum()
+        failed = sum(1 for r in rs if r.get('status'))
+        share = 100 * wall.sum() / total_wall if stage != 'cycle' and total_wall else float('nan')
+        read_mb = column(rs, 'read_blocks').sum() * BLOCK_SIZE / 2**20
+        write_mb = column(rs, 'write_blocks').sum() * BLOCK_SIZE / 2**20
+        rss = column(rs, 'max_rss_kb')
+        rss_mb = rss.max() / 1024 if rss.size else float('nan')
+        ratio = cpu / wall.sum() if wall.sum() else float('nan')
+        lines.append(f'{stage:<10} {wall.size:>6} {failed:>5} {wall.sum():>10.1f} {share:>6.1f} {wall.mean():>8.2f} '
+                     + ' '.join(f'{v:>8.2f}' for v in np.percentile(wall, PERCENTILES))
+                     + f' {wall.max():>8.2f} {cpu:>10.1f} {ratio:>8.2f} {read_mb:>9.1f} {write_mb:>9.1f} {rss_mb:>8.1f}')
+    return '\n'.join(lines)
+
+
+def histogram(values, binsize):
+    """Text histogram w/ bins that cover all values, like gsl-histogram"""
+    lower = values.min() - values.min() % binsize
+    upper = values.max() + (binsize - values.max() % binsize)
+    bins = int(round((upper - lower) / binsize))
+    counts, edges = np.histogram(values, bins=bins, range=(lower, upper))
+    width = max(counts.max(), 1)
+    lines = [f'Saw min={values.min():g}, max={values.max():g}, want binsize={binsize:g} → lower={lower:g}, upper={upper:g}, bins={bins}']
+    for count, lo, hi in zip(counts, edges, edges[1:]):
+        lines.append(f'{lo:>8g} {hi:>8g} {count:>6d} {"#" * int(round(50 * count / width))}')
+    return '\n'.join(lines)
+
+
+def report(records, binsize=20, stage='cycle'):
+    stages = by_stage(records)
+    print(f'# {len(records)} record(s)')
+    if any(s != 'cycle' for s in stages):
+        print('## Per-stage breakdown (seconds)')
+        print(stage_table(stages))
+        print('')
+
+    values = column(stages.get(stage, []), 'wall')
+    if values.size == 0:
+        print(f'?no {stage} records', file=sys.stderr)
+        return
+    print(f'## {stage} processing times ({values.size} total)')
+    print(histogram(values, binsize))
+    print('')
+    print(f'mean {values.mean():g}  stddev {values.std():g}  '
+          + '  '.join(f'p{p} {v:g}' for p, v in zip(PERCENTILES, np.percentile(values, PERCENTILES))))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Summarize MapS input pipeline per-stage metrics')
+    parser.add_argument('file', nargs='+', help='maps_input-*.metrics.jsonl (or older maps_input-*.log) file(s)')
+    parser.add_argument('-b', '--binsize', type=float, default=20, help='Histogram bin size in seconds (default: 20)')
+    parser.add_argument('-s', '--stage', default='cycle', help='Stage to histogram (default: cycle, i.e. whole (day, model cycle))')
+    args = parser.parse_args()
+    try:
+        records = read_records(args.file)
+    except OSError as err:
+        print(f'?{err}', file=sys.stderr)
+        sys.exit(1)
+    report(records, args.binsize, args.stage)
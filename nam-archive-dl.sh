@@ -5,20 +5,21 @@
 if [[ -z "$FOGHAT_BASE" || -z "$FOGHAT_LOG_DIR" || -z "$FOGHAT_ARCHIVE_DIR" ]]
 then
     echo "?FOGHAT Environment variables not defined, see etc/sample-environment.sh" 1>&2
-    exit
+    exit 1
 fi
 
 usage () {
     local zero=`basename $0`
-    echo "$zero <email_id> <order_id> <url>"
-    exit
+    echo "$zero <email_id> <order_id> <url>" 1>&2
+    exit 2
 }
 
+# Non-zero exit status: jobq.py retries the job (w/ backoff)
 restart_job () {
     local msg=$1
     echo -e "${msg}.  Exiting early so job can be restarted/requeued." >>$LOG_FILE
     local zero=`basename $0`
-    echo -e "To restart job, run:\n\n    $zero $EMAIL_ID $ORDER_ID $URL\n" >>$LOG_FILE
+    echo -e "jobq.py retries it, or to restart job by hand, run:\n\n    $zero $EMAIL_ID $ORDER_ID $URL\n" >>$LOG_FILE
     exit 1
 }
 
@@ -43,12 +44,12 @@ NOW=`date`
 echo "# $EMAIL_ID, $ORDER_ID, $URL" >>$LOG_FILE
 echo "Downloading files from $URL at $NOW" >>$LOG_FILE
 
-# See https://www.ncdc.noaa.gov/has/has.orderguide for suggestions
-# I'd try to reject 'index.html?C=*' variants but wget on gridftp (v1.12) is too old to support --reject-regex :(
-WGET_START=`date -u '+%s'`
-/usr/bin/wget -erobots=off --reject 'robots.txt' -nv --no-parent -r --timestamping --append-output=$LOG_FILE -nd --directory-prefix=$DOWNLOAD_TARGET  $URL
-WGET_END=`date -u '+%s'`
-DELTA=$((WGET_END - WGET_START))
+# Saves the order's index.html and (concurrently, resuming partial files) the tar files listed in it
+FOGHAT_EXE_DIR=${FOGHAT_EXE_DIR:-`dirname $0`}
+DL_START=`date -u '+%s'`
+$FOGHAT_EXE_DIR/download_urls.py --index --jobs ${FOGHAT_DOWNLOAD_JOBS:-4} --directory $DOWNLOAD_TARGET $URL 2>>$LOG_FILE
+DL_END=`date -u '+%s'`
+DELTA=$((DL_END - DL_START))
 echo "?downloaded files in $URL in $DELTA seconds" >>$LOG_FILE
 
 # Any of these conditions likely means there was a problem w/ the download
@@ -69,8 +70,8 @@ fi
 # Cleanup temporary download directory
 pushd $PWD >/dev/null
 cd $DOWNLOAD_TARGET
-# Remove index.html?C=*
-rm 'index.html?'*
+# Remove index.html?C=* (wget used to download these)
+rm -f 'index.html?'* .download_manifest.json
 
 # Strip file list from index.html  [assuming it was downloaded] and archive both files
 TXT_FN=file_list_${ORDER_ID}.txt
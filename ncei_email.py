@@ -16,6 +16,7 @@ import os
 import sys
 import time
 import platform
+import sqlite3
 import subprocess
 from subprocess import CalledProcessError, SubprocessError
 import argparse
@@ -33,6 +34,13 @@ env = Env(
 )
 # I don't know how to specify a default for primitive types in the above format
 logger_openfile = env.bool('FOGHAT_LOGGER2FILE', default=False) # Note 5
+# Non-standard port and/or no SSL, e.g. for a local IMAP server when testing
+imap_port = env.int('FOGHAT_IMAP_PORT', default=0) or None
+imap_ssl = env.bool('FOGHAT_IMAP_SSL', default=True)
+# Local store of orders and their states (Note 6)
+orders_db = env.str('FOGHAT_ORDERS_DB', default=os.path.join(os.environ.get('FOGHAT_BASE', '.'), 'var', 'ncei_orders.sqlite'))
+
+NOAA_FROM = 'noreply@noaa.gov'
 
 # Crude sanity check (envfile optional)
 for v in ('FOGHAT_IMAP_HOST', 'FOGHAT_IMAP_USER', 'FOGHAT_IMAP_PASSWD', 'FOGHAT_LOG_DIR'):
@@ -66,10 +74,11 @@ logger.setLevel(logging.DEBUG)  # XXX  REMOVE
 
       Using regex b/c lxml library requires Python 3.5+ :(
 
-  2.  Task Spooler <https://vicerveza.homeunix.net/~viric/soft/ts/>
-      inherits any local environment settings when the job is queued.
-      So we don't need to load the foghat environment variables or the
-      python virtual environment--that's already done.
+  2.  Orders are queued w/ jobq.py, whose scheduler (jobq.py run, from
+      cron) runs jobs w/ its own environment, so that's where the foghat
+      environment variables and python virtual environment are loaded.
+      The nam-order chain queues maps_input.sh processing of the days in
+      the order once its download is done
 
   3.  Can't use subprocess.run() b/c Python 3.4
 
@@ -81,8 +90,141 @@ logger.setLevel(logging.DEBUG)  # XXX  REMOVE
       slice range ([1:2] → [1:3] or somesuch) _and_ adjust the slice range
       of the parse_args() in the dispatched function (check or move).
       Easier to make it mandatory
+
+  6.  Orders are tracked in a SQLite database, order ID → state (found:
+      download URL known but not queued yet, queued, then the folder
+      name the email is moved to, e.g. processed).  Its mailbox table
+      keeps INBOX's UIDVALIDITY and UIDNEXT as of the last check, so a
+      check only fetches messages that arrived since (a full search if
+      UIDVALIDITY changed) and only fetches bodies of orders it hasn't
+      seen.  An order is claimed (found → queued) before it's enqueued,
+      so overlapping checks can't enqueue it twice.  UIDNEXT is saved
+      only after the orders are enqueued, so a check that dies before
+      then looks at the same messages again next time
 """
 
+
+class OrderStore:
+    """SQLite store of AIRS orders and IMAP sync state.  W/ dry_run
+       nothing is committed
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS orders (
+            order_id TEXT PRIMARY KEY,
+            uid INTEGER,
+            uidvalidity INTEGER,
+            url TEXT,
+            state TEXT NOT NULL,
+            job_id TEXT,
+            received TEXT,
+            updated TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS mailbox (
+            folder TEXT PRIMARY KEY,
+            uidvalidity INTEGER NOT NULL,
+            uidnext INTEGER NOT NULL
+        );
+    """
+
+    def __init__(self, filename, dry_run=False):
+        os.makedirs(os.path.dirname(os.path.abspath(filename)), exist_ok=True)
+        self.db = sqlite3.connect(filename, timeout=60)
+        self.db.row_factory = sqlite3.Row
+        self.db.executescript(self.SCHEMA)
+        self.dry_run = dry_run
+
+    def commit(self):
+        if not self.dry_run:
+            self.db.commit()
+
+    def close(self):
+        # Rolls back anything uncommitted (i.e. w/ dry_run)
+        self.db.close()
+
+    def sync_state(self, folder):
+        """(UIDVALIDITY, UIDNEXT) of folder as of the last check, or None"""
+        row = self.db.execute('SELECT uidvalidity, uidnext FROM mailbox WHERE folder = ?', (folder,)).fetchone()
+        return (row['uidvalidity'], row['uidnext']) if row else None
+
+    def set_sync_state(self, folder, uidvalidity, uidnext):
+        self.db.execute('INSERT OR REPLACE INTO mailbox (folder, uidvalidity, uidnext) VALUES (?, ?, ?)',
+                        (folder, uidvalidity, uidnext))
+        self.commit()
+
+    def get(self, order_id):
+        return self.db.execute('SELECT * FROM orders WHERE order_id = ?', (order_id,)).fetchone()
+
+    def orders(self, state=None):
+        if state is None:
+            return self.db.execute('SELECT * FROM orders ORDER BY updated').fetchall()
+        return self.db.execute('SELECT * FROM orders WHERE state = ? ORDER BY updated', (state,)).fetchall()
+
+    def add(self, order_id, uid, uidvalidity, url, received):
+        self.db.execute('INSERT OR IGNORE INTO orders (order_id, uid, uidvalidity, url, state, received, updated) '
+                        'VALUES (?, ?, ?, ?, ?, ?, ?)', (order_id, uid, uidvalidity, url, 'found', received, now()))
+        self.commit()
+
+    def claim(self, order_id):
+        """Atomically mark order as queued, False if it isn't found (new)"""
+        cur = self.db.execute("UPDATE orders SET state = 'queued', updated = ? WHERE order_id = ? AND state = 'found'",
+                              (now(), order_id))
+        self.commit()
+        return cur.rowcount == 1
+
+    def update(self, order_id, **values):
+        values['updated'] = now()
+        columns = sorted(values)
+        self.db.execute('UPDATE orders SET {} WHERE order_id = ?'.format(', '.join('{} = ?'.format(c) for c in columns)),
+                        [values[c] for c in columns] + [order_id])
+        self.commit()
+
+
+def now():
+    return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+
+
+def download_url(message_data):
+    """Web download URL in an AIRS order email, None unless there's one"""
+    email_message = email.message_from_bytes(message_data)
+    urls = []
+    for part in email_message.walk():
+        mt = part.get_content_type()
+        if mt == 'text/plain' or mt == 'text/html':
+            txt = part.get_payload()
+            # Note 1
+            matches = re.findall(r'"(https://[^"]*/pub/has/[^"]+)"', txt)
+            urls.extend(matches)
+    # Make sure we only found _one_ download link
+    if len(urls) != 1:
+        logger.debug(urls)
+        return None
+    return urls[0]
+
+
+def new_messages(server, store, folder='INBOX'):
+    """UIDs of messages from NOAA that arrived in folder since the last
+       check (all of them if UIDVALIDITY changed).  Returns (UIDs,
+       UIDVALIDITY, UIDNEXT)
+    """
+    select_info = server.select_folder(folder)
+    uidvalidity = select_info[b'UIDVALIDITY']
+    last = store.sync_state(folder)
+    if last and last[0] == uidvalidity:
+        # n:* always matches the last message, even if its UID is < n
+        messages = [uid for uid in server.search(['UID', '{}:*'.format(last[1]), 'FROM', NOAA_FROM]) if uid >= last[1]]
+        uidnext = last[1]
+    else:
+        if last:
+            logger.warning('{} UIDVALIDITY changed ({} → {}), searching all messages'.format(folder, last[0], uidvalidity))
+        messages = server.search(['FROM', NOAA_FROM])
+        uidnext = 1
+    # Not every server reports UIDNEXT
+    uidnext = max([uidnext, select_info.get(b'UIDNEXT', 0)] + [uid + 1 for uid in messages])
+    logger.info('{} messages in {}, {} new from NOAA'.format(select_info[b'EXISTS'], folder, len(messages)))
+    return messages, uidvalidity, uidnext
+
+
 def check(server):
     """Check inbox for new emails from NOAA [AIRS Orders] and queue them for processing"""
     uid2order = {}                      # email message id → AIRS order details
@@ -91,77 +233,82 @@ def check(server):
     parser = argparse.ArgumentParser(prog='{} check'.format(exe),description='Check inbox for new emails from NOAA [AIRS Orders] and queue for processing')
     parser.add_argument('--dry-run',action='store_true',help="Don't actually begin processing, just say what would be done")
     args = parser.parse_args(sys.argv[2:])
-    select_info = server.select_folder('INBOX')
-    messages = server.search(['FROM','noreply@noaa.gov'])
-    logger.info('{} messages in INBOX, {} from NOAA'.format(select_info[b'EXISTS'], len(messages)))
-    if len(messages) == 0:
-        logger.info('No order complete [data ready] messages, quitting')
-        return
+    store = OrderStore(orders_db, args.dry_run)
+    messages, uidvalidity, uidnext = new_messages(server, store)
 
     # Filter messages from NOAA
-    for uid, data in server.fetch(messages, ['ENVELOPE']).items():
-        envelope = data[b'ENVELOPE']
-        subject = envelope.subject.decode()
-        from_addr = '{}'.format(envelope.from_[0])
-        logger.info('ID #{} {} "{}", received {} CST/CDT'.format(uid, from_addr, subject, envelope.date))
-        # Search for order ID in email subject
-        m = re.search(r'Order (\w+) Complete', subject)
-        if not m:
-            logger.error("Can't locate order ID in email #{}'s subject \"{}\", skipping".format(uid, subject))
+    move_uids = []                      # already queued, but still in INBOX
+    if messages:
+        for uid, data in server.fetch(messages, ['ENVELOPE']).items():
+            envelope = data[b'ENVELOPE']
+            subject = envelope.subject.decode()
+            from_addr = '{}'.format(envelope.from_[0])
+            logger.info('ID #{} {} "{}", received {} CST/CDT'.format(uid, from_addr, subject, envelope.date))
+            # Search for order ID in email subject
+            m = re.search(r'Order (\w+) Complete', subject)
+            if not m:
+                logger.error("Can't locate order ID in email #{}'s subject \"{}\", skipping".format(uid, subject))
+                continue
+            order_id = m.group(1)
+            known = store.get(order_id)
+            if known:
+                logger.info('Order ID {} already {}, not queueing it again'.format(order_id, known['state']))
+                if known['state'] == 'queued':
+                    move_uids.append(uid)
+                continue
+            uid2order[uid] = { 'order_id': order_id, 'from': from_addr, 'received': str(envelope.date) }
+
+    # Only fetch bodies of orders we haven't seen
+    if uid2order:
+        for uid, message_data in server.fetch(list(uid2order.keys()), 'RFC822').items():
+            order_id = uid2order[uid]['order_id']
+            logger.info('Opening email ID #{} {} (order ID {})'.format(uid, uid2order[uid]['from'], order_id))
+            url = download_url(message_data[b'RFC822'])
+            if url is None:
+                logger.error("Unexpected number of matching web download URLs in email for order ID {}, skipping".format(order_id))
+                continue
+            store.add(order_id, uid, uidvalidity, url, uid2order[uid]['received'])
+
+    # Enqueue new orders, and any that couldn't be enqueued last time
+    queued_uids = []
+    for order in store.orders('found'):
+        order_id = order['order_id']
+        # [jobq] script.py uid  order_id  url
+        cmd = ['./jobq.py','add','--label','order:{}'.format(order_id),'--chain','nam-order',
+               './nam-archive-dl.sh',str(order['uid']),order_id,order['url']]
+        if args.dry_run:
+            logger.info('Would run command « {} »'.format(' '.join(cmd)))
+            queued_uids.append(order['uid'])
             continue
-        order_id = m.group(1)
-        uid2order[uid] = { 'order_id': order_id, 'from': from_addr }
-
-    airs_uids = uid2order.keys()
-    for uid, message_data in server.fetch(airs_uids, 'RFC822').items():
-        email_message = email.message_from_bytes(message_data[b'RFC822'])
-        logger.info('Opening email ID #{} {} "{}"'.format(uid, uid2order[uid]['from'], email_message.get('Subject')))
-        urls = []
-        for part in email_message.walk():
-            mt = part.get_content_type()
-            if mt == 'text/plain' or mt == 'text/html':
-                txt = part.get_payload()
-                # Note 1
-                matches = re.findall(r'"(https://[^"]*/pub/has/[^"]+)"', txt)
-                urls.extend(matches)
-        # Make sure we only found _one_ download link
-        if len(urls) != 1:
-            logger.error("Unexpected number {} of matching web download URLs in email for order ID {}, skipping".format(len(urls), order_id))
-            logger.debug(urls)
+        if not store.claim(order_id):
+            logger.info('Order ID {} was queued by another process, skipping'.format(order_id))
             continue
-        uid2order[uid]['url'] = urls[0]
-    #print(uid2order)  # XXX  REMOVE
-
-    # TODO Check local store of queued jobs and filter pending/to be queued
-    queue_orders = uid2order
-
-    # TODO  Check local store for jobs that can be removed (b/c email has been Archived)
-
-    # Enqueue new orders
-    for uid in queue_orders.keys():
-        order_id = queue_orders[uid]['order_id']
-        # [TaskSpooler] script.py uid  order_id  url
-        cmd = ['ts/ts','./nam-archive-dl.sh',str(uid),order_id,queue_orders[uid]['url']]
         try:
-            if args.dry_run:
-                logger.info('Would run command « {} »'.format(' '.join(cmd)))
-                jobid = -1
-            else:
-                # Note 3
-                jobid = subprocess.check_output(cmd).decode().rstrip()
-                pass
-        except (CalledProcessError, SubprocessError) as err:
-            logger.error('Error [return] code {} returned when trying to run subprocess {}'.format(err.returncode,' '.join(cmd)))
-            logger.error(err.output)
-        logger.info('Enqueued download of order ID {} as Task Spooler job #{}'.format(order_id,jobid))
+            # Note 3
+            jobid = subprocess.check_output(cmd).decode().rstrip()
+        except (CalledProcessError, SubprocessError, OSError) as err:
+            logger.error('Error when trying to run subprocess {}: {}'.format(' '.join(cmd), err))
+            logger.error(getattr(err, 'output', None))
+            # Try again next time
+            store.update(order_id, state='found')
+            continue
+        store.update(order_id, job_id=jobid)
+        logger.info('Enqueued download of order ID {} as jobq job #{}'.format(order_id,jobid))
+        if order['uidvalidity'] == uidvalidity:
+            queued_uids.append(order['uid'])
+    # Only now that new orders are claimed and enqueued (or left found, to
+    # retry) is it safe to skip their messages next time
+    store.set_sync_state('INBOX', uidvalidity, uidnext)
 
     # Move queued email jobs to different folder (state change)
-    if not args.dry_run:
-        server.move(messages=queue_orders.keys(), folder='Queued')
-    uids_str = ','.join([ str(k) for k in queue_orders.keys() ])
-    logger.info('Moved email(s) w/ UID(s) [{}] to Queued folder'.format(uids_str))
-
-    # TODO Write out updated queued jobs store
+    queued_uids.extend(move_uids)
+    if not queued_uids:
+        logger.info('No new order complete [data ready] messages, quitting')
+    elif not args.dry_run:
+        server.move(messages=queued_uids, folder='Queued')
+        uids_str = ','.join([ str(k) for k in queued_uids ])
+        logger.info('Moved email(s) w/ UID(s) [{}] to Queued folder'.format(uids_str))
+    store.close()
 
 def move(server):
     parser = argparse.ArgumentParser(description='Move specified email (by Order ID) to specified folder')
@@ -178,6 +325,19 @@ def move(server):
         return
     logger.info("Moving email w/ Order ID {} (UID #{}) into folder {}".format(args.order, uids[0], args.destination))
     server.move(messages=uids, folder=args.destination)
+    store = OrderStore(orders_db)
+    if store.get(args.order):
+        store.update(args.order, state=args.destination.lower())
+    store.close()
+
+def orders(server):
+    parser = argparse.ArgumentParser(description='List orders (and their states) in the local order store')
+    parser.add_argument('-s', '--state', help='Only orders in this state, e.g. found, queued, processed')
+    args = parser.parse_args(sys.argv[2:])
+    store = OrderStore(orders_db, dry_run=True)
+    for order in store.orders(args.state):
+        print('{}\t{}\t{}\t{}\t{}'.format(order['order_id'], order['state'], order['job_id'] or '-', order['updated'], order['url']))
+    store.close()
 
 def main():
 
@@ -189,6 +349,7 @@ def main():
 Where command is one of:
    check    Check email for new AIRS Orders to download
    move     Move email to a different [email system] folder
+   orders   List orders in the local order store
 ''')
     parser.add_argument('command', help='Subcommand to run')
     # Note 5
@@ -199,8 +360,12 @@ Where command is one of:
         print('Unrecognized command: {}'.format(args.command))
         parser.print_help()
         exit(1)
+    if args.command == 'orders':
+        # Local store only
+        dispatch(args.command, None)
+        return
     # See code example from https://github.com/mjs/imapclient
-    server = IMAPClient(host=env('FOGHAT_IMAP_HOST'), use_uid=True)
+    server = IMAPClient(host=env('FOGHAT_IMAP_HOST'), port=imap_port, use_uid=True, ssl=imap_ssl)
     server.login(env('FOGHAT_IMAP_USER'), env('FOGHAT_IMAP_PASSWD'))
     # use dispatch pattern to invoke method with same name
     dispatch(args.command, server)
@@ -210,7 +375,8 @@ Where command is one of:
 # Adapted from https://stackoverflow.com/a/36270394/1502174
 func_name_dict = {
     'check': check,
-    'move': move
+    'move': move,
+    'orders': orders
 }
 
 def dispatch(name, *args, **kwargs):
@@ -31,7 +31,8 @@ cleanup_href_directory() {
     fi
 
     # Remove un-dated version of filenames (_should_ be a hard link)
-    find ./ -name 'href.t[01][0268]z.conus.prob.f[0123][0-9].grib2' | xargs -r -n1 unlink
+    # (and slim inventories, see FOGHAT_HREF_MATCH)
+    find ./ -name 'href.t[01][0268]z.conus.prob.f[0123][0-9].grib2' -or -name 'href.t[01][0268]z.conus.prob.f[0123][0-9].grib2.idx' | xargs -r -n1 unlink
     popd >/dev/null
 }
 
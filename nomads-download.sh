@@ -23,13 +23,17 @@ fi
 
 mkdir -p $FOGHAT_LOG_DIR  $FOGHAT_ARCHIVE_DIR
 
+# Override w/ a local stand-in server for testing, e.g. http://localhost:8000
+NOMADS_URL=${FOGHAT_NOMADS_URL:-https://nomads.ncep.noaa.gov/pub/data/nccf/com}
+FOGHAT_EXE_DIR=${FOGHAT_EXE_DIR:-`dirname $0`}
+
 
 # Generate all possible HREF files for a given date (yyyymmdd)
 generate_href_urls () {
     local date=$1
 
     # Generate file w/ all the URLs [we want] for the given day
-    local base_url="https://nomads.ncep.noaa.gov/pub/data/nccf/com/hiresw/prod/href.$date/ensprod";
+    local base_url="$NOMADS_URL/hiresw/prod/href.$date/ensprod";
 
     local count=0
     for t in 00 06 12 18
@@ -54,7 +58,7 @@ generate_sref_urls () {
     local count=0
     for cc in 03 09 15 21
     do
-        local base_url="https://nomads.ncep.noaa.gov/pub/data/nccf/com/sref/prod/sref.$date/$cc/ensprod"
+        local base_url="$NOMADS_URL/sref/prod/sref.$date/$cc/ensprod"
         echo "$base_url/sref.t${cc}z.pgrb132.prob_3hrly.grib2"
         echo "$base_url/sref.t${cc}z.pgrb132.prob_3hrly.grib2.idx"
         count=$((count + 2))
@@ -65,12 +69,15 @@ generate_sref_urls () {
 download_urls () {
     local dest_path=$1
     local log_fqpn=$2
+    local match=$3
 
     mkdir -p $dest_path
     # Monitor and log time of all downloads
     local start=`date '+%s'`
     echo "?downloading URLs into $dest_path" >>$log_fqpn
-    /usr/bin/wget -nv --no-parent --load-cookies $FOGHAT_COOKIES --save-cookies $FOGHAT_COOKIES $FOGHAT_WGET_OPTIONS --timestamping --append-output=$log_fqpn --directory-prefix=$dest_path --input-file=-
+    # Concurrent, keep-alive, resumable; files already in $dest_path/.download_manifest.json are skipped
+    # If match (regex) is given, only the GRIB messages it matches (using the .idx inventories)
+    $FOGHAT_EXE_DIR/download_urls.py --jobs ${FOGHAT_DOWNLOAD_JOBS:-4} --directory $dest_path ${match:+--match "$match"} 2>>$log_fqpn
     local end=`date '+%s'`
     local delta=$((end - start))
     printf -v mmss '%d:%02d' $((delta/60)) $((delta % 60))
@@ -78,7 +85,7 @@ download_urls () {
 }
 
 # Add date to filename using hard links here b/c straightforward renaming
-# will cause wget to download _everything_ again when it is re-run
+# will cause _everything_ to be downloaded again when it is re-run
 rename_w_date() {
     local archive_fqpn=$1
 
@@ -92,6 +99,8 @@ rename_w_date() {
     echo "?In $archive_fqpn:"
     for i in *
     do
+        # Incomplete download, download_urls.py resumes it next time
+        [[ "$i" == *.part ]] && continue
         j=`echo $i | sed -r "s/\.(f[0-3][0-9]|prob_3hrly)\.grib2/.\1.${date}.grib2/;"`
         if [[ "$j" != '*' && ! -e "$j" ]]
         then
@@ -142,7 +151,7 @@ then
     do
         year="${date:0:4}"
         DEST_PATH="$ARCHIVE_DIR/$year/$date"
-        generate_href_urls $date | download_urls $DEST_PATH $LOG_FILE
+        generate_href_urls $date | download_urls $DEST_PATH $LOG_FILE "$FOGHAT_HREF_MATCH"
         rename_w_date $DEST_PATH >>$LOG_FILE
     done
 elif [[ "$MODE" == 'sref' ]]
@@ -159,7 +168,7 @@ then
     do
         year="${date:0:4}"
         DEST_PATH="$ARCHIVE_DIR/$year/$date"
-        generate_sref_urls $date | download_urls $DEST_PATH $LOG_FILE
+        generate_sref_urls $date | download_urls $DEST_PATH $LOG_FILE "$FOGHAT_SREF_MATCH"
         rename_w_date $DEST_PATH >>$LOG_FILE
     done
 else
@@ -1,15 +1,13 @@
 #!/usr/bin/env bash
 
 # Automate scheduling one year of data processing
-# Split the processing across four jobs, one for each model cycle (0, 6, 12, 18)
+# Split the processing into a job array of shards (runs of days of one
+# model cycle) of about the same run time, planned by maps_shards.py from
+# the NAM tarfiles available, what's already complete (resume) and
+# measured (day, cycle) processing times, then create the year's tarball
 
-# XXX Assumes your _customized_ HPC sbatch script is in hpc_maps.sbatch
-
-function getjobid() {
-    # sbatch outputs job ID message to stderr
-    local jobid=`$* 2>&1 | grep -Pi -o 'job \d+\b' | sed -r 's/^job //gi;'`
-    echo "$jobid"
-}
+# XXX Assumes your _customized_ HPC sbatch scripts are in
+#     hpc_maps_array.sbatch and hpc_tarball.sbatch
 
 # Ensure [default] jobs stdout/stderr folder exists
 # See SBATCH --output command(s) in .sbatch files
@@ -17,21 +15,18 @@ mkdir -p /work/TANN/$USER/jobs
 
 # Simple sanity check on input
 year=$1
-if [[ $year -lt 2009 || $year -gt 2030 ]]
+shards=${2:-${FOGHAT_SHARDS:-48}}
+if [[ $year -lt 2009 || $year -gt 2030 || ! $shards =~ ^[1-9][0-9]*$ ]]
 then
-    echo "?Usage: $0 <year>"
+    echo "?Usage: $0 <year> [shards]"
     exit
 fi
 
-echo "?Queueing data processing jobs for data year $year"
-j1=$(getjobid sbatch --job-name "fogm${year:2}00" hpc_maps.sbatch -c 0  $year-01-01 $year-12-31)
-j2=$(getjobid sbatch --job-name "fogm${year:2}06" hpc_maps.sbatch -n -c 6  $year-01-01 $year-12-31)
-j3=$(getjobid sbatch --job-name "fogm${year:2}12" hpc_maps.sbatch -n -c 12 $year-01-01 $year-12-31)
-j4=$(getjobid sbatch --job-name "fogm${year:2}18" hpc_maps.sbatch -n -c 18 $year-01-01 $year-12-31)
-
-echo "?Data processing job IDs: $j1, $j2, $j3, $j4"
-RULE=afterok:$j1:$j2:$j3:$j4
+# maps_shards.py needs the python environment (numpy)
+source $HOME/venv/foghat/bin/activate
 
-# Have slurm wait to run the following job until the previous 4 jobs complete (successfully)
-echo "?Queueing tarball job once processing jobs complete ($RULE)"
-sbatch --job-name "fogtar${year:2}" --dependency="$RULE" hpc_tarball.sbatch $year
+# Plan is shown and saved in $FOGHAT_LOG_DIR/maps_shards-${year}0101-${year}1231.json,
+# to only see the plan: maps_shards.py submit --dry-run ...
+echo "?Queueing data processing job array ($shards shards) for data year $year"
+# Have slurm wait to run the tarball job until every array task completes (successfully)
+$FOGHAT_EXE_DIR/maps_shards.py submit --resume --shards $shards $year-01-01 $year-12-31
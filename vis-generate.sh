@@ -6,12 +6,12 @@
 # Bounding box for Hamid's DL NN
 LON_LAT='-98.01:-94.20 25.4:28.85'
 
-# lon/lat position closest to KRAS airport (27.8118333,-97.0887500)  →  ~( 27.8191,-97.0672 )
-CSV_LON_LAT='-97.07:-97.05 27.79:27.84'
+# CSV time series are for the grid point(s) closest to KRAS airport
+# (27.8118333,-97.0887500)  →  ~( 27.8191,-97.0672 ), see STATIONS in
+# grid_index.py, or the stations in the -s STATIONS file
 
 # A single regex w/ all the predictors at all the levels we want
 MATCH_RE=":VIS:surface:"
-CSV_MATCH_RE=":VIS.prob"
 
 # ---8<---  ---8<---  ---8<---  wgrib2 vars above  ---8<---  ---8<---  ---8<---
 
@@ -85,17 +85,10 @@ process_day_csv()
     local ymd=`date -d "$when" '+%Y %m%d'`
     read year md <<<$ymd                # year, month+day
 
-    # Process HREF grib files for today
-    for fn in $HREF_ARCHIVE_DIR/$year$md/href.t??z.conus.prob.f??.$year$md.grib2
-    #for fn in $HREF_ARCHIVE_DIR/$year/$year$md/href.t${mc}z.conus.prob.f??.$year$md.grib2
-    do
-        wgrib2 $FOGHAT_WGRIB_OPTS $fn -set_ext_name 1 -match $CSV_MATCH_RE -undefine out-box $CSV_LON_LAT -inv /dev/null -csv -
-    done  | $FOGHAT_EXE_DIR/csv_combine.pl >>$TMP_CSV_FILE
-
-    # XXX  Kluge count b/c I can't get the loop iteration/file counting
-    #      to work when I pipe the entire stdout of the loop to the
-    #      csv_combine.pl process ¯\_(ツ)_/¯
-    local count=`ls -1 $HREF_ARCHIVE_DIR/$year$md/href.t??z.conus.prob.f??.$year$md.grib2 | wc --lines`
+    # Process HREF grib files for today, all stations in one pass
+    local files=`ls -1 $HREF_ARCHIVE_DIR/$year$md/href.t??z.conus.prob.f??.$year$md.grib2 2>/dev/null`
+    local count=`echo -n "$files" | grep -c .`
+    [[ $count -gt 0 ]] && $FOGHAT_EXE_DIR/href_points.py ${STATIONS:+--stations "$STATIONS"} $files >>$TMP_CSV_FILE
 
     local delta_t=$((`date '+%s'` - start_t))
     echo "?[CSV] $count forecast hour files processed from $year$md in $delta_t seconds" 1>&2
@@ -194,6 +187,7 @@ Generate probabilistic visibility data from NOMADS HREF
 
 Options:
   -p            Preserve intermediate files (debug only)
+  -s STATIONS   CSV time series for stations in this file (name,latitude,longitude), default KRAS
 
 E.g., $zero netcdf 2018-11-01 2018-11-30
 
@@ -207,7 +201,7 @@ EndOfUsage
 # Default CSV file label
 CSV_LABEL=''
 # Parse command line options
-while getopts "hl:p" OPTION; do
+while getopts "hl:ps:" OPTION; do
     case $OPTION in
     h)
         usage
@@ -218,6 +212,9 @@ while getopts "hl:p" OPTION; do
     p)
         PRESERVE=1
         ;;
+    s)
+        STATIONS=$OPTARG
+        ;;
     *)
         echo "Incorrect option ($OPTION) provided"
         exit 1